@@ -0,0 +1,117 @@
+"""
+JSON serialization benchmark for GET /recommendations pages
+
+Compares the original path (RealDictCursor rows copied with dict() and
+encoded by Flask's default provider) with the fast path (tuple cursor
+rows turned into dicts once by fetch_records and encoded by
+FastJSONProvider).
+
+Rows come from generate_series when DATABASE_URL is set, so cursor
+overhead is included; otherwise synthetic rows measure encoding only.
+
+Usage:
+    python benchmarks/json_serialization.py [--rows 10000] [--repeat 20]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+import server
+
+PAGE_QUERY = """
+    SELECT g AS id,
+           'Customer ' || g AS name,
+           g %% 101 AS risk_score,
+           CASE WHEN g %% 101 < 50 THEN 'Bonds' ELSE 'Stocks' END AS portfolio_type,
+           TIMESTAMP '2024-01-01' + g * INTERVAL '1 second' AS timestamp
+    FROM generate_series(1, %s) AS g
+"""
+
+class SyntheticCursor:
+    """Stands in for a tuple cursor when no database is configured"""
+
+    class Column:
+        def __init__(self, name):
+            self.name = name
+
+    def __init__(self, rows):
+        self.description = [self.Column(name) for name in
+                            ('id', 'name', 'risk_score', 'portfolio_type', 'timestamp')]
+        self._rows = rows
+
+    def fetchall(self):
+        return list(self._rows)
+
+def synthetic_rows(count):
+    start = datetime(2024, 1, 1)
+    return [
+        (i, f"Customer {i}", i % 101, 'Bonds' if i % 101 < 50 else 'Stocks',
+         start + timedelta(seconds=i))
+        for i in range(1, count + 1)
+    ]
+
+def time_it(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    std_app = Flask('std')
+    std_app.json = DefaultJSONProvider(std_app)
+    fast_app = Flask('fast')
+    fast_app.json = server.FastJSONProvider(fast_app)
+
+    conn = None
+    if os.getenv('DATABASE_URL'):
+        conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+    rows = synthetic_rows(args.rows)
+
+    def original():
+        if conn:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            cursor.execute(PAGE_QUERY, (args.rows,))
+            records = cursor.fetchall()
+        else:
+            columns = ('id', 'name', 'risk_score', 'portfolio_type', 'timestamp')
+            records = [dict(zip(columns, row)) for row in rows]
+        with std_app.app_context():
+            std_app.json.response({'recommendations': [dict(row) for row in records]}).get_data()
+
+    def fast():
+        if conn:
+            cursor = conn.cursor()
+            cursor.execute(PAGE_QUERY, (args.rows,))
+        else:
+            cursor = SyntheticCursor(rows)
+        with fast_app.app_context():
+            fast_app.json.response({'recommendations': server.fetch_records(cursor)}).get_data()
+
+    source = 'postgres' if conn else 'synthetic'
+    print(f"{args.rows} rows ({source}), median of {args.repeat} runs")
+    original_ms = time_it(original, args.repeat)
+    fast_ms = time_it(fast, args.repeat)
+    encoder = 'orjson' if server.orjson else 'stdlib'
+    print(f"  original (RealDictCursor, dict copy, default provider): {original_ms:8.2f} ms")
+    print(f"  fast     (tuple cursor, FastJSONProvider with {encoder:6s}): {fast_ms:8.2f} ms")
+    print(f"  speedup: {original_ms / fast_ms:.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+"""
+Load test and latency benchmark for the recommendation API
+
+Replays synthetic or recorded requests against a running server at a
+fixed concurrency and reports throughput and latency percentiles per
+scenario as JSON. With --baseline, fails (exit code 1) when a scenario
+regressed by more than --tolerance.
+
+Scenarios:
+    recommend_json   POST /recommend with a JSON body
+    recommend_xml    POST /recommend with an XML body
+    recommendations  GET /recommendations?limit=100
+    metrics          GET /metrics
+
+Recorded workloads are NDJSON files with one request per line:
+    {"method": "POST", "path": "/recommend",
+     "headers": {"Content-Type": "application/json"},
+     "body": "{\"risk_score\": 42}"}
+
+Usage:
+    # against a server that is already running
+    python benchmarks/load_test.py --url http://127.0.0.1:5000
+
+    # start gunicorn locally (uses DATABASE_URL from the environment),
+    # save a baseline, then compare later runs against it
+    python benchmarks/load_test.py --start-server --output baseline.json
+    python benchmarks/load_test.py --start-server --baseline baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCENARIOS = ('recommend_json', 'recommend_xml', 'recommendations', 'metrics')
+# Requests prepared per scenario; workers cycle through them
+SAMPLE_SIZE = 1000
+
+def synthetic_requests(scenario):
+    """Return (method, path, headers, body) tuples for a scenario"""
+    rng = random.Random(scenario)
+    requests = []
+    for i in range(SAMPLE_SIZE):
+        risk_score = rng.randint(0, 100)
+        if scenario == 'recommend_json':
+            body = json.dumps({'risk_score': risk_score, 'name': f'bench-{i}'})
+            requests.append(('POST', '/recommend', {'Content-Type': 'application/json'}, body))
+        elif scenario == 'recommend_xml':
+            body = (f'<?xml version="1.0"?><request><risk_score>{risk_score}</risk_score>'
+                    f'<name>bench-{i}</name></request>')
+            requests.append(('POST', '/recommend', {'Content-Type': 'application/xml'}, body))
+        elif scenario == 'recommendations':
+            requests.append(('GET', '/recommendations?limit=100', {}, ''))
+        elif scenario == 'metrics':
+            requests.append(('GET', '/metrics', {}, ''))
+        else:
+            raise ValueError(f'Unknown scenario: {scenario}')
+    return requests
+
+def recorded_requests(path):
+    """Load a recorded NDJSON workload"""
+    requests = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                requests.append((
+                    entry.get('method', 'GET'),
+                    entry['path'],
+                    entry.get('headers', {}),
+                    entry.get('body', '')
+                ))
+    if not requests:
+        raise ValueError(f'No requests in {path}')
+    return requests
+
+def encode_request(host, method, path, headers, body):
+    body = body.encode() if isinstance(body, str) else body
+    lines = [f'{method} {path} HTTP/1.1', f'Host: {host}', f'Content-Length: {len(body)}']
+    lines += [f'{name}: {value}' for name, value in headers.items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + body
+
+async def read_response(reader):
+    """Read one HTTP/1.1 response; returns (status, keep_alive)"""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('Connection closed by server')
+    status = int(status_line.split()[1])
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    else:
+        await reader.read()
+        return status, False
+
+    return status, headers.get('connection', '').lower() != 'close'
+
+async def run_scenario(url, requests, concurrency, duration):
+    """Drive requests with `concurrency` keep-alive connections for `duration` seconds"""
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    payloads = [encode_request(parts.netloc, *request) for request in requests]
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def worker(offset):
+        nonlocal errors
+        reader = writer = None
+        i = offset
+        while time.monotonic() < deadline:
+            payload = payloads[i % len(payloads)]
+            i += concurrency
+            reused = writer is not None
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection(host, port)
+                started = time.perf_counter()
+                writer.write(payload)
+                await writer.drain()
+                status, keep_alive = await read_response(reader)
+                latencies.append(time.perf_counter() - started)
+                if status >= 400:
+                    errors += 1
+                if not keep_alive:
+                    writer.close()
+                    writer = None
+            except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+                writer = None
+                if reused:
+                    # The server may close an idle keep-alive connection (e.g.
+                    # when recycling a worker); retry on a fresh one like an
+                    # HTTP client would instead of counting an error
+                    i -= concurrency
+                    continue
+                errors += 1
+                await asyncio.sleep(0.01)
+        if writer is not None:
+            writer.close()
+
+    started = time.monotonic()
+    await asyncio.gather(*(worker(n) for n in range(concurrency)))
+    elapsed = time.monotonic() - started
+    return summarize(latencies, errors, elapsed)
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return round(sorted_values[index] * 1000, 2)
+
+def summarize(latencies, errors, elapsed):
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': round(latencies[-1] * 1000, 2) if latencies else None
+    }
+
+def compare(results, baseline, tolerance):
+    """Return a list of regressions of results against a baseline run"""
+    regressions = []
+    for name, base in baseline.get('scenarios', {}).items():
+        current = results['scenarios'].get(name)
+        if current is None:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if base.get(key) and current.get(key) and current[key] > base[key] * (1 + tolerance):
+                regressions.append(f'{name}: {key} {current[key]} > baseline {base[key]}')
+        if base.get('rps') and current['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f"{name}: rps {current['rps']} < baseline {base['rps']}")
+        base_error_rate = base['errors'] / max(base['requests'], 1)
+        error_rate = current['errors'] / max(current['requests'], 1)
+        if error_rate > base_error_rate + 0.01:
+            regressions.append(f'{name}: error rate {error_rate:.2%} > baseline {base_error_rate:.2%}')
+    return regressions
+
+def start_server(url):
+    """Migrate the schema, start gunicorn for this repository and wait until it is ready"""
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'server', 'migrate'],
+                   cwd=ROOT_DIR, stdout=subprocess.DEVNULL, check=True)
+    parts = urlsplit(url)
+    # All load comes from one client, which the rate limiter would throttle
+    env = dict(os.environ)
+    env.setdefault('RATE_LIMIT', 'off')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         '-b', f'{parts.hostname}:{parts.port}', 'server:app'],
+        cwd=ROOT_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f'{url}/health/ready', timeout=1).read()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('Server did not become healthy')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='scenario to run (repeatable, default: all)')
+    parser.add_argument('--workload', help='recorded NDJSON workload, run as scenario "recorded"')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=10, help='seconds per scenario')
+    parser.add_argument('--warmup', type=float, default=1, help='seconds of unmeasured load first')
+    parser.add_argument('--output', help='write results JSON to this file')
+    parser.add_argument('--baseline', help='compare against a previous results JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative regression (default 0.2 = 20%%)')
+    parser.add_argument('--start-server', action='store_true',
+                        help='start gunicorn for this repository on --url')
+    args = parser.parse_args()
+
+    if args.workload:
+        workloads = {'recorded': recorded_requests(args.workload)}
+    else:
+        workloads = {name: synthetic_requests(name) for name in (args.scenario or SCENARIOS)}
+
+    server = start_server(args.url) if args.start_server else None
+    try:
+        results = {
+            'meta': {
+                'url': args.url,
+                'concurrency': args.concurrency,
+                'duration': args.duration,
+                'started': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'cpus': os.cpu_count()
+            },
+            'scenarios': {}
+        }
+        for name, requests in workloads.items():
+            if args.warmup > 0:
+                asyncio.run(run_scenario(args.url, requests, args.concurrency, args.warmup))
+            summary = asyncio.run(run_scenario(args.url, requests, args.concurrency, args.duration))
+            results['scenarios'][name] = summary
+            print(f"{name:16s} rps={summary['rps']:>8} p50={summary['p50_ms']}ms "
+                  f"p95={summary['p95_ms']}ms p99={summary['p99_ms']}ms errors={summary['errors']}",
+                  file=sys.stderr)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Cold start and worker recycle benchmark
+
+Measures, for the database in DATABASE_URL and for a stalled one that
+accepts connections but never answers:
+    import     seconds to import server.py in a fresh interpreter, which
+               every gunicorn worker pays when it boots
+    boot       seconds from starting gunicorn (one worker) to the first
+               served request
+    recycle    worst request latency while that worker is recycled every
+               --max-requests requests, against the median request
+
+Requests go to /metrics/prometheus, which does not touch the database,
+so the numbers show what startup itself costs.
+
+Usage:
+    DATABASE_URL=postgresql://... python benchmarks/startup.py
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PROBE_PATH = '/metrics/prometheus'
+
+def time_import(env, runs):
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c',
+             'import time; started = time.perf_counter(); import server; '
+             'print(time.perf_counter() - started)'],
+            cwd=ROOT_DIR, env=env, capture_output=True, text=True, check=True
+        ).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return round(statistics.median(timings), 3)
+
+def get(url, timeout=30, retry_for=0):
+    """
+    Time one GET, retrying for up to retry_for seconds: a recycling
+    worker may drop a connection it accepted but did not serve
+    """
+    started = time.perf_counter()
+    while True:
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                response.read()
+            return time.perf_counter() - started
+        except (ConnectionError, http.client.HTTPException):
+            if time.perf_counter() - started > retry_for:
+                raise
+            time.sleep(0.001)
+
+def time_boot_and_recycle(env, port, max_requests):
+    url = f'http://127.0.0.1:{port}{PROBE_PATH}'
+    env = dict(env, WEB_CONCURRENCY='1', GUNICORN_MAX_REQUESTS=str(max_requests),
+               GUNICORN_MAX_REQUESTS_JITTER='0')
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         '-b', f'127.0.0.1:{port}', 'server:app'],
+        cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while True:
+            try:
+                get(url, timeout=1)
+                break
+            except (OSError, http.client.HTTPException):
+                if process.poll() is not None or time.perf_counter() - started > 120:
+                    raise RuntimeError('gunicorn did not start')
+                time.sleep(0.01)
+        boot = time.perf_counter() - started
+
+        latencies = [get(url, retry_for=30) for _ in range(max_requests * 3)]
+        return {
+            'boot_s': round(boot, 3),
+            'request_p50_ms': round(statistics.median(latencies) * 1000, 2),
+            'recycle_max_ms': round(max(latencies) * 1000, 2)
+        }
+    finally:
+        process.terminate()
+        process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5, help='imports timed per database')
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--max-requests', type=int, default=50)
+    args = parser.parse_args()
+
+    # Connections to a socket that is never accepted hang until the connect timeout
+    stalled = socket.socket()
+    stalled.bind(('127.0.0.1', 0))
+    stalled.listen(1024)
+    stalled_url = f'postgresql://postgres@127.0.0.1:{stalled.getsockname()[1]}/postgres'
+
+    results = {}
+    targets = {'reachable': os.getenv('DATABASE_URL'), 'stalled': stalled_url}
+    for name, database_url in targets.items():
+        if not database_url:
+            continue
+        env = dict(os.environ, DATABASE_URL=database_url)
+        results[name] = {
+            'import_s': time_import(env, args.runs),
+            **time_boot_and_recycle(env, args.port, args.max_requests)
+        }
+        print(name, results[name], file=sys.stderr)
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -14,10 +14,70 @@ import {
   Users,
   XCircle,
 } from "lucide-react";
-import { useEffect, useState } from "react";
+import { useEffect, useRef, useState } from "react";
 
 const API_BASE_URL = import.meta.env.VITE_BASE_URL || "http://localhost:5000";
 console.log("Using API Base URL:", API_BASE_URL);
+
+// Rows kept in the live recommendations table
+const MAX_LIVE_ROWS = 100;
+
+// Apply a live "metrics" event to the state loaded from /metrics.
+// Recommendation events carry only the change to each portfolio type;
+// a missed event is followed by a "reset", which refetches.
+const applyMetricsUpdate = (current, { type, delta, totals }) => {
+  if (type === "recommendations") {
+    const distribution = [...(current.portfolio_distribution || [])];
+    for (const [portfolioType, { count, risk_score_sum }] of Object.entries(
+      delta
+    )) {
+      const index = distribution.findIndex(
+        (row) => row.portfolio_type === portfolioType
+      );
+      const previous =
+        index === -1 ? { count: 0, avg_risk_score: 0 } : distribution[index];
+      const newCount = previous.count + count;
+      const entry = {
+        portfolio_type: portfolioType,
+        count: newCount,
+        avg_risk_score:
+          (previous.avg_risk_score * previous.count + risk_score_sum) /
+          newCount,
+      };
+      if (index === -1) {
+        distribution.push(entry);
+      } else {
+        distribution[index] = entry;
+      }
+    }
+    return {
+      ...current,
+      portfolio_distribution: distribution,
+      total_recommendations: distribution.reduce(
+        (sum, row) => sum + row.count,
+        0
+      ),
+    };
+  }
+
+  // Test results: totals for passed/failed, deltas for any other status
+  const passed = totals.passed?.count ?? current.passed_tests;
+  const failed = totals.failed?.count ?? current.failed_tests;
+  const other = Object.entries(delta)
+    .filter(([status]) => status !== "passed" && status !== "failed")
+    .reduce((sum, [, { count }]) => sum + count, 0);
+  return {
+    ...current,
+    passed_tests: passed,
+    failed_tests: failed,
+    total_tests:
+      current.total_tests +
+      (passed - current.passed_tests) +
+      (failed - current.failed_tests) +
+      other,
+  };
+};
+
 const App = () => {
   const [activeTab, setActiveTab] = useState("client");
   const [isQALoggedIn, setIsQALoggedIn] = useState(false);
@@ -32,6 +92,9 @@ const App = () => {
   const [userName, setUserName] = useState("");
   const [recommendation, setRecommendation] = useState(null);
   const [loading, setLoading] = useState(false);
+  // Idempotency-Key of the submission in flight, reused by double-clicks
+  // and retries of the same request
+  const pendingRecommend = useRef(null);
 
   // QA Dashboard State
   const [testOutput, setTestOutput] = useState("");
@@ -41,12 +104,63 @@ const App = () => {
   const [qaDashboardTab, setQaDashboardTab] = useState("tests");
   const [recommendations, setRecommendations] = useState([]);
   const [recsLoading, setRecsLoading] = useState(false);
+  // Whether the live event stream is connected
+  const liveEvents = useRef(false);
 
-  // Fetch metrics on QA dashboard load
+  // Fetch metrics on QA dashboard load, then follow live updates
   useEffect(() => {
-    if (isQALoggedIn && activeTab === "qa") {
-      fetchMetrics();
+    if (!(isQALoggedIn && activeTab === "qa")) {
+      return undefined;
     }
+    fetchMetrics();
+
+    const events = new EventSource(`${API_BASE_URL}/events`);
+    let connected = false;
+    events.addEventListener("ready", () => {
+      // After a reconnect, reload whatever was missed in between
+      if (connected) {
+        fetchMetrics();
+      }
+      connected = true;
+      liveEvents.current = true;
+    });
+    events.addEventListener("reset", () => fetchMetrics());
+    events.addEventListener("recommendations", (event) => {
+      const rows = JSON.parse(event.data).rows.reverse();
+      setRecommendations((current) => {
+        const ids = new Set(rows.map((row) => row.id));
+        return [...rows, ...current.filter((row) => !ids.has(row.id))].slice(
+          0,
+          MAX_LIVE_ROWS
+        );
+      });
+    });
+    events.addEventListener("test_results", (event) => {
+      const rows = JSON.parse(event.data).rows.reverse();
+      setMetrics(
+        (current) =>
+          current && {
+            ...current,
+            recent_tests: [...rows, ...(current.recent_tests || [])].slice(
+              0,
+              10
+            ),
+          }
+      );
+    });
+    events.addEventListener("metrics", (event) => {
+      const update = JSON.parse(event.data);
+      setMetrics((current) => current && applyMetricsUpdate(current, update));
+    });
+    events.onerror = () => {
+      // The browser reconnects by itself
+      liveEvents.current = false;
+    };
+
+    return () => {
+      events.close();
+      liveEvents.current = false;
+    };
   }, [isQALoggedIn, activeTab]);
 
   const handleQALogin = (e) => {
@@ -74,17 +188,28 @@ const App = () => {
     setLoading(true);
     setRecommendation(null);
 
+    const body = JSON.stringify({
+      risk_score: parseInt(riskScore),
+      name: userName || "Anonymous User",
+    });
+    if (pendingRecommend.current?.body !== body) {
+      pendingRecommend.current = { body, key: crypto.randomUUID() };
+    }
+
     try {
       const response = await fetch(`${API_BASE_URL}/recommend`, {
         method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({
-          risk_score: parseInt(riskScore),
-          name: userName || "Anonymous User",
-        }),
+        headers: {
+          "Content-Type": "application/json",
+          "Idempotency-Key": pendingRecommend.current.key,
+        },
+        body,
       });
 
       const data = await response.json();
+      if (response.ok) {
+        pendingRecommend.current = null;
+      }
       setRecommendation(data);
     } catch (error) {
       console.error("Error fetching recommendation:", error);
@@ -103,19 +228,51 @@ const App = () => {
     );
 
     try {
+      // Start the run in the background, then stream its output
       const response = await fetch(
-        `${API_BASE_URL}/run-tests?type=${encodeURIComponent(testType)}`
+        `${API_BASE_URL}/run-tests/jobs?type=${encodeURIComponent(testType)}`,
+        { method: "POST" }
       );
-      const data = await response.json();
-      setTestOutput(data.output || data.error || "No output received");
-
-      // Refresh metrics after test run
-      setTimeout(() => fetchMetrics(), 1000);
+      const job = await response.json();
+      if (!response.ok) {
+        setTestOutput(job.error || "No output received");
+        setTestRunning(false);
+        return;
+      }
+
+      let output = "";
+      const events = new EventSource(
+        `${API_BASE_URL}/run-tests/jobs/${job.id}/events`
+      );
+      events.addEventListener("output", (event) => {
+        output += JSON.parse(event.data).text;
+        setTestOutput(output);
+      });
+      events.addEventListener("done", (event) => {
+        const result = JSON.parse(event.data);
+        events.close();
+        if (!output) {
+          setTestOutput(`Test run finished with status: ${result.status}`);
+        }
+        setTestRunning(false);
+
+        // Refresh metrics after test run, unless live events already did
+        if (!liveEvents.current) {
+          fetchMetrics();
+        }
+      });
+      events.onerror = () => {
+        if (events.readyState === EventSource.CLOSED) {
+          setTestOutput(
+            `${output}\n[SYSTEM ALERT]: Lost connection to test output stream.`
+          );
+          setTestRunning(false);
+        }
+      };
     } catch (error) {
       setTestOutput(
         `Error: ${error.message}\n[SYSTEM ALERT]: Ensure backend service is active at ${API_BASE_URL}.`
       );
-    } finally {
       setTestRunning(false);
     }
   };
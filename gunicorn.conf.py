@@ -0,0 +1,65 @@
+"""
+Gunicorn configuration for the Flask backend
+
+GUNICORN_WORKER_CLASS selects the serving mode:
+- gthread (default): each worker serves GUNICORN_THREADS requests
+  concurrently on OS threads; no extra dependencies
+- gevent: each worker multiplexes up to GUNICORN_WORKER_CONNECTIONS
+  connections on greenlets, with psycopg2 made cooperative in post_fork
+- sync: one request at a time per worker (gunicorn's default)
+
+See the "Serving" section of README.md for measured capacity.
+"""
+import os
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+threads = int(os.getenv('GUNICORN_THREADS', 8)) if worker_class == 'gthread' else 1
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# /run-tests may legitimately run for up to 30 seconds
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+# Recycle workers periodically to bound memory growth
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+
+def make_psycopg2_green():
+    """
+    Make psycopg2 yield to the gevent hub while waiting on the socket,
+    so one worker can have many queries in flight
+    """
+    import psycopg2.extensions
+    from gevent.socket import wait_read, wait_write
+
+    def wait_callback(conn, timeout=None):
+        while True:
+            state = conn.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                break
+            elif state == psycopg2.extensions.POLL_READ:
+                wait_read(conn.fileno(), timeout=timeout)
+            elif state == psycopg2.extensions.POLL_WRITE:
+                wait_write(conn.fileno(), timeout=timeout)
+            else:
+                raise psycopg2.OperationalError(f"Bad result from poll: {state}")
+
+    psycopg2.extensions.set_wait_callback(wait_callback)
+
+def on_starting(server):
+    # A per-worker response cache is only invalidated in the worker that
+    # wrote, so the others would serve stale responses until the TTL
+    if server.cfg.workers > 1:
+        os.environ.setdefault('RESPONSE_CACHE', 'sqlite')
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        make_psycopg2_green()
+
+def post_worker_init(worker):
+    # Start the readiness checks before the worker takes its first request,
+    # so probes do not see it as 'starting' longer than the first check
+    import server
+    server.get_readiness_checker()
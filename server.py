@@ -1,15 +1,113 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, make_response, stream_with_context, g, has_request_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import xml.etree.ElementTree as ET
+import xml.parsers.expat
+import base64
+import bisect
+import codecs
+import contextlib
+import csv
+import functools
+import hashlib
+import io
+import itertools
+import math
+import sqlite3
+import tempfile
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from urllib.parse import urlencode, urlsplit
 import subprocess
 import sys
 import os
-from datetime import datetime
+import atexit
+import queue
+import random
+import select
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2 import sql
+from psycopg2.extras import execute_values
 import json
 
+try:
+    import orjson
+except ImportError:  # optional: fall back to the stdlib encoder
+    orjson = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # optional: only needed for Parquet exports
+    pyarrow = None
+
+try:
+    import brotli
+except ImportError:  # optional: responses fall back to gzip
+    brotli = None
+
+# JSON_PROVIDER: 'fast' (orjson when installed) or 'std' (Flask default)
+JSON_PROVIDER = os.getenv('JSON_PROVIDER', 'fast').lower()
+
+def json_default(value):
+    """Encode the non-JSON types returned by psycopg2"""
+    if isinstance(value, datetime):
+        # TIMESTAMP columns are naive and stored in UTC
+        if value.tzinfo is None:
+            return utc_isoformat(value)
+        return value.isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def utc_now():
+    """Current UTC time as a naive datetime, as stored in TIMESTAMP columns"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def utc_isoformat(value):
+    """ISO 8601 with a +00:00 offset for a naive UTC datetime"""
+    return value.replace(tzinfo=timezone.utc).isoformat()
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider that encodes with orjson when it is installed
+    Datetimes are written as ISO 8601 (naive values as UTC) and Decimals
+    as numbers, with the same output from the stdlib fallback
+    """
+
+    _ORJSON_OPTIONS = (orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS) if orjson else 0
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.dumps(obj, default=json_default, option=self._ORJSON_OPTIONS).decode()
+        kwargs.setdefault('default', json_default)
+        return json.dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if orjson is not None:
+            body = orjson.dumps(obj, default=json_default, option=self._ORJSON_OPTIONS)
+        else:
+            body = json.dumps(obj, default=json_default, separators=(',', ':'))
+        return self._app.response_class(body, mimetype=self.mimetype)
+
 app = Flask(__name__)
+if JSON_PROVIDER == 'fast':
+    app.json = FastJSONProvider(app)
 if os.getenv('RENDER'):
     # In production, allow specific origins
     CORS(app, origins=[
@@ -20,359 +118,4858 @@ else:
     # In development, allow all origins
     CORS(app)
 
+# Request metrics configuration
+# REQUEST_METRICS: record per-route latency histograms and the time spent
+# parsing, checking out connections, running queries, serializing and
+# compressing
+REQUEST_METRICS = os.getenv('REQUEST_METRICS', 'true').lower() == 'true'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PHASES = ('parse', 'db_connect', 'query', 'serialize', 'compress')
+
+class Histograms:
+    """
+    Latency histograms keyed by label tuples
+    Each OS thread records into its own shard, so observing takes no lock
+    (greenlets of a gevent worker share their thread's shard but never
+    switch in the middle of an update); snapshot() merges the shards
+    """
+
+    def __init__(self, labelnames, buckets):
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._shards = {}
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        thread_id = threading.get_native_id()
+        shard = self._shards.get(thread_id)
+        if shard is None:
+            with self._lock:
+                shard = self._shards.setdefault(thread_id, {})
+        return shard
+
+    def observe(self, labels, seconds):
+        shard = self._shard()
+        series = shard.get(labels)
+        if series is None:
+            # One slot per bucket, one for +Inf, then the running sum
+            series = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, seconds)] += 1
+        series[-1] += seconds
+
+    def snapshot(self):
+        """Return {labels: (cumulative bucket counts, count, sum)}"""
+        merged = {}
+        for shard in list(self._shards.values()):
+            for labels, series in shard.copy().items():
+                series = list(series)
+                total = merged.get(labels)
+                if total is None:
+                    merged[labels] = series
+                else:
+                    for i, value in enumerate(series):
+                        total[i] += value
+        result = {}
+        for labels, series in merged.items():
+            counts, running = [], 0
+            for value in series[:-1]:
+                running += value
+                counts.append(running)
+            result[labels] = (counts, running, series[-1])
+        return result
+
+request_latency = Histograms(('method', 'route', 'status'), LATENCY_BUCKETS)
+phase_latency = Histograms(('route', 'phase'), LATENCY_BUCKETS)
+
+def current_route():
+    """Route label for metrics: the matched URL rule, or 'background'"""
+    if not has_request_context():
+        return 'background'
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+def observe_phase(phase, seconds):
+    if REQUEST_METRICS:
+        phase_latency.observe((current_route(), phase), seconds)
+
+@contextlib.contextmanager
+def timed(phase):
+    """Record the time spent in the block as one phase of the current request"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_phase(phase, time.perf_counter() - started)
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor that records statement execution time as the 'query' phase"""
+
+    def execute(self, query, vars=None):
+        with timed('query'):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with timed('query'):
+            return super().executemany(query, vars_list)
+
+if REQUEST_METRICS:
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_latency(response):
+        # Streamed responses are measured up to the start of the body
+        started = g.pop('request_started', None)
+        if started is not None:
+            request_latency.observe(
+                (request.method, current_route(), str(response.status_code)),
+                time.perf_counter() - started
+            )
+        return response
+
+    def _timed_json_response(response):
+        @functools.wraps(response)
+        def wrapper(*args, **kwargs):
+            with timed('serialize'):
+                return response(*args, **kwargs)
+        return wrapper
+
+    app.json.response = _timed_json_response(app.json.response)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
 # Database Configuration - Replace with your NeonDB credentials
 DATABASE_URL = os.getenv('DATABASE_URL')
 
+# Connection pool configuration
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 5))
+DB_POOL_VALIDATE_AFTER = float(os.getenv('DB_POOL_VALIDATE_AFTER', 30))
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', 10))
+
+# Read replica configuration
+# DATABASE_REPLICA_URLS: comma-separated Postgres replica URLs. Routes that
+# read from replicas use one within REPLICA_MAX_LAG seconds of the primary,
+# or the primary when none is.
+DATABASE_REPLICA_URLS = [
+    url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()
+]
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 5))
+REPLICA_CHECK_INTERVAL = float(os.getenv('REPLICA_CHECK_INTERVAL', 5))
+# Routes whose queries go to replicas unless READ_ROUTES overrides them,
+# e.g. READ_ROUTES='/metrics=primary,/recommendations/export=primary'
+REPLICA_READ_ROUTES = ('/recommendations', '/recommendations/export', '/metrics', '/metrics/daily')
+
+# Storage backend configuration
+# STORAGE_BACKEND: 'postgres' (DATABASE_URL), 'sqlite' (a local WAL-mode file
+# shared by all workers on the host) or 'memory' (per worker, lost on exit).
+# Live events, daily rollups and cross-worker Idempotency-Keys need Postgres.
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'postgres').lower()
+STORAGE_SQLITE_PATH = os.getenv('STORAGE_SQLITE_PATH', os.path.join(BASE_DIR, 'fin-secure.sqlite3'))
+# WRITE_SPOOL: with Postgres, keep writes made while it is unreachable in a
+# local SQLite file and replay them once it is back
+WRITE_SPOOL = os.getenv('WRITE_SPOOL', 'true').lower() == 'true'
+WRITE_SPOOL_PATH = os.getenv(
+    'WRITE_SPOOL_PATH',
+    os.path.join(tempfile.gettempdir(), 'fin-secure-write-spool.sqlite3')
+)
+WRITE_SPOOL_MAX_ROWS = int(os.getenv('WRITE_SPOOL_MAX_ROWS', 100000))
+WRITE_SPOOL_BATCH_SIZE = int(os.getenv('WRITE_SPOOL_BATCH_SIZE', 1000))
+WRITE_SPOOL_REPLAY_INTERVAL = float(os.getenv('WRITE_SPOOL_REPLAY_INTERVAL', 5))
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became free within the timeout"""
+
+class PooledConnection(psycopg2.extensions.connection):
+    """psycopg2 connection that knows the pool it belongs to"""
+
+    pool = None
+
+class ConnectionPool:
+    """
+    Thread-safe Postgres connection pool
+    Keeps idle connections open between requests, caps the number of
+    open connections at maxconn and re-validates connections that sat
+    idle for longer than validate_after seconds before handing them out
+    """
+
+    def __init__(self, dsn, minconn, maxconn, timeout, validate_after):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = max(maxconn, 1)
+        self.timeout = timeout
+        self.validate_after = validate_after
+        self.pid = os.getpid()
+        self._idle = []  # (conn, last_used) pairs, most recently used last
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._counters = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'connects': 0,
+            'connect_errors': 0,
+            'discarded': 0
+        }
+
+    def _connect(self):
+        try:
+            conn = psycopg2.connect(
+                self.dsn,
+                connect_timeout=DB_CONNECT_TIMEOUT,
+                connection_factory=PooledConnection,
+                cursor_factory=TimedCursor if REQUEST_METRICS else None
+            )
+        except Exception:
+            self._count('connect_errors')
+            raise
+        self._count('connects')
+        conn.pool = self
+        return conn
+
+    def _count(self, key):
+        with self._cond:
+            self._counters[key] += 1
+
+    def _discard(self, conn):
+        self._count('discarded')
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_usable(self, conn, last_used):
+        """Check that an idle connection is still alive"""
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.validate_after:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def warm_up(self):
+        """Open minconn connections ahead of the first request"""
+        while True:
+            with self._cond:
+                if len(self._idle) + self._in_use >= self.minconn:
+                    return
+            conn = self._connect()
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def getconn(self):
+        """Check out a connection, waiting up to timeout seconds for one"""
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while not self._idle and self._in_use >= self.maxconn:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    raise PoolTimeout(
+                        f"No database connection available within {self.timeout}s"
+                    )
+                self._cond.wait(remaining)
+            entry = self._idle.pop() if self._idle else None
+            self._in_use += 1
+
+        try:
+            conn = None
+            if entry is not None:
+                conn, last_used = entry
+                if not self._is_usable(conn, last_used):
+                    self._discard(conn)
+                    conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        self._count('checkouts')
+        return conn
+
+    def putconn(self, conn):
+        """Return a connection to the pool, resetting any open transaction"""
+        keep = not conn.closed
+        if keep:
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                keep = False
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except Exception:
+                    keep = False
+        if not keep:
+            self._discard(conn)
+
+        with self._cond:
+            self._in_use -= 1
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        """Close every idle connection"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def stats(self):
+        with self._cond:
+            return {
+                'min_size': self.minconn,
+                'max_size': self.maxconn,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                **self._counters
+            }
+
+_pool = None
+_pool_lock = threading.Lock()
+# Schema version found by this worker's pool warm-up (None until checked)
+_schema_version = None
+# Pools inherited from a parent process across fork(). Their sockets are
+# shared with the parent, so they are kept referenced instead of being
+# closed (closing would terminate the parent's sessions).
+_inherited_pools = []
+
+def get_pool():
+    """Return the connection pool for the current process"""
+    global _pool
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+
+    with _pool_lock:
+        if _pool is not None and _pool.pid != os.getpid():
+            _inherited_pools.append(_pool)
+            _pool = None
+        if _pool is None:
+            _pool = ConnectionPool(
+                DATABASE_URL,
+                minconn=DB_POOL_MIN,
+                maxconn=DB_POOL_MAX,
+                timeout=DB_POOL_TIMEOUT,
+                validate_after=DB_POOL_VALIDATE_AFTER
+            )
+            # Connect in the background so a slow or missing database
+            # never holds up the request that created the pool
+            threading.Thread(
+                target=_prepare_pool, args=(_pool,), name='db-pool-warm-up', daemon=True
+            ).start()
+        return _pool
+
+def _prepare_pool(pool):
+    """Open the pool's minimum connections and check the schema version"""
+    global _schema_version
+    try:
+        pool.warm_up()
+        conn = pool.getconn()
+        try:
+            _schema_version = get_schema_version(conn)
+        finally:
+            pool.putconn(conn)
+    except Exception as e:
+        print(f"Database pool warm-up failed: {e}")
+        return
+    if _schema_version < SCHEMA_VERSION:
+        print(f"Warning: database schema is at version {_schema_version}, "
+              f"expected {SCHEMA_VERSION}; run `flask --app server migrate`")
+
 def get_db_connection():
-    """Create database connection"""
+    """Check out a pooled database connection"""
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        return conn
+        with timed('db_connect'):
+            return get_pool().getconn()
     except Exception as e:
         print(f"Database connection error: {e}")
         return None
 
-def init_database():
-    """Initialize database tables"""
-    conn = get_db_connection()
-    if not conn:
-        print("Warning: Could not connect to database")
-        return
+def release_db_connection(conn):
+    """Return a connection from get_db_connection or get_read_connection to its pool"""
+    try:
+        conn.pool.putconn(conn)
+    except Exception as e:
+        print(f"Error releasing database connection: {e}")
+
+def get_pool_stats():
+    """Connection pool statistics for the current worker"""
+    pool = _pool
+    if pool is None or pool.pid != os.getpid():
+        return None
+    return pool.stats()
+
+def parse_read_routes(overrides):
+    """Route -> 'primary' or 'replica', from REPLICA_READ_ROUTES and READ_ROUTES"""
+    routes = dict.fromkeys(REPLICA_READ_ROUTES, 'replica')
+    for item in overrides.split(','):
+        if not item.strip():
+            continue
+        route, _, target = item.partition('=')
+        target = target.strip().lower()
+        if target not in ('primary', 'replica'):
+            raise ValueError(f"READ_ROUTES entries must be route=primary|replica, got {item!r}")
+        routes[route.strip()] = target
+    return routes
+
+READ_ROUTES = parse_read_routes(os.getenv('READ_ROUTES', ''))
+
+# Seconds the replica is behind the primary. A replica that has replayed
+# everything it received from a live stream is current, however old its
+# last replayed transaction is (an idle primary sends nothing new).
+# Otherwise NULL when it has not replayed any transaction yet.
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+             AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming')
+            THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+class ReplicaRouter:
+    """
+    Chooses the pool for read-only queries
+    A background thread measures each replica's lag every check_interval
+    seconds. Reads go round-robin to the replicas within max_lag of the
+    primary; with none, get_read_connection falls back to the primary.
+    """
+
+    def __init__(self, urls, max_lag, check_interval):
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.pid = os.getpid()
+        self.replicas = [{
+            'host': f"{urlsplit(url).hostname}:{urlsplit(url).port or 5432}",
+            'pool': ConnectionPool(url, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT,
+                                   DB_POOL_VALIDATE_AFTER),
+            'lag': None,
+            'error': None,
+            'checked_at': None
+        } for url in urls]
+        self._available = []
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        self._counters = {'replica_reads': 0, 'primary_fallbacks': 0}
+        threading.Thread(target=self._run, name='replica-lag-check', daemon=True).start()
+
+    def _measure(self, pool):
+        conn = pool.getconn()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(REPLICA_LAG_SQL)
+            lag = cursor.fetchone()[0]
+            cursor.close()
+            if lag is None:
+                raise ValueError('Replica has not replayed any transaction yet')
+            return float(lag)
+        finally:
+            pool.putconn(conn)
+
+    def check(self):
+        """Measure every replica's lag and pick the ones reads may use"""
+        available = []
+        for replica in self.replicas:
+            try:
+                replica['lag'] = self._measure(replica['pool'])
+                replica['error'] = None
+            except Exception as e:
+                replica['lag'] = None
+                replica['error'] = str(e)
+            replica['checked_at'] = utc_now()
+            if replica['lag'] is not None and replica['lag'] <= self.max_lag:
+                available.append(replica['pool'])
+        self._available = available
+
+    def _run(self):
+        while True:
+            self.check()
+            time.sleep(self.check_interval)
+
+    def pool_for_read(self):
+        """A replica pool within max_lag, or None"""
+        available = self._available
+        if not available:
+            return None
+        return available[next(self._turn) % len(available)]
+
+    def count(self, key):
+        with self._lock:
+            self._counters[key] += 1
+
+    def stats(self):
+        with self._lock:
+            return {'healthy_replicas': len(self._available), **self._counters}
+
+    def status(self):
+        return [{
+            'host': replica['host'],
+            'lag': replica['lag'],
+            'healthy': replica['pool'] in self._available,
+            'error': replica['error'],
+            'checked_at': replica['checked_at'],
+            'pool': replica['pool'].stats()
+        } for replica in self.replicas]
+
+_replica_router = None
+_replica_router_lock = threading.Lock()
+
+def get_replica_router():
+    """Return the replica router for the current process"""
+    global _replica_router
+    router = _replica_router
+    if router is not None and router.pid == os.getpid():
+        return router
+
+    with _replica_router_lock:
+        if _replica_router is None or _replica_router.pid != os.getpid():
+            if _replica_router is not None:
+                # Its pools' sockets are shared with the parent; see _inherited_pools
+                _inherited_pools.extend(replica['pool'] for replica in _replica_router.replicas)
+            # The lag check thread does not survive fork()
+            _replica_router = ReplicaRouter(
+                DATABASE_REPLICA_URLS, REPLICA_MAX_LAG, REPLICA_CHECK_INTERVAL
+            )
+        return _replica_router
+
+def get_replica_stats():
+    """Replica routing counters for the current worker"""
+    router = _replica_router
+    if router is None or router.pid != os.getpid():
+        return None
+    return router.stats()
+
+def get_replica_status():
+    """Lag, health and pool statistics per replica, as seen by this worker"""
+    router = _replica_router
+    if router is None or router.pid != os.getpid():
+        return None
+    return router.status()
+
+def get_read_connection():
+    """
+    Check out a connection for read-only queries
+    Routes that read from replicas get one within REPLICA_MAX_LAG; every
+    other route, or when no replica qualifies, gets the primary
+    """
+    if DATABASE_REPLICA_URLS and READ_ROUTES.get(current_route()) == 'replica':
+        router = get_replica_router()
+        pool = router.pool_for_read()
+        if pool is not None:
+            try:
+                with timed('db_connect'):
+                    conn = pool.getconn()
+                router.count('replica_reads')
+                return conn
+            except Exception as e:
+                print(f"Replica connection error: {e}")
+        router.count('primary_fallbacks')
+    return get_db_connection()
+
+# Response cache configuration
+# RESPONSE_CACHE: 'memory' (per worker), 'sqlite' (shared by all workers on
+# the host through a local file) or 'off'. Writes only invalidate 'memory'
+# in the worker that made them, so gunicorn.conf.py defaults to 'sqlite'
+# when it starts more than one worker
+RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', 'memory').lower()
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 10))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 256))
+RESPONSE_CACHE_PATH = os.getenv(
+    'RESPONSE_CACHE_PATH',
+    os.path.join(tempfile.gettempdir(), 'fin-secure-response-cache.sqlite3')
+)
+
+class MemoryCache:
+    """
+    In-process TTL + LRU cache
+    Entries are grouped by namespace; invalidating a namespace bumps its
+    generation so responses computed before the write are never stored
+    under a key that will be read again
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires, namespace, value)
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generation(self, namespace):
+        with self._lock:
+            return self._generations.get(namespace, 0)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def set(self, key, namespace, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, namespace, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, namespace):
+        with self._lock:
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+            for key in [k for k, e in self._entries.items() if e[1] == namespace]:
+                del self._entries[key]
+
+def open_sqlite(path, local):
+    """
+    Return this thread's autocommit connection to a WAL-mode SQLite file
+    sqlite3 connections are per thread and must not cross fork(), so
+    they are kept in the given threading.local and reopened per process
+    """
+    if getattr(local, 'pid', None) != os.getpid():
+        local.conn = sqlite3.connect(path, timeout=5, isolation_level=None)
+        local.conn.execute("PRAGMA journal_mode=WAL")
+        local.conn.execute("PRAGMA synchronous=NORMAL")
+        local.pid = os.getpid()
+    return local.conn
+
+class SQLiteCache:
+    """
+    TTL + LRU cache stored in a local SQLite file
+    Shared by every gunicorn worker on the host, so an invalidation in one
+    worker is seen by all of them
+    """
+
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                namespace TEXT,
+                value BLOB,
+                expires REAL,
+                last_access REAL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS generations (
+                namespace TEXT PRIMARY KEY,
+                generation INTEGER
+            )
+        """)
+
+    def _conn(self):
+        return open_sqlite(self.path, self._local)
+
+    def generation(self, namespace):
+        row = self._conn().execute(
+            "SELECT generation FROM generations WHERE namespace = ?", (namespace,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def get(self, key):
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute(
+            "SELECT value FROM cache WHERE key = ? AND expires >= ?", (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE cache SET last_access = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, namespace, value):
+        conn = self._conn()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+            (key, namespace, json.dumps(value), now + self.ttl, now)
+        )
+        conn.execute("""
+            DELETE FROM cache WHERE expires < ? OR key IN (
+                SELECT key FROM cache ORDER BY last_access DESC LIMIT -1 OFFSET ?
+            )
+        """, (now, self.max_entries))
+
+    def invalidate(self, namespace):
+        conn = self._conn()
+        conn.execute("""
+            INSERT INTO generations VALUES (?, 1)
+            ON CONFLICT (namespace) DO UPDATE SET generation = generation + 1
+        """, (namespace,))
+        conn.execute("DELETE FROM cache WHERE namespace = ?", (namespace,))
+
+def create_response_cache():
+    if RESPONSE_CACHE == 'memory':
+        return MemoryCache(RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES)
+    if RESPONSE_CACHE == 'sqlite':
+        return SQLiteCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES)
+    return None
+
+response_cache = create_response_cache()
+
+def invalidate_cache(*namespaces):
+    """Drop cached responses that depend on data that was just written"""
+    if response_cache is None:
+        return
+    for namespace in namespaces:
+        try:
+            response_cache.invalidate(namespace)
+        except Exception as e:
+            print(f"Error invalidating response cache: {e}")
+
+def cached_response(namespace):
+    """
+    Cache successful GET responses by namespace, path and query arguments
+    Responses carry an ETag, so a matching If-None-Match gets a 304
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            entry = None
+            key = None
+            if response_cache is not None:
+                try:
+                    generation = response_cache.generation(namespace)
+                    key = f"{namespace}:{generation}:{request.path}?" + urlencode(
+                        sorted(request.args.items(multi=True))
+                    )
+                    entry = response_cache.get(key)
+                except Exception as e:
+                    print(f"Error reading response cache: {e}")
+
+            if entry is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                body = response.get_data(as_text=True)
+                entry = {
+                    'body': body,
+                    'mimetype': response.mimetype,
+                    'etag': hashlib.sha1(body.encode()).hexdigest()
+                }
+                if key is not None:
+                    try:
+                        response_cache.set(key, namespace, entry)
+                    except Exception as e:
+                        print(f"Error writing response cache: {e}")
+
+            response = Response(entry['body'], mimetype=entry['mimetype'])
+            response.set_etag(entry['etag'])
+            # Let browsers keep the body but revalidate it on every request
+            response.headers['Cache-Control'] = 'no-cache'
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+# Response compression configuration
+# RESPONSE_COMPRESSION: 'on' to compress text responses for clients that
+# accept it, with brotli when the brotli package is installed and gzip
+# otherwise; 'off' when a proxy in front already compresses
+RESPONSE_COMPRESSION = os.getenv('RESPONSE_COMPRESSION', 'on').lower() == 'on'
+# Smaller bodies are sent as they are: compressing them saves less than
+# it costs. Streamed bodies are flushed every COMPRESS_MIN_BYTES of input
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+COMPRESS_GZIP_LEVEL = int(os.getenv('COMPRESS_GZIP_LEVEL', 6))
+COMPRESS_BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', 4))
+# Server-sent events are left alone so every event reaches the client at once
+COMPRESSIBLE_MIMETYPES = (
+    'application/json', 'application/x-ndjson', 'text/csv', 'text/plain', 'text/html'
+)
+COMPRESS_ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+class StreamCompressor:
+    """Incremental gzip or brotli compressor"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(COMPRESS_GZIP_LEVEL, wbits=31)  # gzip container
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self._compressor.process(data)
+        return self._compressor.compress(data)
+
+    def flush(self):
+        """Everything compressed so far, decodable without the rest"""
+        if self.encoding == 'br':
+            return self._compressor.flush()
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+def compress_stream(chunks, encoding):
+    """
+    Compress a streamed body, flushing once COMPRESS_MIN_BYTES of input
+    is pending so slow streams still reach the client as they go
+    """
+    compressor = StreamCompressor(encoding)
+    pending = 0
+    try:
+        for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            pending += len(chunk)
+            if pending >= COMPRESS_MIN_BYTES:
+                compressed += compressor.flush()
+                pending = 0
+            if compressed:
+                yield compressed
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+if RESPONSE_COMPRESSION:
+    @app.after_request
+    def compress_response(response):
+        """Compress JSON and text bodies with the best encoding the client accepts"""
+        if (response.mimetype not in COMPRESSIBLE_MIMETYPES
+                or response.status_code in (204, 206, 304)
+                or 'Content-Encoding' in response.headers
+                or response.direct_passthrough):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(COMPRESS_ENCODINGS)
+        if encoding is None or request.method == 'HEAD':
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.iter_encoded(), encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            body = response.get_data()
+            if len(body) < COMPRESS_MIN_BYTES:
+                return response
+            with timed('compress'):
+                compressor = StreamCompressor(encoding)
+                response.set_data(compressor.compress(body) + compressor.finish())
+
+        response.headers['Content-Encoding'] = encoding
+        # The compressed body is a different representation of the same
+        # resource: a weak ETag still matches If-None-Match for either
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+# Rate limiting and admission control configuration
+# RATE_LIMIT: token buckets per client in 'sqlite' (shared by all workers on
+# the host through a local file), 'memory' (per worker) or 'off'
+RATE_LIMIT = os.getenv('RATE_LIMIT', 'sqlite').lower()
+RATE_LIMIT_RATE = float(os.getenv('RATE_LIMIT_RATE', 10))  # tokens per second
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', 20))
+RATE_LIMIT_RETENTION = float(os.getenv('RATE_LIMIT_RETENTION', 86400))
+RATE_LIMIT_PATH = os.getenv(
+    'RATE_LIMIT_PATH',
+    os.path.join(tempfile.gettempdir(), 'fin-secure-rate-limits.sqlite3')
+)
+# RECOMMEND_MAX_INFLIGHT: concurrent /recommend requests per worker before
+# new ones are shed with a 503 (0 disables)
+RECOMMEND_MAX_INFLIGHT = int(os.getenv('RECOMMEND_MAX_INFLIGHT', 50))
+# TRUSTED_PROXIES: reverse proxies in front of the app whose X-Forwarded-For
+# is trusted to identify the client (Render runs one)
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', 1 if os.getenv('RENDER') else 0))
+
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+class TokenBucket:
+    """Refill arithmetic shared by the rate limiter stores"""
+
+    def __init__(self, rate, burst, retention):
+        self.rate = max(rate, 1e-6)
+        self.burst = max(burst, 1)
+        self.retention = retention
+
+    def refill(self, tokens, updated, now):
+        return min(self.burst, tokens + max(now - updated, 0) * self.rate)
+
+    def retry_after(self, tokens):
+        """Whole seconds until the bucket holds a token again"""
+        return max(1, math.ceil((1 - tokens) / self.rate))
+
+class MemoryRateLimiter(TokenBucket):
+    """Token buckets held by this worker; each worker allows the full rate"""
+
+    def __init__(self, rate, burst, retention):
+        super().__init__(rate, burst, retention)
+        self._buckets = {}  # key -> [tokens, updated, allowed, limited]
+        self._lock = threading.Lock()
+        self._next_purge = time.time() + retention
+
+    def take(self, key):
+        """Take a token for key; returns (allowed, tokens left)"""
+        now = time.time()
+        with self._lock:
+            if now >= self._next_purge:
+                self._next_purge = now + self.retention
+                cutoff = now - self.retention
+                for stale in [k for k, b in self._buckets.items() if b[1] < cutoff]:
+                    del self._buckets[stale]
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now, 0, 0]
+            tokens = self.refill(bucket[0], bucket[1], now)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+                bucket[2] += 1
+            else:
+                bucket[3] += 1
+            bucket[0], bucket[1] = tokens, now
+            return allowed, tokens
+
+    def charge(self, key, count):
+        """Take count more tokens for key, overdrawing it if need be; returns tokens left"""
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now, 0, 0]
+            tokens = self.refill(bucket[0], bucket[1], now) - count
+            bucket[0], bucket[1] = tokens, now
+            return tokens
+
+    def usage(self, limit):
+        now = time.time()
+        with self._lock:
+            rows = [(key, *bucket) for key, bucket in self._buckets.items()]
+        rows.sort(key=lambda row: row[3] + row[4], reverse=True)
+        return [{
+            'key': key,
+            'allowed': allowed,
+            'limited': limited,
+            'tokens': round(self.refill(tokens, updated, now), 2),
+            'last_seen': datetime.fromtimestamp(updated, timezone.utc).isoformat()
+        } for key, tokens, updated, allowed, limited in rows[:limit]]
+
+class SQLiteRateLimiter(TokenBucket):
+    """
+    Token buckets stored in a local SQLite file
+    Shared by every gunicorn worker on the host, so a client gets the
+    configured rate in total rather than once per worker
+    """
+
+    def __init__(self, path, rate, burst, retention):
+        super().__init__(rate, burst, retention)
+        self.path = path
+        self._local = threading.local()
+        self._next_purge = 0
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL,
+                updated REAL,
+                allowed INTEGER DEFAULT 0,
+                limited INTEGER DEFAULT 0
+            )
+        """)
+
+    def _conn(self):
+        return open_sqlite(self.path, self._local)
+
+    def take(self, key):
+        """Take a token for key; returns (allowed, tokens left)"""
+        conn = self._conn()
+        now = time.time()
+        # IMMEDIATE takes the write lock up front, so concurrent workers
+        # cannot both spend the same token
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens = self.refill(*row, now) if row else self.burst
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute("""
+                INSERT INTO buckets (key, tokens, updated, allowed, limited)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    tokens = excluded.tokens,
+                    updated = excluded.updated,
+                    allowed = allowed + excluded.allowed,
+                    limited = limited + excluded.limited
+            """, (key, tokens, now, int(allowed), int(not allowed)))
+            if now >= self._next_purge:
+                self._next_purge = now + min(self.retention, 3600)
+                conn.execute("DELETE FROM buckets WHERE updated < ?", (now - self.retention,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, tokens
+
+    def charge(self, key, count):
+        """Take count more tokens for key, overdrawing it if need be; returns tokens left"""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens = (self.refill(*row, now) if row else self.burst) - count
+            conn.execute("""
+                INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    tokens = excluded.tokens,
+                    updated = excluded.updated
+            """, (key, tokens, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return tokens
+
+    def usage(self, limit):
+        now = time.time()
+        rows = self._conn().execute("""
+            SELECT key, tokens, updated, allowed, limited FROM buckets
+            ORDER BY allowed + limited DESC LIMIT ?
+        """, (limit,)).fetchall()
+        return [{
+            'key': key,
+            'allowed': allowed,
+            'limited': limited,
+            'tokens': round(self.refill(tokens, updated, now), 2),
+            'last_seen': datetime.fromtimestamp(updated, timezone.utc).isoformat()
+        } for key, tokens, updated, allowed, limited in rows]
+
+def create_rate_limiter():
+    if RATE_LIMIT == 'memory':
+        return MemoryRateLimiter(RATE_LIMIT_RATE, RATE_LIMIT_BURST, RATE_LIMIT_RETENTION)
+    if RATE_LIMIT == 'sqlite':
+        return SQLiteRateLimiter(
+            RATE_LIMIT_PATH, RATE_LIMIT_RATE, RATE_LIMIT_BURST, RATE_LIMIT_RETENTION
+        )
+    return None
+
+rate_limiter = create_rate_limiter()
+
+class AdmissionGate:
+    """
+    Non-blocking cap on the requests a worker serves at once
+    Requests over the cap are turned away immediately instead of queueing
+    for the connection pool, so an overloaded worker answers in
+    microseconds rather than after DB_POOL_TIMEOUT
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._active = 0
+        self._lock = threading.Lock()
+        self._counters = {'admitted': 0, 'shed': 0, 'rate_limited': 0}
+
+    def enter(self):
+        with self._lock:
+            if self.limit and self._active >= self.limit:
+                self._counters['shed'] += 1
+                return False
+            self._active += 1
+            self._counters['admitted'] += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self._active -= 1
+
+    def count(self, key):
+        with self._lock:
+            self._counters[key] += 1
+
+    def stats(self):
+        with self._lock:
+            return {'max_in_flight': self.limit, 'in_flight': self._active, **self._counters}
+
+recommend_gate = AdmissionGate(RECOMMEND_MAX_INFLIGHT)
+
+def rate_limit_key():
+    """Identify the client by a hash of its X-API-Key, else by IP address"""
+    api_key = request.headers.get('X-API-Key')
+    if api_key:
+        return 'key:' + hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    return f'ip:{request.remote_addr or "unknown"}'
+
+def overload_response(status, message, retry_after):
+    response = jsonify({'error': message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def admission_control(view):
+    """
+    Shed load and rate limit a view before it reads the body or touches
+    the database: a 503 when this worker is at RECOMMEND_MAX_INFLIGHT,
+    a 429 when the client's token bucket is empty, both with Retry-After.
+    A failing rate limit store lets requests through. A streamed response
+    keeps its slot until the stream is closed, since that is when its
+    work is done.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not recommend_gate.enter():
+            return overload_response(503, 'Server is busy, please retry', 1)
+        streaming = False
+        try:
+            tokens = None
+            if rate_limiter is not None:
+                g.rate_limit_key = rate_limit_key()
+                try:
+                    allowed, tokens = rate_limiter.take(g.rate_limit_key)
+                except Exception as e:
+                    print(f"Error checking rate limit: {e}")
+                    allowed = True
+                if not allowed:
+                    recommend_gate.count('rate_limited')
+                    return overload_response(
+                        429, 'Rate limit exceeded', rate_limiter.retry_after(tokens)
+                    )
+            response = make_response(view(*args, **kwargs))
+            if tokens is not None:
+                response.headers['X-RateLimit-Limit'] = str(int(rate_limiter.burst))
+                response.headers['X-RateLimit-Remaining'] = str(int(tokens))
+            if response.is_streamed:
+                response.call_on_close(recommend_gate.leave)
+                streaming = True
+            return response
+        finally:
+            if not streaming:
+                recommend_gate.leave()
+    return wrapper
+
+def charge_rate_limit(count):
+    """
+    Charge count more requests to the client let in by admission_control,
+    for views that do one request's worth of work per item
+    Returns the Retry-After seconds once the client's bucket is
+    overdrawn, else None. A failing rate limit store charges nothing.
+    """
+    key = g.get('rate_limit_key')
+    if rate_limiter is None or key is None or count <= 0:
+        return None
+    try:
+        tokens = rate_limiter.charge(key, count)
+    except Exception as e:
+        print(f"Error charging rate limit: {e}")
+        return None
+    if tokens >= 0:
+        return None
+    recommend_gate.count('rate_limited')
+    return rate_limiter.retry_after(tokens)
+
+# Schema migrations, applied in order by `flask --app server migrate`.
+# Migrations are never edited once released; add a new one instead.
+
+def migration_base_tables(cursor):
+    # Create recommendations table
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS recommendations (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(255),
+            risk_score INTEGER,
+            portfolio_type VARCHAR(50),
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Create test_results table
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS test_results (
+            id SERIAL PRIMARY KEY,
+            test_name VARCHAR(255),
+            test_type VARCHAR(50),
+            status VARCHAR(50),
+            details TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+def migration_read_indexes(cursor):
+    # Indexes backing keyset pagination, with and without the type filter
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_recommendations_timestamp_id
+        ON recommendations (timestamp DESC, id DESC)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_recommendations_type_timestamp_id
+        ON recommendations (portfolio_type, timestamp DESC, id DESC)
+    """)
+
+    # Index for the recent test results shown on the dashboard
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_test_results_timestamp
+        ON test_results (timestamp DESC)
+    """)
+
+def migration_stats_tables(cursor):
+    # Running aggregates for /metrics, maintained by the write paths
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS recommendation_stats (
+            portfolio_type VARCHAR(50) PRIMARY KEY,
+            count BIGINT NOT NULL DEFAULT 0,
+            risk_score_sum BIGINT NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS test_result_stats (
+            status VARCHAR(50) PRIMARY KEY,
+            count BIGINT NOT NULL DEFAULT 0
+        )
+    """)
+
+def migration_idempotency_keys(cursor):
+    # Stored /recommend responses by Idempotency-Key
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key VARCHAR(255) PRIMARY KEY,
+            request_hash CHAR(64) NOT NULL,
+            response TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at
+        ON idempotency_keys (created_at)
+    """)
+
+def migration_daily_rollups(cursor):
+    # Daily rollups of the base tables, complete for days before
+    # rollup_state.rolled_up_until
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS recommendation_daily (
+            day DATE NOT NULL,
+            portfolio_type VARCHAR(50) NOT NULL,
+            count BIGINT NOT NULL,
+            risk_score_sum BIGINT NOT NULL,
+            PRIMARY KEY (day, portfolio_type)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS test_result_daily (
+            day DATE NOT NULL,
+            test_type VARCHAR(50) NOT NULL,
+            status VARCHAR(50) NOT NULL,
+            count BIGINT NOT NULL,
+            PRIMARY KEY (day, test_type, status)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            source VARCHAR(50) PRIMARY KEY,
+            rolled_up_until DATE NOT NULL
+        )
+    """)
+
+def migration_client_ids(cursor):
+    # Ids the app generates for each row before its first write attempt,
+    # so a spooled write that was in fact committed is not saved twice
+    cursor.execute("ALTER TABLE recommendations ADD COLUMN IF NOT EXISTS client_id UUID")
+    cursor.execute("ALTER TABLE test_results ADD COLUMN IF NOT EXISTS client_id UUID")
+    migration_client_id_indexes(cursor)
+
+def migration_client_id_indexes(cursor):
+    # Unique indexes on a partitioned table must include its partition
+    # key; a replayed row keeps its original timestamp
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_recommendations_client_id
+        ON recommendations (client_id, timestamp)
+    """)
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_test_results_client_id
+        ON test_results (client_id, timestamp)
+    """)
+
+def migration_stats_slots(cursor):
+    # Spread each portfolio type's counters over several rows; readers sum them
+    cursor.execute(
+        "ALTER TABLE recommendation_stats ADD COLUMN IF NOT EXISTS slot SMALLINT NOT NULL DEFAULT 0"
+    )
+    cursor.execute("ALTER TABLE recommendation_stats DROP CONSTRAINT recommendation_stats_pkey")
+    cursor.execute("ALTER TABLE recommendation_stats ADD PRIMARY KEY (portfolio_type, slot)")
+
+# (version, description, function applying it to a cursor)
+MIGRATIONS = [
+    (1, 'recommendations and test_results tables', migration_base_tables),
+    (2, 'keyset pagination and dashboard indexes', migration_read_indexes),
+    (3, 'metrics aggregate tables', migration_stats_tables),
+    (4, 'idempotency keys', migration_idempotency_keys),
+    (5, 'daily rollups', migration_daily_rollups),
+    (6, 'client-generated row ids', migration_client_ids),
+    (7, 'recommendation stats slots', migration_stats_slots),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+# Arbitrary application-wide advisory lock id serializing migration runs
+SCHEMA_MIGRATION_LOCK_ID = 7264003
+
+def migrate(partition=None):
+    """
+    Apply pending schema migrations, each in its own transaction, then
+    seed the metrics aggregates and run table maintenance once.
+    With partition (default: TABLE_PARTITIONING is 'monthly'), plain
+    base tables are then converted to monthly partitions.
+    Returns the versions applied.
+    """
+    if partition is None:
+        partition = TABLE_PARTITIONING == 'monthly'
+
+    if STORAGE_BACKEND != 'postgres':
+        # The embedded backends create their tables when first opened
+        get_storage()
+        print(f"Nothing to migrate for the {STORAGE_BACKEND} storage backend")
+        return []
+
+    # Use a dedicated connection rather than the pool: this runs once per
+    # deploy, outside the workers
+    conn = psycopg2.connect(DATABASE_URL, connect_timeout=DB_CONNECT_TIMEOUT)
+    cursor = conn.cursor()
+    applied = []
+    try:
+        cursor.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_MIGRATION_LOCK_ID,))
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.commit()
+
+        cursor.execute("SELECT version FROM schema_migrations")
+        done = {row[0] for row in cursor.fetchall()}
+        for version, description, apply in MIGRATIONS:
+            if version in done:
+                continue
+            apply(cursor)
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                (version, description)
+            )
+            conn.commit()
+            applied.append(version)
+            print(f"Applied migration {version}: {description}")
+
+        if partition:
+            partition_tables(conn)
+
+        # Seed the aggregates from existing rows the first time they are used
+        cursor.execute("""
+            SELECT NOT EXISTS (SELECT 1 FROM recommendation_stats)
+               AND NOT EXISTS (SELECT 1 FROM test_result_stats)
+        """)
+        if cursor.fetchone()[0]:
+            reconcile_metrics(conn)
+        maintain_tables(conn)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        # Closing the session releases the advisory lock
+        conn.close()
+
+    print(f"Database schema is at version {SCHEMA_VERSION}")
+    return applied
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending database schema migrations"""
+    migrate()
+
+@app.cli.command('partition-tables')
+def partition_tables_command():
+    """Migrate, then convert recommendations and test_results to monthly partitions"""
+    migrate(partition=True)
+
+def get_schema_version(conn):
+    """Latest migration applied to the database, or 0 before the first"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+        if not cursor.fetchone()[0]:
+            return 0
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+        conn.rollback()
+
+# RECOMMENDATION_STATS_SLOTS: rows each portfolio type's counters are spread
+# over in recommendation_stats. Each write adds to one slot picked at random,
+# so concurrent writers rarely wait on the same row lock; readers sum them.
+RECOMMENDATION_STATS_SLOTS = max(int(os.getenv('RECOMMENDATION_STATS_SLOTS', 16)), 1)
+# Seconds between full recomputations of the /metrics aggregates (0 disables)
+METRICS_RECONCILE_INTERVAL = float(os.getenv('METRICS_RECONCILE_INTERVAL', 3600))
+# Arbitrary application-wide advisory lock id for reconciliation
+METRICS_RECONCILE_LOCK_ID = 7264001
+
+def reconcile_metrics(conn):
+    """
+    Recompute recommendation_stats and test_result_stats from the base
+    tables, correcting any drift. Writes to the base tables are blocked
+    for the duration so the result is exact. Returns False when another
+    worker is already reconciling.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (METRICS_RECONCILE_LOCK_ID,))
+        if not cursor.fetchone()[0]:
+            conn.rollback()
+            return False
+
+        cursor.execute("SET LOCAL lock_timeout = '5s'")
+        cursor.execute("LOCK TABLE recommendations, test_results IN SHARE MODE")
+
+        # Days already rolled up are read from the daily rollups, which
+        # also keep them counted after retention drops their partitions
+        # One row per portfolio type, in slot 0
+        cursor.execute("DELETE FROM recommendation_stats")
+        cursor.execute("""
+            WITH watermark AS (
+                SELECT COALESCE(MAX(rolled_up_until), '-infinity') AS until
+                FROM rollup_state WHERE source = 'recommendations'
+            )
+            INSERT INTO recommendation_stats (portfolio_type, count, risk_score_sum)
+            SELECT portfolio_type, SUM(count), SUM(risk_score_sum)
+            FROM (
+                SELECT portfolio_type, count, risk_score_sum
+                FROM recommendation_daily, watermark
+                WHERE day < watermark.until
+                UNION ALL
+                SELECT portfolio_type, COUNT(*), COALESCE(SUM(risk_score), 0)
+                FROM recommendations, watermark
+                WHERE portfolio_type IS NOT NULL
+                  AND (timestamp >= watermark.until OR timestamp IS NULL)
+                GROUP BY portfolio_type
+            ) totals
+            GROUP BY portfolio_type
+        """)
+
+        cursor.execute("DELETE FROM test_result_stats")
+        cursor.execute("""
+            WITH watermark AS (
+                SELECT COALESCE(MAX(rolled_up_until), '-infinity') AS until
+                FROM rollup_state WHERE source = 'test_results'
+            )
+            INSERT INTO test_result_stats (status, count)
+            SELECT status, SUM(count)
+            FROM (
+                SELECT status, count
+                FROM test_result_daily, watermark
+                WHERE day < watermark.until
+                UNION ALL
+                SELECT status, COUNT(*)
+                FROM test_results, watermark
+                WHERE status IS NOT NULL
+                  AND (timestamp >= watermark.until OR timestamp IS NULL)
+                GROUP BY status
+            ) totals
+            GROUP BY status
+        """)
+
+        conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+_reconciler_pid = None
+_reconciler_lock = threading.Lock()
+
+def _reconcile_metrics_loop():
+    while True:
+        time.sleep(METRICS_RECONCILE_INTERVAL)
+        conn = get_db_connection()
+        if not conn:
+            continue
+        try:
+            if reconcile_metrics(conn):
+                invalidate_cache('metrics')
+        except Exception as e:
+            print(f"Error reconciling metrics: {e}")
+        finally:
+            release_db_connection(conn)
+
+def ensure_metrics_reconciler():
+    """Start the periodic reconciliation thread for this process"""
+    global _reconciler_pid
+    if (METRICS_RECONCILE_INTERVAL <= 0 or STORAGE_BACKEND != 'postgres'
+            or _reconciler_pid == os.getpid()):
+        return
+
+    with _reconciler_lock:
+        if _reconciler_pid == os.getpid():
+            return
+        _reconciler_pid = os.getpid()
+        threading.Thread(
+            target=_reconcile_metrics_loop, name='metrics-reconciler', daemon=True
+        ).start()
+
+# Table partitioning, rollup and retention configuration
+# TABLE_PARTITIONING: 'monthly' makes `migrate` convert plain
+# recommendations and test_results tables, new or existing, into tables
+# range-partitioned by month on timestamp (`flask partition-tables` does
+# the same on demand). Tables already partitioned are left as they are,
+# and 'off' (default) never converts. Maintenance looks at the tables
+# themselves, not at this setting.
+TABLE_PARTITIONING = os.getenv('TABLE_PARTITIONING', 'off').lower()
+PARTITIONS_AHEAD = int(os.getenv('PARTITIONS_AHEAD', 3))
+# Months of raw rows kept; older partitions are dropped once rolled up (0 keeps all)
+RETENTION_MONTHS = int(os.getenv('RETENTION_MONTHS', 0))
+# Seconds after midnight UTC before a day is rolled up, for late writes
+ROLLUP_DELAY = float(os.getenv('ROLLUP_DELAY', 300))
+TABLE_MAINTENANCE_INTERVAL = float(os.getenv('TABLE_MAINTENANCE_INTERVAL', 3600))
+TABLE_MAINTENANCE_LOCK_ID = 7264002
+PARTITIONED_TABLES = ('recommendations', 'test_results')
+
+ROLLUP_SQL = {
+    'recommendations': """
+        INSERT INTO recommendation_daily (day, portfolio_type, count, risk_score_sum)
+        SELECT timestamp::date, portfolio_type, COUNT(*), COALESCE(SUM(risk_score), 0)
+        FROM recommendations
+        WHERE timestamp >= %(start)s AND timestamp < %(end)s
+          AND portfolio_type IS NOT NULL
+        GROUP BY 1, 2
+        ON CONFLICT (day, portfolio_type) DO UPDATE
+        SET count = EXCLUDED.count, risk_score_sum = EXCLUDED.risk_score_sum
+    """,
+    'test_results': """
+        INSERT INTO test_result_daily (day, test_type, status, count)
+        SELECT timestamp::date, COALESCE(test_type, ''), status, COUNT(*)
+        FROM test_results
+        WHERE timestamp >= %(start)s AND timestamp < %(end)s
+          AND status IS NOT NULL
+        GROUP BY 1, 2, 3
+        ON CONFLICT (day, test_type, status) DO UPDATE
+        SET count = EXCLUDED.count
+    """
+}
+
+# Adds rows written late, after their day was rolled up, to the rollup.
+# Recomputing the day instead would lose the rows of a dropped partition.
+ROLLUP_ADD_SQL = {
+    'recommendations': """
+        INSERT INTO recommendation_daily (day, portfolio_type, count, risk_score_sum)
+        VALUES %s
+        ON CONFLICT (day, portfolio_type) DO UPDATE
+        SET count = recommendation_daily.count + EXCLUDED.count,
+            risk_score_sum = recommendation_daily.risk_score_sum + EXCLUDED.risk_score_sum
+    """,
+    'test_results': """
+        INSERT INTO test_result_daily (day, test_type, status, count)
+        VALUES %s
+        ON CONFLICT (day, test_type, status) DO UPDATE
+        SET count = test_result_daily.count + EXCLUDED.count
+    """
+}
+
+def daily_delta(source, rows, until):
+    """Rollup rows for the inserted `source` rows dated before `until`"""
+    delta = {}
+    if source == 'recommendations':
+        for _, risk_score, portfolio_type, timestamp in rows:
+            if portfolio_type is not None and timestamp.date() < until:
+                entry = delta.setdefault((timestamp.date(), portfolio_type), [0, 0])
+                entry[0] += 1
+                entry[1] += risk_score or 0
+    else:
+        for _, test_type, status, _, timestamp in rows:
+            if status is not None and timestamp.date() < until:
+                entry = delta.setdefault((timestamp.date(), test_type or '', status), [0])
+                entry[0] += 1
+    return [(*key, *entry) for key, entry in sorted(delta.items())]
+
+def lock_rollup_watermark(cursor, source):
+    """
+    Lock and return rollup_state.rolled_up_until for `source` (None before
+    the first rollup) until the caller commits, so rollups and late rows
+    counted by add_to_rollup cannot miss or double count each other
+    """
+    cursor.execute(
+        "SELECT rolled_up_until FROM rollup_state WHERE source = %s FOR UPDATE", (source,)
+    )
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def add_to_rollup(cursor, source, rows, until):
+    """Count inserted `source` rows of days before `until` in its daily rollup"""
+    if until is None:
+        return
+    values = daily_delta(source, rows, until)
+    if values:
+        execute_values(cursor, ROLLUP_ADD_SQL[source], values)
+
+def add_months(day, months):
+    """First day of the month `months` after the month of `day`"""
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def partition_name(table, month):
+    return f"{table}_p{month:%Y_%m}"
+
+def partition_table(cursor, table, today):
+    """
+    Replace plain `table` with one range-partitioned by month on
+    timestamp, holding the same rows, ids and id sequence
+    Partitions cover every month from the oldest row to PARTITIONS_AHEAD
+    months ahead, plus a default partition. The table is locked for the
+    whole copy, so writes to it wait until the caller commits.
+    """
+    staging = f"{table}_partitioned"
+    cursor.execute(sql.SQL("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE").format(sql.Identifier(table)))
+    cursor.execute(sql.SQL("""
+        CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS, PRIMARY KEY (id, timestamp))
+        PARTITION BY RANGE (timestamp)
+    """).format(sql.Identifier(staging), sql.Identifier(table)))
+    cursor.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} DEFAULT").format(
+        sql.Identifier(f"{table}_default"), sql.Identifier(staging)
+    ))
+
+    cursor.execute(sql.SQL("SELECT MIN(timestamp)::date FROM {}").format(sql.Identifier(table)))
+    month = add_months(cursor.fetchone()[0] or today, 0)
+    while month <= add_months(today, PARTITIONS_AHEAD):
+        cursor.execute(sql.SQL(
+            "CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)"
+        ).format(sql.Identifier(partition_name(table, month)), sql.Identifier(staging)),
+            (month, add_months(month, 1)))
+        month = add_months(month, 1)
+
+    cursor.execute(sql.SQL("INSERT INTO {} SELECT * FROM {}").format(
+        sql.Identifier(staging), sql.Identifier(table)
+    ))
+    # Hand the id sequence over before the old table (its owner) is dropped
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", (table,))
+    sequence = cursor.fetchone()[0]
+    cursor.execute(sql.SQL("ALTER SEQUENCE {} OWNED BY {}.id").format(
+        sql.SQL(sequence), sql.Identifier(staging)
+    ))
+    cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(table)))
+    cursor.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+        sql.Identifier(staging), sql.Identifier(table)
+    ))
+    cursor.execute(sql.SQL("ALTER TABLE {} RENAME CONSTRAINT {} TO {}").format(
+        sql.Identifier(table), sql.Identifier(f"{staging}_pkey"), sql.Identifier(f"{table}_pkey")
+    ))
+
+def partition_tables(conn):
+    """
+    Convert whichever of PARTITIONED_TABLES are still plain into monthly
+    partitions, in one transaction. Returns the tables converted.
+    """
+    cursor = conn.cursor()
+    try:
+        today = utc_now().date()
+        converted = [
+            table for table in PARTITIONED_TABLES
+            if table not in partitioned_tables(cursor)
+        ]
+        for table in converted:
+            partition_table(cursor, table, today)
+        if converted:
+            # The indexes went with the old tables
+            migration_read_indexes(cursor)
+            migration_client_id_indexes(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    for table in converted:
+        print(f"Partitioned {table} by month")
+    return converted
+
+def partitioned_tables(cursor):
+    cursor.execute("""
+        SELECT c.relname
+        FROM pg_partitioned_table p
+        JOIN pg_class c ON c.oid = p.partrelid
+        WHERE c.relname = ANY(%s) AND pg_table_is_visible(c.oid)
+    """, (list(PARTITIONED_TABLES),))
+    return {row[0] for row in cursor.fetchall()}
+
+def monthly_partitions(cursor, table):
+    """Map the first day of each month to the name of its partition"""
+    cursor.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class parent ON parent.oid = i.inhparent
+        WHERE parent.relname = %s AND pg_table_is_visible(parent.oid)
+    """, (table,))
+    partitions = {}
+    prefix = f"{table}_p"
+    for (name,) in cursor.fetchall():
+        if name.startswith(prefix):
+            try:
+                month = datetime.strptime(name[len(prefix):], '%Y_%m').date()
+            except ValueError:
+                continue
+            partitions[month] = name
+    return partitions
+
+def create_monthly_partitions(cursor, table, today):
+    """Create the partitions for this month and the next PARTITIONS_AHEAD"""
+    existing = monthly_partitions(cursor, table)
+    for offset in range(PARTITIONS_AHEAD + 1):
+        month = add_months(today, offset)
+        if month in existing:
+            continue
+        cursor.execute("SAVEPOINT create_partition")
+        try:
+            cursor.execute(sql.SQL(
+                "CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)"
+            ).format(sql.Identifier(partition_name(table, month)), sql.Identifier(table)),
+                (month, add_months(month, 1)))
+            cursor.execute("RELEASE SAVEPOINT create_partition")
+        except psycopg2.Error as e:
+            # e.g. rows for that month already landed in the default partition
+            cursor.execute("ROLLBACK TO SAVEPOINT create_partition")
+            print(f"Error creating partition {partition_name(table, month)}: {e}")
+
+def roll_up(cursor, source, until):
+    """
+    Aggregate the complete days of `source` before `until` into its daily
+    rollup and advance rollup_state. Returns the new watermark.
+    """
+    start = lock_rollup_watermark(cursor, source)
+    if start is None:
+        cursor.execute(sql.SQL("SELECT MIN(timestamp)::date FROM {}").format(sql.Identifier(source)))
+        start = cursor.fetchone()[0] or until
+    if start >= until:
+        return start
+
+    cursor.execute(ROLLUP_SQL[source], {'start': start, 'end': until})
+    cursor.execute("""
+        INSERT INTO rollup_state (source, rolled_up_until) VALUES (%s, %s)
+        ON CONFLICT (source) DO UPDATE SET rolled_up_until = EXCLUDED.rolled_up_until
+    """, (source, until))
+    return until
+
+def drop_expired_partitions(cursor, table, today, rolled_up_until):
+    """Drop monthly partitions older than RETENTION_MONTHS that are rolled up"""
+    cutoff = min(add_months(today, -RETENTION_MONTHS), rolled_up_until)
+    for month, name in sorted(monthly_partitions(cursor, table).items()):
+        if add_months(month, 1) <= cutoff:
+            cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+            print(f"Dropped expired partition {name}")
+
+def maintain_tables(conn):
+    """
+    Roll up complete days, create upcoming monthly partitions and apply
+    the retention policy. Returns False when another worker is already
+    doing it.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (TABLE_MAINTENANCE_LOCK_ID,))
+        if not cursor.fetchone()[0]:
+            conn.rollback()
+            return False
+        cursor.execute("SET LOCAL lock_timeout = '5s'")
+
+        today = utc_now().date()
+        rollup_until = (utc_now() - timedelta(seconds=ROLLUP_DELAY)).date()
+        partitioned = partitioned_tables(cursor)
+        for table in PARTITIONED_TABLES:
+            rolled_up_until = roll_up(cursor, table, rollup_until)
+            if table in partitioned:
+                create_monthly_partitions(cursor, table, today)
+                if RETENTION_MONTHS > 0:
+                    drop_expired_partitions(cursor, table, today, rolled_up_until)
+
+        conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+_maintenance_pid = None
+_maintenance_lock = threading.Lock()
+
+def _table_maintenance_loop():
+    while True:
+        conn = get_db_connection()
+        if conn:
+            try:
+                # Nothing to maintain until `migrate` has created the tables
+                if get_schema_version(conn) >= SCHEMA_VERSION:
+                    maintain_tables(conn)
+            except Exception as e:
+                print(f"Error maintaining tables: {e}")
+            finally:
+                release_db_connection(conn)
+        time.sleep(TABLE_MAINTENANCE_INTERVAL)
+
+@app.before_request
+def ensure_table_maintenance():
+    """Start the periodic table maintenance thread for this process"""
+    global _maintenance_pid
+    if (TABLE_MAINTENANCE_INTERVAL <= 0 or STORAGE_BACKEND != 'postgres'
+            or _maintenance_pid == os.getpid()):
+        return
+
+    with _maintenance_lock:
+        if _maintenance_pid == os.getpid():
+            return
+        _maintenance_pid = os.getpid()
+        threading.Thread(
+            target=_table_maintenance_loop, name='table-maintenance', daemon=True
+        ).start()
+
+def parse_xml_vulnerable(xml_string):
+    """
+    INTENTIONALLY VULNERABLE XML PARSER
+    This demonstrates XML injection vulnerability for testing purposes
+    In production, NEVER use this approach!
+    """
+    try:
+        # Parse XML without safety restrictions (VULNERABLE!)
+        root = ET.fromstring(xml_string)
+
+        risk_score = int(root.find('risk_score').text)
+        name = root.find('name').text
+
+        return {'risk_score': risk_score, 'name': name}
+    except Exception as e:
+        raise ValueError(f"XML parsing error: {str(e)}")
+
+# XML ingestion configuration
+# XML_PARSER: 'vulnerable' keeps the demo parser above, 'safe' uses the
+# bounded streaming parser below
+XML_PARSER = os.getenv('XML_PARSER', 'vulnerable').lower()
+XML_MAX_BODY_BYTES = int(os.getenv('XML_MAX_BODY_BYTES', 64 * 1024))
+XML_MAX_DEPTH = int(os.getenv('XML_MAX_DEPTH', 16))
+_XML_READ_SIZE = 4096
+_XML_FIELDS = ('risk_score', 'name')
+
+class _XMLFieldsFound(Exception):
+    """Raised from the expat handlers once every field has been read"""
+
+def parse_xml_safe(stream):
+    """
+    Hardened streaming XML parser for production use
+    Feeds the body to expat in small chunks, rejects DTDs and entity
+    declarations, enforces XML_MAX_BODY_BYTES and XML_MAX_DEPTH and stops
+    reading as soon as <risk_score> and <name> under the root are complete
+    """
+    parser = xml.parsers.expat.ParserCreate()
+    parser.SetParamEntityParsing(xml.parsers.expat.XML_PARAM_ENTITY_PARSING_NEVER)
+
+    fields = {}
+    text = []
+    state = {'depth': 0, 'field': None, 'capturing': False}
+
+    def reject(message):
+        def handler(*args):
+            raise ValueError(message)
+        return handler
+
+    def start_element(tag, attrs):
+        state['depth'] += 1
+        if state['depth'] > XML_MAX_DEPTH:
+            raise ValueError(f"document nesting exceeds {XML_MAX_DEPTH} levels")
+        # Like Element.text, only text before the first child counts
+        state['capturing'] = False
+        if state['depth'] == 2 and tag in _XML_FIELDS and tag not in fields:
+            state['field'] = tag
+            state['capturing'] = True
+            text.clear()
+
+    def end_element(tag):
+        if state['depth'] == 2 and state['field'] == tag:
+            fields[tag] = ''.join(text) or None
+            state['field'] = None
+            state['capturing'] = False
+            if len(fields) == len(_XML_FIELDS):
+                raise _XMLFieldsFound()
+        state['depth'] -= 1
+
+    def character_data(data):
+        if state['capturing']:
+            text.append(data)
+
+    parser.StartDoctypeDeclHandler = reject('DTDs are not allowed')
+    parser.EntityDeclHandler = reject('entity declarations are not allowed')
+    parser.UnparsedEntityDeclHandler = reject('entity declarations are not allowed')
+    parser.ExternalEntityRefHandler = reject('external entities are not allowed')
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+
+    try:
+        received = 0
+        while True:
+            chunk = stream.read(_XML_READ_SIZE)
+            received += len(chunk)
+            if received > XML_MAX_BODY_BYTES:
+                raise ValueError(f"body exceeds {XML_MAX_BODY_BYTES} bytes")
+            parser.Parse(chunk, not chunk)
+            if not chunk:
+                break
+    except _XMLFieldsFound:
+        pass
+    except Exception as e:
+        raise ValueError(f"XML parsing error: {str(e)}")
+
+    if 'risk_score' not in fields:
+        raise ValueError("XML parsing error: risk_score element is required")
+    if 'name' not in fields:
+        raise ValueError("XML parsing error: name element is required")
+
+    try:
+        risk_score = int(fields['risk_score'])
+    except (TypeError, ValueError):
+        raise ValueError("XML parsing error: risk_score must be an integer")
+
+    return {'risk_score': risk_score, 'name': fields['name']}
+
+# Portfolio rule configuration
+PORTFOLIO_RULES_PATH = os.getenv(
+    'PORTFOLIO_RULES_PATH',
+    os.path.join(BASE_DIR, 'portfolio_rules.json')
+)
+PORTFOLIO_RULES_CHECK_INTERVAL = float(os.getenv('PORTFOLIO_RULES_CHECK_INTERVAL', 5))
+MAX_RISK_SCORE = 100
+
+# Used when the rules file is missing: risk score < 50 -> Bonds, else Stocks
+DEFAULT_PORTFOLIO_RULES = {
+    'bands': [
+        {'min': 0, 'max': 49, 'portfolio_type': 'Bonds'},
+        {'min': 50, 'max': 100, 'portfolio_type': 'Stocks'}
+    ]
+}
+
+def compile_portfolio_rules(config):
+    """
+    Compile rule bands into a table indexed by risk score
+    Each band is {min, max, portfolio_type} plus optional per-tier fields
+    such as allocation. Bands must cover 0-100 exactly once.
+    """
+    table = [None] * (MAX_RISK_SCORE + 1)
+    for band in config['bands']:
+        low, high = int(band['min']), int(band['max'])
+        if not 0 <= low <= high <= MAX_RISK_SCORE:
+            raise ValueError(f"Invalid band range {low}-{high}")
+        if not band.get('portfolio_type'):
+            raise ValueError(f"Band {low}-{high} has no portfolio_type")
+        rule = {key: value for key, value in band.items() if key not in ('min', 'max')}
+        for score in range(low, high + 1):
+            if table[score] is not None:
+                raise ValueError(f"Risk score {score} is covered by more than one band")
+            table[score] = rule
+
+    missing = [score for score, rule in enumerate(table) if rule is None]
+    if missing:
+        raise ValueError(f"Risk scores {missing[0]}-{missing[-1]} are not covered by any band")
+    return tuple(table)
+
+class PortfolioRules:
+    """
+    Table-driven portfolio rule engine
+    Rules are compiled into one entry per risk score, so a decision is a
+    single index lookup. The rules file is re-read when its modification
+    time changes (checked at most every check_interval seconds); a file
+    that fails to compile leaves the previous rules in place.
+    """
+
+    def __init__(self, path, check_interval):
+        self.path = path
+        self.check_interval = check_interval
+        self._mtime = None
+        self._next_check = 0
+        self._lock = threading.Lock()
+        self._rules = compile_portfolio_rules(DEFAULT_PORTFOLIO_RULES)
+        self.reload()
+
+    def reload(self):
+        """Load the rules file if it changed since the last load"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+
+        try:
+            with open(self.path) as f:
+                rules = compile_portfolio_rules(json.load(f))
+        except Exception as e:
+            print(f"Error loading portfolio rules from {self.path}: {e}")
+            self._mtime = mtime
+            return False
+
+        self._rules = rules
+        self._mtime = mtime
+        print(f"Loaded portfolio rules from {self.path}")
+        return True
+
+    def _check_reload(self):
+        now = time.monotonic()
+        if now < self._next_check or not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = now + self.check_interval
+            self.reload()
+        finally:
+            self._lock.release()
+
+    def rule(self, risk_score):
+        """Return the rule (portfolio_type and per-tier fields) for one score"""
+        self._check_reload()
+        if not 0 <= risk_score <= MAX_RISK_SCORE:
+            raise ValueError(f"risk_score must be between 0 and {MAX_RISK_SCORE}")
+        return self._rules[risk_score]
+
+    def rules(self, risk_scores):
+        """
+        Vectorized evaluation: map a sequence of validated integer scores
+        to their rules with C-level lookups and no per-item branching.
+        Every score is looked up in the same version of the rules.
+        """
+        self._check_reload()
+        risk_scores = list(risk_scores)
+        if risk_scores and (min(risk_scores) < 0 or max(risk_scores) > MAX_RISK_SCORE):
+            raise ValueError(f"risk_score must be between 0 and {MAX_RISK_SCORE}")
+        return list(map(self._rules.__getitem__, risk_scores))
+
+portfolio_rules = PortfolioRules(PORTFOLIO_RULES_PATH, PORTFOLIO_RULES_CHECK_INTERVAL)
+
+def get_portfolio_recommendation(risk_score):
+    """Business logic for portfolio recommendation"""
+    return portfolio_rules.rule(risk_score)['portfolio_type']
+
+def get_portfolio_recommendations(risk_scores):
+    """Rules (portfolio_type and per-tier fields) for many validated risk scores at once"""
+    return portfolio_rules.rules(risk_scores)
+
+# Live event configuration
+# LIVE_EVENTS: publish every write with NOTIFY, committed with it, and
+# stream the events to dashboards on GET /events
+LIVE_EVENTS = os.getenv('LIVE_EVENTS', 'true').lower() == 'true'
+LIVE_EVENTS_CHANNEL = 'finsecure_events'
+LIVE_EVENTS_MAX_ROWS = int(os.getenv('LIVE_EVENTS_MAX_ROWS', 10))
+# Each open stream holds a gthread worker thread (a greenlet under gevent)
+LIVE_EVENTS_MAX_SUBSCRIBERS = int(os.getenv('LIVE_EVENTS_MAX_SUBSCRIBERS', 4))
+LIVE_EVENTS_QUEUE_SIZE = int(os.getenv('LIVE_EVENTS_QUEUE_SIZE', 256))
+LIVE_EVENTS_HEARTBEAT = float(os.getenv('LIVE_EVENTS_HEARTBEAT', 15))
+LIVE_EVENTS_MAX_DURATION = float(os.getenv('LIVE_EVENTS_MAX_DURATION', 300))
+# Writers only NOTIFY while some worker is listening. They look for the
+# listeners' connections in pg_stat_activity at most every
+# LIVE_EVENTS_LISTENER_CHECK seconds, so with no /events stream open a
+# write never takes the cluster-wide NOTIFY commit lock.
+LIVE_EVENTS_LISTENER_CHECK = float(os.getenv('LIVE_EVENTS_LISTENER_CHECK', 1))
+LIVE_EVENTS_APPLICATION_NAME = 'finsecure-live-events'
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+_NOTIFY_MAX_BYTES = 7900
+
+_listeners_checked_at = None
+_listeners_present = False
+
+def live_event_listeners(cursor):
+    """
+    Whether any worker of this deployment is LISTENing for live events
+    Looked up with the caller's cursor at most every
+    LIVE_EVENTS_LISTENER_CHECK seconds; in between the last answer is used.
+    """
+    global _listeners_checked_at, _listeners_present
+    now = time.monotonic()
+    if _listeners_checked_at is None or now - _listeners_checked_at >= LIVE_EVENTS_LISTENER_CHECK:
+        cursor.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM pg_stat_activity
+                WHERE application_name = %s AND datname = current_database()
+            )
+        """, (LIVE_EVENTS_APPLICATION_NAME,))
+        _listeners_present = cursor.fetchone()[0]
+        _listeners_checked_at = now
+    return _listeners_present
+
+def publish_event(cursor, kind, count, rows, delta, totals=None):
+    """
+    Queue a live event in the current transaction
+    Postgres delivers it to every listening worker on commit, in commit
+    order, and drops it on rollback. rows holds at most the last
+    LIVE_EVENTS_MAX_ROWS written; delta is the change to the affected
+    /metrics aggregates and totals, when given, their new values.
+    Nothing is sent while no worker is listening.
+    """
+    if not LIVE_EVENTS or not live_event_listeners(cursor):
+        return
+    event = {'type': kind, 'count': count, 'rows': rows, 'delta': delta, 'totals': totals}
+    payload = app.json.dumps(event)
+    if len(payload.encode()) > _NOTIFY_MAX_BYTES:
+        event['rows'] = []
+        payload = app.json.dumps(event)
+    cursor.execute("SELECT pg_notify(%s, %s)", (LIVE_EVENTS_CHANNEL, payload))
+
+class EventBroadcaster:
+    """
+    Fans live events out to this worker's /events subscribers
+    A thread started with the first subscriber LISTENs on a dedicated
+    connection outside the pool, and closes it once the last subscriber
+    has left. Each subscriber gets a bounded queue; one that falls behind,
+    or may have missed events while the listener (re)connected, is sent a
+    'reset' so it refetches instead.
+    """
+
+    RESET = {'type': 'reset'}
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self):
+        """Return a queue of events, or None when at LIVE_EVENTS_MAX_SUBSCRIBERS"""
+        subscriber = queue.Queue(maxsize=LIVE_EVENTS_QUEUE_SIZE)
+        with self._lock:
+            if len(self._subscribers) >= LIVE_EVENTS_MAX_SUBSCRIBERS:
+                return None
+            self._subscribers.add(subscriber)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._listen, name='live-events-listener', daemon=True
+                )
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # Replace the backlog with a single reset
+                while True:
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        break
+                subscriber.put_nowait(self.RESET)
+
+    def _stopping(self):
+        """Forget the listener thread once nobody is subscribed any more"""
+        with self._lock:
+            if self._subscribers:
+                return False
+            # Under the lock, so a new subscriber starts a fresh thread
+            self._thread = None
+            return True
+
+    def _listen(self):
+        # Return as soon as _stopping() says so: by then a new subscriber
+        # may already have started the next listener thread
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(
+                    DATABASE_URL, connect_timeout=DB_CONNECT_TIMEOUT,
+                    application_name=LIVE_EVENTS_APPLICATION_NAME,
+                )
+                conn.autocommit = True
+                conn.cursor().execute(f"LISTEN {LIVE_EVENTS_CHANNEL}")
+                # Writers notice a new listener only at their next check;
+                # once they all have, events written before are refetched
+                reset_at = time.monotonic() + 2 * LIVE_EVENTS_LISTENER_CHECK
+                idle_since = time.monotonic()
+
+                while True:
+                    if self._stopping():
+                        return
+                    if reset_at is not None and time.monotonic() >= reset_at:
+                        self.publish(self.RESET)
+                        reset_at = None
+                    if not select.select([conn], [], [], 1)[0]:
+                        if time.monotonic() - idle_since >= LIVE_EVENTS_HEARTBEAT:
+                            # Idle: make sure the connection is still alive
+                            conn.cursor().execute("SELECT 1")
+                            idle_since = time.monotonic()
+                        continue
+                    idle_since = time.monotonic()
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            self.publish(json.loads(notify.payload))
+                        except ValueError:
+                            continue
+            except Exception as e:
+                print(f"Live events listener error: {e}")
+                time.sleep(1)
+            finally:
+                if conn is not None:
+                    conn.close()
+            if self._stopping():
+                return
+
+_broadcaster = None
+_broadcaster_lock = threading.Lock()
+
+def get_event_broadcaster():
+    """Return the live event broadcaster for the current process"""
+    global _broadcaster
+    with _broadcaster_lock:
+        # Threads do not survive fork(), so each worker needs its own
+        if _broadcaster is None or _broadcaster.pid != os.getpid():
+            _broadcaster = EventBroadcaster()
+        return _broadcaster
+
+# Write-behind configuration for recommendation inserts
+WRITE_BEHIND = os.getenv('WRITE_BEHIND', 'false').lower() == 'true'
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv('WRITE_BEHIND_QUEUE_SIZE', 10000))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', 500))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', 1.0))
+WRITE_BEHIND_ENQUEUE_TIMEOUT = float(os.getenv('WRITE_BEHIND_ENQUEUE_TIMEOUT', 0.05))
+
+INSERT_RECOMMENDATIONS_SQL = """
+    INSERT INTO recommendations (name, risk_score, portfolio_type, timestamp)
+    VALUES %s
+    RETURNING id
+"""
+
+INSERT_NEW_RECOMMENDATIONS_SQL = """
+    INSERT INTO recommendations (name, risk_score, portfolio_type, timestamp, client_id)
+    VALUES %s
+    ON CONFLICT (client_id, timestamp) DO NOTHING
+    RETURNING id, client_id
+"""
+
+def insert_new_rows(cursor, query, rows, client_ids, page_size=100):
+    """
+    Insert rows tagged with client_ids, skipping those already inserted
+    by an earlier attempt. Returns the ids and the rows inserted now.
+    """
+    returned = execute_values(cursor, query, [
+        (*row, client_id) for row, client_id in zip(rows, client_ids)
+    ], page_size=page_size, fetch=True)
+    inserted = {client_id: row_id for row_id, client_id in returned}
+    kept = [
+        ((inserted[client_id],), row)
+        for row, client_id in zip(rows, client_ids) if client_id in inserted
+    ]
+    return [row_id for row_id, _ in kept], [row for _, row in kept]
+
+def recommendation_delta(rows):
+    """Count and risk score sum per portfolio type of recommendation rows"""
+    delta = {}
+    for _, risk_score, portfolio_type, _ in rows:
+        entry = delta.setdefault(portfolio_type, {'count': 0, 'risk_score_sum': 0})
+        entry['count'] += 1
+        entry['risk_score_sum'] += risk_score
+    return delta
+
+def record_recommendation_stats(cursor, rows):
+    """
+    Add freshly inserted recommendation rows to recommendation_stats
+    Must run in the same transaction as the INSERT. Rows are folded into
+    one upsert per portfolio type, all in one slot picked at random and
+    in a fixed order to avoid deadlocks. Returns the rows' contribution
+    as {portfolio_type: {'count', 'risk_score_sum'}}
+    """
+    delta = recommendation_delta(rows)
+    slot = random.randrange(RECOMMENDATION_STATS_SLOTS)
+    execute_values(cursor, """
+        INSERT INTO recommendation_stats (portfolio_type, slot, count, risk_score_sum)
+        VALUES %s
+        ON CONFLICT (portfolio_type, slot) DO UPDATE SET
+            count = recommendation_stats.count + EXCLUDED.count,
+            risk_score_sum = recommendation_stats.risk_score_sum + EXCLUDED.risk_score_sum
+    """, [
+        (key, slot, entry['count'], entry['risk_score_sum'])
+        for key, entry in sorted(delta.items())
+    ])
+    return delta
+
+def publish_recommendations(cursor, ids, rows, delta):
+    """Publish inserted recommendation rows as a live event"""
+    recent = [
+        {'id': row_id, 'name': name, 'risk_score': risk_score,
+         'portfolio_type': portfolio_type, 'timestamp': timestamp}
+        for (row_id,), (name, risk_score, portfolio_type, timestamp)
+        in zip(ids[-LIVE_EVENTS_MAX_ROWS:], rows[-LIVE_EVENTS_MAX_ROWS:])
+    ]
+    publish_event(cursor, 'recommendations', len(rows), recent, delta)
+
+def write_recommendations(cursor, rows, page_size=WRITE_BEHIND_BATCH_SIZE, client_ids=None):
+    """
+    Insert recommendation rows, count them in recommendation_stats and
+    publish them, all in the caller's transaction. With client_ids, rows
+    already inserted are skipped. Returns the rows inserted.
+    """
+    if client_ids is None:
+        ids = execute_values(cursor, INSERT_RECOMMENDATIONS_SQL, rows,
+                             page_size=page_size, fetch=True)
+    else:
+        ids, rows = insert_new_rows(cursor, INSERT_NEW_RECOMMENDATIONS_SQL, rows,
+                                    client_ids, page_size)
+        if not rows:
+            return rows
+    delta = record_recommendation_stats(cursor, rows)
+    publish_recommendations(cursor, ids, rows, delta)
+    return rows
+
+INSERT_TEST_RESULTS_SQL = """
+    INSERT INTO test_results (test_name, test_type, status, details, timestamp)
+    VALUES %s
+    RETURNING id
+"""
+
+INSERT_NEW_TEST_RESULTS_SQL = """
+    INSERT INTO test_results (test_name, test_type, status, details, timestamp, client_id)
+    VALUES %s
+    ON CONFLICT (client_id, timestamp) DO NOTHING
+    RETURNING id, client_id
+"""
+
+def test_result_delta(rows):
+    """Count per status of (test_name, test_type, status, details, timestamp) rows"""
+    delta = {}
+    for row in rows:
+        delta.setdefault(row[2], {'count': 0})['count'] += 1
+    return delta
+
+def write_test_results(cursor, rows, client_ids=None):
+    """
+    Insert (test_name, test_type, status, details, timestamp) rows, count
+    them in test_result_stats and publish them, in the caller's
+    transaction. With client_ids, rows already inserted are skipped.
+    Returns the rows inserted.
+    """
+    if client_ids is None:
+        ids = execute_values(cursor, INSERT_TEST_RESULTS_SQL, rows, fetch=True)
+    else:
+        ids, rows = insert_new_rows(cursor, INSERT_NEW_TEST_RESULTS_SQL, rows, client_ids)
+        if not rows:
+            return rows
+    delta = test_result_delta(rows)
+    updated = execute_values(cursor, """
+        INSERT INTO test_result_stats (status, count)
+        VALUES %s
+        ON CONFLICT (status) DO UPDATE SET count = test_result_stats.count + EXCLUDED.count
+        RETURNING status, count
+    """, [(status, entry['count']) for status, entry in sorted(delta.items())], fetch=True)
+    totals = {status: {'count': count} for status, count in updated}
+    recent = [
+        {'id': row_id, 'test_name': test_name, 'test_type': test_type,
+         'status': status, 'timestamp': timestamp}
+        for (row_id,), (test_name, test_type, status, _, timestamp)
+        in zip(ids[-LIVE_EVENTS_MAX_ROWS:], rows[-LIVE_EVENTS_MAX_ROWS:])
+    ]
+    publish_event(cursor, 'test_results', len(rows), recent, delta, totals)
+    return rows
+
+def insert_recommendations(rows):
+    """
+    Save (name, risk_score, portfolio_type, timestamp) rows in one
+    transaction. Returns the number of rows written (or spooled).
+    """
+    if not rows:
+        return 0
+    try:
+        return get_storage().insert_recommendations(rows)
+    except Exception as e:
+        print(f"Error saving recommendations: {e}")
+        return 0
+
+class WriteBehindQueue:
+    """
+    Bounded in-process queue of pending recommendation rows
+    A background thread drains it in batches of up to batch_size rows,
+    or whatever has accumulated after flush_interval seconds. When the
+    queue is full, producers wait up to enqueue_timeout seconds before
+    the row is dropped.
+    """
+
+    _STOP = object()
+
+    def __init__(self, maxsize, batch_size, flush_interval, enqueue_timeout):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.pid = os.getpid()
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._counters = {'queued': 0, 'flushed': 0, 'dropped': 0, 'batches': 0}
+        self._thread = threading.Thread(
+            target=self._run, name='recommendation-write-behind', daemon=True
+        )
+        self._thread.start()
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._counters[key] += n
+
+    def put(self, row):
+        """Enqueue a row, applying backpressure when the queue is full"""
+        try:
+            self._queue.put(row, timeout=self.enqueue_timeout)
+        except queue.Full:
+            self._count('dropped')
+            print("Warning: write-behind queue full, recommendation dropped")
+            return False
+        self._count('queued')
+        return True
+
+    def _flush(self, batch):
+        written = insert_recommendations(batch)
+        self._count('flushed', written)
+        self._count('dropped', len(batch) - written)
+        self._count('batches')
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            stopping = item is self._STOP
+            if item is not None and not stopping:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if batch and (stopping or len(batch) >= self.batch_size
+                          or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+                deadline = None
+
+            if stopping:
+                return
+
+    def close(self, timeout=10):
+        """Flush everything still queued and stop the flusher thread"""
+        if self.pid != os.getpid() or not self._thread.is_alive():
+            return
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {'pending': self._queue.qsize(), **self._counters}
+
+_write_behind = None
+_write_behind_lock = threading.Lock()
+
+def get_write_behind():
+    """Return the write-behind queue for the current process"""
+    global _write_behind
+    wb = _write_behind
+    if wb is not None and wb.pid == os.getpid():
+        return wb
+
+    with _write_behind_lock:
+        if _write_behind is None or _write_behind.pid != os.getpid():
+            # Threads do not survive fork(), so a child starts its own flusher
+            _write_behind = WriteBehindQueue(
+                WRITE_BEHIND_QUEUE_SIZE,
+                WRITE_BEHIND_BATCH_SIZE,
+                WRITE_BEHIND_FLUSH_INTERVAL,
+                WRITE_BEHIND_ENQUEUE_TIMEOUT
+            )
+        return _write_behind
+
+def get_write_behind_stats():
+    """Write-behind counters for the current worker"""
+    wb = _write_behind
+    if wb is None or wb.pid != os.getpid():
+        return None
+    return wb.stats()
+
+@atexit.register
+def flush_write_behind():
+    """Drain pending recommendation writes on graceful shutdown"""
+    wb = _write_behind
+    if wb is not None:
+        wb.close()
+
+class StorageUnavailable(Exception):
+    """Raised when the storage backend cannot be reached"""
+
+# SQLSTATEs ending the session: the server is shutting down or restarting
+SESSION_ENDED_SQLSTATES = ('57P01', '57P02', '57P03')
+
+def connection_lost(conn, error):
+    """
+    Whether a psycopg2 error means the connection to Postgres was lost,
+    rather than that the transaction failed on a live connection
+    (deadlock, lock or statement timeout, cancelled query). When the
+    connection was lost during COMMIT, the commit may have gone through.
+    """
+    pgcode = getattr(error, 'pgcode', None)
+    return (
+        conn.closed != 0 or pgcode is None
+        or pgcode.startswith('08') or pgcode in SESSION_ENDED_SQLSTATES
+    )
+
+SPOOL_WRITERS = {'recommendations': write_recommendations, 'test_results': write_test_results}
+SPOOL_INVALIDATES = {'recommendations': ('recommendations', 'metrics'), 'test_results': ('metrics',)}
+
+class WriteSpool:
+    """
+    Writes kept in a local SQLite file while Postgres is unreachable
+    Shared by every worker on the host. replay() moves them to Postgres
+    oldest first, one batch per transaction, and leaves them spooled
+    while the database is still down. Rows keep the client ids they were
+    first written with, so rows that did reach Postgres, or a batch
+    replayed again after a crash before the local delete, are skipped.
+    Replayed rows of days already rolled up are added to the rollups.
+    """
+
+    # Seconds a worker may hold the replay lease before another takes over
+    LEASE_SECONDS = 60
+
+    def __init__(self, path, max_rows, batch_size):
+        self.path = path
+        self.max_rows = max_rows
+        self.batch_size = batch_size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counters = {'spooled': 0, 'replayed': 0, 'dropped': 0}
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS spool (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                row TEXT NOT NULL,
+                client_id TEXT
+            )
+        """)
+        if 'client_id' not in {column[1] for column in conn.execute("PRAGMA table_info(spool)")}:
+            # A spool file from before rows had client ids
+            try:
+                conn.execute("ALTER TABLE spool ADD COLUMN client_id TEXT")
+            except sqlite3.OperationalError:
+                pass  # added by another worker meanwhile
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS replay_lease (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                owner INTEGER,
+                expires REAL
+            )
+        """)
+        conn.execute("INSERT OR IGNORE INTO replay_lease VALUES (1, 0, 0)")
+
+    def _conn(self):
+        return open_sqlite(self.path, self._local)
+
+    def _count(self, key, n):
+        with self._lock:
+            self._counters[key] += n
+
+    def pending(self):
+        # Rows are only ever deleted from the head, so seq has no gaps
+        row = self._conn().execute("SELECT MAX(seq) - MIN(seq) + 1 FROM spool").fetchone()
+        return row[0] or 0
+
+    def add(self, kind, rows, client_ids):
+        """Spool rows of one kind with their client ids; returns False when the spool is full"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self.pending() + len(rows) > self.max_rows:
+                conn.execute("ROLLBACK")
+                self._count('dropped', len(rows))
+                print(f"Warning: write spool full, {len(rows)} {kind} dropped")
+                return False
+            conn.executemany(
+                "INSERT INTO spool (kind, row, client_id) VALUES (?, ?, ?)",
+                [(kind, json.dumps([*row[:-1], row[-1].isoformat()]), client_id)
+                 for row, client_id in zip(rows, client_ids)]
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._count('spooled', len(rows))
+        return True
+
+    def _lease(self, conn, held):
+        now = time.time()
+        pid = os.getpid()
+        if held:
+            cursor = conn.execute("""
+                UPDATE replay_lease SET owner = ?, expires = ?
+                WHERE id = 1 AND (expires < ? OR owner = ?)
+            """, (pid, now + self.LEASE_SECONDS, now, pid))
+            return cursor.rowcount == 1
+        conn.execute("UPDATE replay_lease SET expires = 0 WHERE id = 1 AND owner = ?", (pid,))
+
+    def replay(self):
+        """Move spooled writes to Postgres; returns the number of rows replayed"""
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM spool LIMIT 1").fetchone() is None:
+            return 0
+        if not self._lease(conn, True):
+            return 0  # another worker is replaying
+
+        replayed = 0
+        try:
+            while True:
+                entries = conn.execute(
+                    "SELECT seq, kind, row, client_id FROM spool ORDER BY seq LIMIT ?",
+                    (self.batch_size,)
+                ).fetchall()
+                if not entries:
+                    return replayed
+                pg = get_db_connection()
+                if not pg:
+                    return replayed
+                try:
+                    cursor = pg.cursor()
+                    groups = []
+                    for seq, kind, row, client_id in entries:
+                        values = json.loads(row)
+                        row = (*values[:-1], datetime.fromisoformat(values[-1]))
+                        if client_id is None:
+                            # Spooled before rows had client ids; keep it stable
+                            client_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f'{self.path}#{seq}'))
+                        if groups and groups[-1][0] == kind:
+                            groups[-1][1].append(row)
+                            groups[-1][2].append(client_id)
+                        else:
+                            groups.append((kind, [row], [client_id]))
+                    # Locked in a fixed order, as table maintenance does
+                    watermarks = {
+                        kind: lock_rollup_watermark(cursor, kind)
+                        for kind in sorted({kind for kind, _, _ in groups})
+                    }
+                    for kind, rows, client_ids in groups:
+                        written = SPOOL_WRITERS[kind](cursor, rows, client_ids=client_ids)
+                        add_to_rollup(cursor, kind, written, watermarks[kind])
+                    pg.commit()
+                    cursor.close()
+                finally:
+                    release_db_connection(pg)
+                conn.execute("DELETE FROM spool WHERE seq <= ?", (entries[-1][0],))
+                self._lease(conn, True)
+                replayed += len(entries)
+                self._count('replayed', len(entries))
+                invalidate_cache(*{ns for kind, _, _ in groups for ns in SPOOL_INVALIDATES[kind]})
+        finally:
+            self._lease(conn, False)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        return {'pending': self.pending(), **counters}
+
+class PostgresStorage:
+    """
+    Storage in the Postgres database at DATABASE_URL
+    With a spool, a write that finds the database unreachable is kept
+    locally and replayed later instead of being dropped
+    """
+
+    name = 'postgres'
+
+    def __init__(self, spool=None):
+        self.spool = spool
+
+    def _connect_for_read(self):
+        conn = get_read_connection()
+        if not conn:
+            raise StorageUnavailable('Database connection failed')
+        return conn
+
+    def _write(self, kind, rows):
+        # Generated before the first attempt, so a write that reached
+        # Postgres just before the connection was lost is not saved twice
+        client_ids = [str(uuid.uuid4()) for _ in rows]
+        try:
+            with timed('db_connect'):
+                conn = get_pool().getconn()
+        except PoolTimeout:
+            # Saturated rather than down: spooling would only hide it
+            raise StorageUnavailable('No database connection became free in time')
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            return self._spool(kind, rows, client_ids, e)
+        try:
+            cursor = conn.cursor()
+            SPOOL_WRITERS[kind](cursor, rows, client_ids=client_ids)
+            conn.commit()
+            cursor.close()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            if not connection_lost(conn, e):
+                raise
+            return self._spool(kind, rows, client_ids, e)
+        finally:
+            release_db_connection(conn)
+        invalidate_cache(*SPOOL_INVALIDATES[kind])
+        return len(rows)
+
+    def _spool(self, kind, rows, client_ids, error):
+        if self.spool is None:
+            raise StorageUnavailable(f'Database connection failed: {error}')
+        print(f"Database unavailable, spooling {kind}: {error}")
+        return len(rows) if self.spool.add(kind, rows, client_ids) else 0
+
+    def insert_recommendations(self, rows):
+        return self._write('recommendations', rows)
+
+    def insert_recommendation_once(self, key, request_hash, response, row, expired_before, purge=False):
+        """
+        Claim an Idempotency-Key and insert its recommendation row in one
+        transaction. Returns None when this request claimed the key,
+        otherwise the (request_hash, response) stored with it. Never
+        spooled: the spool would save the row without its key.
+        """
+        conn = get_db_connection()
+        if not conn:
+            raise StorageUnavailable('Database connection failed')
+        try:
+            cursor = conn.cursor()
+            if purge:
+                cursor.execute(
+                    "DELETE FROM idempotency_keys WHERE created_at <= %s", (expired_before,)
+                )
+            # An expired key is free to be claimed again. A concurrent
+            # claim of the same key waits here until the first commits
+            cursor.execute("""
+                INSERT INTO idempotency_keys (key, request_hash, response, created_at)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (key) DO UPDATE
+                SET request_hash = EXCLUDED.request_hash,
+                    response = EXCLUDED.response,
+                    created_at = EXCLUDED.created_at
+                WHERE idempotency_keys.created_at <= %s
+                RETURNING key
+            """, (key, request_hash, response, row[-1], expired_before))
+            if cursor.fetchone() is None:
+                cursor.execute(
+                    "SELECT request_hash, response FROM idempotency_keys WHERE key = %s", (key,)
+                )
+                existing = cursor.fetchone()
+            else:
+                write_recommendations(cursor, [row])
+                existing = None
+            conn.commit()
+            cursor.close()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            raise StorageUnavailable(str(e)) from e
+        finally:
+            release_db_connection(conn)
+        if existing is None:
+            invalidate_cache('recommendations', 'metrics')
+        return existing
+
+    def insert_test_results(self, rows):
+        return self._write('test_results', rows)
+
+    def recommendation_batch(self):
+        return PostgresBatch(get_db_connection())
+
+    def ping(self):
+        """Run a query on a pooled connection and check the schema version"""
+        global _schema_version
+        pool = get_pool()
+        conn = pool.getconn()
+        try:
+            _schema_version = get_schema_version(conn)
+        finally:
+            pool.putconn(conn)
+        if _schema_version < SCHEMA_VERSION:
+            raise StorageUnavailable(
+                f"Database schema is at version {_schema_version}, expected {SCHEMA_VERSION}"
+            )
+
+    def page_recommendations(self, portfolio_type, limit, offset=0, position=None, total_mode='none'):
+        """
+        Return (rows, total): up to limit recommendations newest first,
+        after skipping offset rows or, given a (timestamp, id) position,
+        the rows up to and including it
+        """
+        conn = self._connect_for_read()
+        try:
+            cursor = conn.cursor()
+
+            # Build query with optional filter
+            query = """
+                SELECT id, name, risk_score, portfolio_type, timestamp
+                FROM recommendations
+            """
+            conditions = []
+            params = []
+
+            if portfolio_type:
+                conditions.append("portfolio_type = %s")
+                params.append(portfolio_type)
+
+            if position:
+                conditions.append("(timestamp, id) < (%s, %s)")
+                params.extend(position)
+
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+
+            query += " ORDER BY timestamp DESC, id DESC LIMIT %s OFFSET %s"
+            params.extend([limit, offset])
+
+            cursor.execute(query, params)
+            rows = fetch_records(cursor)
+            total = count_recommendations(cursor, portfolio_type, total_mode)
+            cursor.close()
+            return rows, total
+        finally:
+            release_db_connection(conn)
+
+    def metrics(self):
+        """Return (test counts by status, [(portfolio_type, count, risk_score_sum)], recent tests)"""
+        conn = self._connect_for_read()
+        try:
+            cursor = conn.cursor()
+
+            # Get test statistics
+            cursor.execute("SELECT status, count FROM test_result_stats")
+            test_counts = dict(cursor.fetchall())
+
+            # Get portfolio distribution
+            cursor.execute("""
+                SELECT portfolio_type, SUM(count), SUM(risk_score_sum)
+                FROM recommendation_stats
+                GROUP BY portfolio_type
+                HAVING SUM(count) > 0
+                ORDER BY portfolio_type
+            """)
+            portfolio_stats = cursor.fetchall()
+
+            # Get recent test results
+            cursor.execute("""
+                SELECT test_name, test_type, status, timestamp
+                FROM test_results
+                ORDER BY timestamp DESC
+                LIMIT 10
+            """)
+            recent_tests = fetch_records(cursor)
+
+            cursor.close()
+            return test_counts, portfolio_stats, recent_tests
+        finally:
+            release_db_connection(conn)
+
+    def stats(self):
+        return None if self.spool is None else self.spool.stats()
+
+class PostgresBatch:
+    """
+    Recommendation rows written to Postgres chunk by chunk, each chunk in
+    its own transaction, so neither the rows nor the recommendation_stats
+    locks are held while the rest of the batch is read. Never spooled.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor() if conn else None
+
+    @property
+    def available(self):
+        return self.cursor is not None
+
+    def add(self, rows):
+        """Write and commit one chunk; returns the number of rows saved"""
+        try:
+            write_recommendations(self.cursor, rows, page_size=RECOMMEND_BATCH_CHUNK_SIZE)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        invalidate_cache('recommendations', 'metrics')
+        return len(rows)
+
+    def close(self):
+        if self.conn:
+            if self.cursor is not None:
+                self.cursor.close()
+            release_db_connection(self.conn)
+
+class StorageBatch:
+    """Recommendation rows written chunk by chunk through the storage backend"""
+
+    available = True
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def add(self, rows):
+        return self.storage.insert_recommendations(rows)
+
+    def close(self):
+        pass
+
+def format_sqlite_timestamp(value):
+    # Fixed width, so text order is time order
+    return value.replace(tzinfo=None).isoformat(timespec='microseconds')
+
+class SQLiteStorage:
+    """
+    Storage in a local WAL-mode SQLite file, for single-node deployments
+    Shared by every worker on the host. As with Postgres, the aggregate
+    tables are updated in the same transaction as each insert.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS recommendations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT,
+                risk_score INTEGER,
+                portfolio_type TEXT,
+                timestamp TEXT NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_recommendations_timestamp_id
+            ON recommendations (timestamp, id)
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_recommendations_portfolio_type_timestamp_id
+            ON recommendations (portfolio_type, timestamp, id)
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS test_results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                test_name TEXT,
+                test_type TEXT,
+                status TEXT,
+                details TEXT,
+                timestamp TEXT NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_test_results_timestamp
+            ON test_results (timestamp)
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS recommendation_stats (
+                portfolio_type TEXT PRIMARY KEY,
+                count INTEGER NOT NULL,
+                risk_score_sum INTEGER NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS test_result_stats (
+                status TEXT PRIMARY KEY,
+                count INTEGER NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                request_hash TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            )
+        """)
+
+    def _conn(self):
+        return open_sqlite(self.path, self._local)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _records(cursor):
+        columns = [column[0] for column in cursor.description]
+        records = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        for record in records:
+            record['timestamp'] = datetime.fromisoformat(record['timestamp'])
+        return records
+
+    @staticmethod
+    def _write_recommendations(conn, rows):
+        conn.executemany("""
+            INSERT INTO recommendations (name, risk_score, portfolio_type, timestamp)
+            VALUES (?, ?, ?, ?)
+        """, [(*row[:-1], format_sqlite_timestamp(row[-1])) for row in rows])
+        conn.executemany("""
+            INSERT INTO recommendation_stats VALUES (?, ?, ?)
+            ON CONFLICT (portfolio_type) DO UPDATE SET
+                count = count + excluded.count,
+                risk_score_sum = risk_score_sum + excluded.risk_score_sum
+        """, [
+            (key, entry['count'], entry['risk_score_sum'])
+            for key, entry in recommendation_delta(rows).items()
+        ])
+
+    def insert_recommendations(self, rows):
+        with self._transaction() as conn:
+            self._write_recommendations(conn, rows)
+        invalidate_cache('recommendations', 'metrics')
+        return len(rows)
+
+    def insert_recommendation_once(self, key, request_hash, response, row, expired_before, purge=False):
+        expired_before = format_sqlite_timestamp(expired_before)
+        # BEGIN IMMEDIATE serializes writers, so checking then inserting is safe
+        with self._transaction() as conn:
+            if purge:
+                conn.execute("DELETE FROM idempotency_keys WHERE created_at <= ?", (expired_before,))
+            existing = conn.execute("""
+                SELECT request_hash, response FROM idempotency_keys
+                WHERE key = ? AND created_at > ?
+            """, (key, expired_before)).fetchone()
+            if existing is None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO idempotency_keys VALUES (?, ?, ?, ?)",
+                    (key, request_hash, response, format_sqlite_timestamp(row[-1]))
+                )
+                self._write_recommendations(conn, [row])
+        if existing is None:
+            invalidate_cache('recommendations', 'metrics')
+        return existing
+
+    def insert_test_results(self, rows):
+        with self._transaction() as conn:
+            conn.executemany("""
+                INSERT INTO test_results (test_name, test_type, status, details, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            """, [(*row[:-1], format_sqlite_timestamp(row[-1])) for row in rows])
+            conn.executemany("""
+                INSERT INTO test_result_stats VALUES (?, ?)
+                ON CONFLICT (status) DO UPDATE SET count = count + excluded.count
+            """, [(status, entry['count']) for status, entry in test_result_delta(rows).items()])
+        invalidate_cache('metrics')
+        return len(rows)
+
+    def recommendation_batch(self):
+        return StorageBatch(self)
+
+    def ping(self):
+        self._conn().execute("SELECT 1")
+
+    def page_recommendations(self, portfolio_type, limit, offset=0, position=None, total_mode='none'):
+        conditions = []
+        params = []
+        if portfolio_type:
+            conditions.append("portfolio_type = ?")
+            params.append(portfolio_type)
+        if position:
+            conditions.append("(timestamp, id) < (?, ?)")
+            params.extend([format_sqlite_timestamp(position[0]), position[1]])
+        query = "SELECT id, name, risk_score, portfolio_type, timestamp FROM recommendations"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
+
+        conn = self._conn()
+        rows = self._records(conn.execute(query, params))
+        total = None
+        if total_mode != 'none':
+            # The stats table is exact here, so 'estimate' costs no less
+            total = conn.execute(
+                "SELECT COALESCE(SUM(count), 0) FROM recommendation_stats"
+                + (" WHERE portfolio_type = ?" if portfolio_type else ""),
+                [portfolio_type] if portfolio_type else []
+            ).fetchone()[0]
+        return rows, total
+
+    def metrics(self):
+        conn = self._conn()
+        test_counts = dict(conn.execute("SELECT status, count FROM test_result_stats"))
+        portfolio_stats = conn.execute("""
+            SELECT portfolio_type, count, risk_score_sum
+            FROM recommendation_stats
+            WHERE count > 0
+            ORDER BY portfolio_type
+        """).fetchall()
+        recent_tests = self._records(conn.execute("""
+            SELECT test_name, test_type, status, timestamp
+            FROM test_results
+            ORDER BY timestamp DESC
+            LIMIT 10
+        """))
+        return test_counts, portfolio_stats, recent_tests
+
+    def export_batches(self, portfolio_type, since, until, batch_size):
+        """Yield lists of (id, name, risk_score, portfolio_type, timestamp), oldest first"""
+        conditions = []
+        params = []
+        if portfolio_type:
+            conditions.append("portfolio_type = ?")
+            params.append(portfolio_type)
+        if since:
+            conditions.append("timestamp >= ?")
+            params.append(format_sqlite_timestamp(since))
+        if until:
+            conditions.append("timestamp < ?")
+            params.append(format_sqlite_timestamp(until))
+        query = "SELECT id, name, risk_score, portfolio_type, timestamp FROM recommendations"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY timestamp, id"
+
+        # A separate connection: the read transaction stays open while
+        # the response streams, and must not pin this thread's connection
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        try:
+            cursor = conn.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield [(*row[:-1], datetime.fromisoformat(row[-1])) for row in rows]
+        finally:
+            conn.close()
+
+    def stats(self):
+        return None
+
+class MemoryStorage:
+    """
+    Storage in this worker's memory, for tests and single-process runs
+    Recommendations are kept column by column in (timestamp, id) order,
+    so pages are slices and a portfolio_type filter scans one column
+    """
+
+    name = 'memory'
+    COLUMNS = ('id', 'name', 'risk_score', 'portfolio_type', 'timestamp')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._columns = {column: [] for column in self.COLUMNS}
+        self._keys = []  # (timestamp, id) of each row, ascending
+        self._next_id = 1
+        self._recommendation_stats = {}  # portfolio_type -> [count, risk_score_sum]
+        self._test_results = []
+        self._test_result_stats = {}
+        self._idempotency_keys = {}  # key -> (request_hash, response, created_at)
+
+    def _add_recommendations(self, rows):
+        """Insert rows; the caller holds the lock"""
+        columns = self._columns
+        delta = recommendation_delta(rows)
+        for name, risk_score, portfolio_type, timestamp in rows:
+            row_id = self._next_id
+            self._next_id += 1
+            key = (timestamp.replace(tzinfo=None), row_id)
+            index = bisect.bisect(self._keys, key)
+            self._keys.insert(index, key)
+            for column, value in zip(self.COLUMNS, (row_id, name, risk_score, portfolio_type, key[0])):
+                columns[column].insert(index, value)
+        for key, entry in delta.items():
+            stats = self._recommendation_stats.setdefault(key, [0, 0])
+            stats[0] += entry['count']
+            stats[1] += entry['risk_score_sum']
+
+    def insert_recommendations(self, rows):
+        with self._lock:
+            self._add_recommendations(rows)
+        invalidate_cache('recommendations', 'metrics')
+        return len(rows)
+
+    def insert_recommendation_once(self, key, request_hash, response, row, expired_before, purge=False):
+        # Keys live in this worker, like the rows they answer for
+        with self._lock:
+            if purge:
+                self._idempotency_keys = {
+                    k: entry for k, entry in self._idempotency_keys.items()
+                    if entry[2] > expired_before
+                }
+            existing = self._idempotency_keys.get(key)
+            if existing is not None and existing[2] > expired_before:
+                return existing[:2]
+            self._add_recommendations([row])
+            self._idempotency_keys[key] = (request_hash, response, row[-1])
+        invalidate_cache('recommendations', 'metrics')
+        return None
+
+    def insert_test_results(self, rows):
+        with self._lock:
+            for test_name, test_type, status, details, timestamp in rows:
+                self._test_results.append({
+                    'test_name': test_name,
+                    'test_type': test_type,
+                    'status': status,
+                    'timestamp': timestamp
+                })
+            for status, entry in test_result_delta(rows).items():
+                self._test_result_stats[status] = (
+                    self._test_result_stats.get(status, 0) + entry['count']
+                )
+        invalidate_cache('metrics')
+        return len(rows)
+
+    def recommendation_batch(self):
+        return StorageBatch(self)
+
+    def ping(self):
+        pass
+
+    def _row(self, index):
+        return {column: self._columns[column][index] for column in self.COLUMNS}
+
+    def page_recommendations(self, portfolio_type, limit, offset=0, position=None, total_mode='none'):
+        with self._lock:
+            end = bisect.bisect_left(self._keys, position) if position else len(self._keys)
+            if portfolio_type:
+                types = self._columns['portfolio_type']
+                matches = (i for i in range(end - 1, -1, -1) if types[i] == portfolio_type)
+                indexes = list(itertools.islice(matches, offset, offset + limit))
+            else:
+                indexes = range(end - 1 - offset, max(end - 1 - offset - limit, -1), -1)
+            rows = [self._row(i) for i in indexes]
+
+            total = None
+            if total_mode != 'none':
+                if portfolio_type:
+                    total = self._recommendation_stats.get(portfolio_type, [0])[0]
+                else:
+                    total = len(self._keys)
+        return rows, total
+
+    def metrics(self):
+        with self._lock:
+            portfolio_stats = [
+                (key, count, risk_score_sum)
+                for key, (count, risk_score_sum) in sorted(self._recommendation_stats.items())
+                if count > 0
+            ]
+            recent_tests = sorted(
+                self._test_results[-10:], key=lambda row: row['timestamp'], reverse=True
+            )
+            return dict(self._test_result_stats), portfolio_stats, recent_tests
+
+    def export_batches(self, portfolio_type, since, until, batch_size):
+        with self._lock:
+            start = bisect.bisect_left(self._keys, (since,)) if since else 0
+            end = bisect.bisect_left(self._keys, (until,)) if until else len(self._keys)
+            rows = list(zip(*(self._columns[column][start:end] for column in self.COLUMNS)))
+        if portfolio_type:
+            rows = [row for row in rows if row[3] == portfolio_type]
+        for i in range(0, len(rows), batch_size):
+            yield rows[i:i + batch_size]
+
+    def stats(self):
+        return None
+
+def create_storage():
+    if STORAGE_BACKEND == 'sqlite':
+        return SQLiteStorage(STORAGE_SQLITE_PATH)
+    if STORAGE_BACKEND == 'memory':
+        return MemoryStorage()
+    spool = None
+    if WRITE_SPOOL:
+        spool = WriteSpool(WRITE_SPOOL_PATH, WRITE_SPOOL_MAX_ROWS, WRITE_SPOOL_BATCH_SIZE)
+    return PostgresStorage(spool)
+
+_storage = None
+_storage_lock = threading.Lock()
+
+def get_storage():
+    """Return the configured storage backend, created on first use"""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = create_storage()
+    return _storage
+
+def get_storage_stats():
+    """Write spool statistics, when the backend has a spool"""
+    return None if _storage is None else _storage.stats()
+
+_spool_replay_pid = None
+_spool_replay_lock = threading.Lock()
+
+def _write_spool_loop(spool):
+    while True:
+        time.sleep(WRITE_SPOOL_REPLAY_INTERVAL)
+        try:
+            replayed = spool.replay()
+            if replayed:
+                print(f"Replayed {replayed} spooled writes")
+        except Exception as e:
+            print(f"Error replaying write spool: {e}")
+
+@app.before_request
+def ensure_spool_replay():
+    """Start the thread replaying spooled writes for this process"""
+    global _spool_replay_pid
+    if STORAGE_BACKEND != 'postgres' or not WRITE_SPOOL or _spool_replay_pid == os.getpid():
+        return
+
+    with _spool_replay_lock:
+        if _spool_replay_pid == os.getpid():
+            return
+        _spool_replay_pid = os.getpid()
+        threading.Thread(
+            target=_write_spool_loop, args=(get_storage().spool,),
+            name='write-spool-replay', daemon=True
+        ).start()
+
+# Length of the recommendations.name column
+NAME_MAX_LENGTH = 255
+
+def validate_recommendation(data):
+    """
+    Validate a recommendation request payload
+    Returns (name, risk_score); raises ValueError with a client-facing
+    message when the payload is invalid
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Request body must be a JSON object')
+
+    risk_score = data.get('risk_score')
+    name = data.get('name', 'Anonymous')
+
+    if risk_score is None:
+        raise ValueError('risk_score is required')
+
+    if isinstance(name, (int, float)) and not isinstance(name, bool):
+        name = str(name)
+    elif name is not None and not isinstance(name, str):
+        raise ValueError('name must be a string')
+    if name is not None and len(name) > NAME_MAX_LENGTH:
+        raise ValueError(f'name must be at most {NAME_MAX_LENGTH} characters')
+
+    risk_score = int(risk_score)
+
+    # Validate risk score range
+    if not 0 <= risk_score <= 100:
+        raise ValueError('risk_score must be between 0 and 100')
+
+    return name, risk_score
+
+def apply_rule(name, risk_score, rule):
+    """
+    The recommendation for a validated payload: a dict with name,
+    risk_score, portfolio_type and, when the rule defines one, allocation
+    """
+    recommendation = {
+        'name': name,
+        'risk_score': risk_score,
+        'portfolio_type': rule['portfolio_type']
+    }
+    if 'allocation' in rule:
+        recommendation['allocation'] = rule['allocation']
+    return recommendation
+
+def build_recommendation(data):
+    """
+    Validate a recommendation request payload and apply the portfolio rules
+    Raises ValueError with a client-facing message when it is invalid
+    """
+    name, risk_score = validate_recommendation(data)
+    return apply_rule(name, risk_score, portfolio_rules.rule(risk_score))
+
+def save_recommendation(name, risk_score, portfolio_type, timestamp=None):
+    """Save recommendation to database"""
+    row = (name, risk_score, portfolio_type, timestamp or utc_now())
+    if WRITE_BEHIND:
+        get_write_behind().put(row)
+    else:
+        insert_recommendations([row])
+
+def save_test_result(test_name, test_type, status, details=""):
+    """Save test result to database"""
+    try:
+        get_storage().insert_test_results([(test_name, test_type, status, details, utc_now())])
+    except Exception as e:
+        print(f"Error saving test result: {e}")
+
+# Idempotency-Key configuration
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', 86400))
+IDEMPOTENCY_CACHE_MAX_ENTRIES = int(os.getenv('IDEMPOTENCY_CACHE_MAX_ENTRIES', 10000))
+IDEMPOTENCY_PURGE_INTERVAL = float(os.getenv('IDEMPOTENCY_PURGE_INTERVAL', 3600))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+class IdempotencyConflict(Exception):
+    """Raised when an Idempotency-Key is reused for a different request"""
+
+class IdempotencyStore:
+    """
+    Successful /recommend responses stored by Idempotency-Key
+    The storage backend claims the key in the same transaction as the
+    recommendation it answers for, so a write that fails leaves the key
+    free for the retry. With postgres and sqlite the first request to
+    claim a key wins across all workers; later requests with the key get
+    its stored response. A per-worker TTL cache of claimed keys answers
+    repeats without a round trip.
+    """
+
+    def __init__(self, ttl, max_entries, purge_interval):
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._cache = MemoryCache(ttl, max_entries)
+        self._next_purge = 0.0
+
+    @staticmethod
+    def fingerprint(data):
+        """Hash of the parsed request payload, to detect reused keys"""
+        return hashlib.sha256(
+            json.dumps(data, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def _check(self, entry, fingerprint):
+        if entry['request_hash'] != fingerprint:
+            raise IdempotencyConflict(
+                'Idempotency-Key was already used with a different request'
+            )
+        return entry['response']
+
+    def lookup(self, key, fingerprint):
+        """Return the cached response body for key, or None"""
+        entry = self._cache.get(key)
+        return None if entry is None else self._check(entry, fingerprint)
+
+    def save(self, key, fingerprint, response, row):
+        """
+        Claim key and save its recommendation row in one transaction
+        Returns None when this request claimed the key, otherwise the
+        response body stored by the earlier request. Raises
+        StorageUnavailable when the key cannot be checked, with nothing
+        saved, so the client can safely retry.
+        """
+        now = time.monotonic()
+        purge = now >= self._next_purge
+        if purge:
+            self._next_purge = now + self.purge_interval
+        existing = get_storage().insert_recommendation_once(
+            key, fingerprint, response, row,
+            expired_before=row[-1] - timedelta(seconds=self.ttl),
+            purge=purge
+        )
+        if existing is None:
+            entry = {'request_hash': fingerprint, 'response': response}
+        else:
+            entry = {'request_hash': existing[0], 'response': existing[1]}
+        self._cache.set(key, 'idempotency', entry)
+        return None if existing is None else self._check(entry, fingerprint)
+
+idempotency_store = IdempotencyStore(
+    IDEMPOTENCY_TTL, IDEMPOTENCY_CACHE_MAX_ENTRIES, IDEMPOTENCY_PURGE_INTERVAL
+)
+
+def replay_response(body):
+    """Response for a request whose Idempotency-Key was already used"""
+    response = Response(body, mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+@app.route('/recommend', methods=['POST'])
+@admission_control
+def recommend():
+    """
+    Main recommendation endpoint
+    Accepts JSON or XML input
+    Returns portfolio recommendation based on risk score
+
+    Requests carrying an Idempotency-Key header are processed once; a
+    repeat of the same request gets the stored response and writes
+    nothing, a different request with the key gets a 422
+    """
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is not None and not 0 < len(idempotency_key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+        return jsonify({
+            'error': f'Idempotency-Key must be 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters'
+        }), 400
+
+    try:
+        content_type = request.headers.get('Content-Type', '')
+
+        with timed('parse'):
+            if 'application/xml' in content_type or 'text/xml' in content_type:
+                if XML_PARSER == 'safe':
+                    # Handle XML input with the bounded streaming parser
+                    data = parse_xml_safe(request.stream)
+                else:
+                    # Handle XML input (vulnerable to injection)
+                    xml_data = request.data.decode('utf-8')
+                    data = parse_xml_vulnerable(xml_data)
+            else:
+                # Handle JSON input
+                data = request.get_json()
+
+        # Validate input and get recommendation
+        recommendation = build_recommendation(data)
+
+        timestamp = utc_now()
+        response = jsonify({
+            **recommendation,
+            'timestamp': utc_isoformat(timestamp)
+        })
+
+        if idempotency_key is not None:
+            # The key is claimed in the same transaction as the row, so a
+            # retry never saves twice and a failed save can be retried
+            fingerprint = idempotency_store.fingerprint(data)
+            stored = idempotency_store.lookup(idempotency_key, fingerprint)
+            if stored is None:
+                row = (
+                    recommendation['name'],
+                    recommendation['risk_score'],
+                    recommendation['portfolio_type'],
+                    timestamp
+                )
+                stored = idempotency_store.save(
+                    idempotency_key, fingerprint, response.get_data(as_text=True), row
+                )
+            if stored is not None:
+                return replay_response(stored)
+            return response
+
+        # Save to database
+        save_recommendation(
+            recommendation['name'],
+            recommendation['risk_score'],
+            recommendation['portfolio_type'],
+            timestamp
+        )
+
+        return response
+
+    except IdempotencyConflict as e:
+        return jsonify({'error': str(e)}), 422
+    except StorageUnavailable as e:
+        print(f"Error saving idempotent recommendation: {e}")
+        return overload_response(503, 'Idempotency-Key cannot be checked right now; retry later', 1)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+# Batch scoring configuration
+RECOMMEND_BATCH_CHUNK_SIZE = int(os.getenv('RECOMMEND_BATCH_CHUNK_SIZE', 500))
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonlines')
+_STREAM_READ_SIZE = 64 * 1024
+
+def iter_ndjson(stream):
+    """
+    Yield one decoded value per non-blank line of an NDJSON stream
+    Lines that are not valid JSON are yielded as ValueError instances so
+    the caller can report them without aborting the whole batch
+    """
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield ValueError(f"Invalid JSON: {e}")
+
+def iter_json_array(stream):
+    """
+    Incrementally decode the items of a top-level JSON array
+    Only one read buffer plus the current item is held in memory.
+    Raises ValueError when the body is not a well-formed JSON array.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    eof = False
+    started = False
+    reader = codecs.getreader('utf-8')(stream)
+
+    def fill():
+        nonlocal buf, eof
+        chunk = reader.read(_STREAM_READ_SIZE)
+        if not chunk:
+            eof = True
+        buf += chunk
+
+    while True:
+        buf = buf.lstrip()
+        if not buf:
+            if eof:
+                raise ValueError('Unexpected end of JSON array')
+            fill()
+            continue
+
+        if not started:
+            if buf[0] != '[':
+                raise ValueError('Request body must be a JSON array or NDJSON')
+            buf = buf[1:]
+            started = True
+            continue
+
+        if buf[0] == ']':
+            return
+        if buf[0] == ',':
+            buf = buf[1:]
+            continue
+
+        try:
+            item, end = decoder.raw_decode(buf)
+        except ValueError:
+            if eof:
+                raise ValueError('Malformed JSON array')
+            fill()
+            continue
+
+        # A value that runs to the end of the buffer may be truncated
+        # (e.g. a number split across reads), so wait for more input
+        if end == len(buf) and not eof:
+            fill()
+            continue
+
+        buf = buf[end:]
+        yield item
+
+@app.route('/recommend/batch', methods=['POST'])
+@admission_control
+def recommend_batch():
+    """
+    Batch recommendation endpoint
+    Accepts a JSON array or an NDJSON body of {name, risk_score} objects
+    Streams one NDJSON result (or error) line per item, followed by a
+    summary line. Items are validated, scored and saved a chunk at a
+    time, each chunk in its own transaction, and the summary reports how
+    many were saved. Each item is charged to the client's rate limit, a chunk at a time; once
+    the bucket is overdrawn the rest of the body is left unread.
+    """
+    mimetype = request.mimetype
+    if mimetype in NDJSON_MIMETYPES:
+        items = iter_ndjson(request.stream)
+    else:
+        items = iter_json_array(request.stream)
+
+    def generate():
+        batch = get_storage().recommendation_batch()
+        # (index, error, name, risk_score) per item read since the last flush
+        chunk = []
+        processed = succeeded = 0
+        # The token taken on admission pays for the first item
+        charged = 1
+        retry_after = None
+        saving = batch.available
+        saved = 0
+        body_error = None
+
+        def flush():
+            """
+            Apply the rules to the chunk's valid items in one call, save
+            them and return the chunk's result lines in input order
+            """
+            nonlocal saving, saved
+            rules = iter(get_portfolio_recommendations(
+                risk_score for _, error, _, risk_score in chunk if error is None
+            ))
+            timestamp = utc_now()
+            rows = []
+            lines = []
+            for index, error, name, risk_score in chunk:
+                if error is not None:
+                    lines.append(app.json.dumps({'index': index, 'error': error}) + '\n')
+                    continue
+                recommendation = apply_rule(name, risk_score, next(rules))
+                rows.append((name, risk_score, recommendation['portfolio_type'], timestamp))
+                lines.append(app.json.dumps({
+                    'index': index,
+                    **recommendation,
+                    'timestamp': utc_isoformat(timestamp)
+                }) + '\n')
+            chunk.clear()
+
+            if rows and saving:
+                try:
+                    saved += batch.add(rows)
+                except Exception as e:
+                    # Later chunks are not saved either, so the client
+                    # can retry from the first unsaved item
+                    print(f"Error saving recommendations: {e}")
+                    saving = False
+            return lines
+
+        try:
+            try:
+                for index, item in enumerate(items):
+                    if processed - charged >= RECOMMEND_BATCH_CHUNK_SIZE:
+                        retry_after = charge_rate_limit(processed - charged)
+                        charged = processed
+                        if retry_after is not None:
+                            body_error = 'Rate limit exceeded'
+                            break
+                    processed += 1
+                    try:
+                        if isinstance(item, ValueError):
+                            raise item
+                        name, risk_score = validate_recommendation(item)
+                    except (ValueError, TypeError) as e:
+                        chunk.append((index, str(e), None, None))
+                    else:
+                        chunk.append((index, None, name, risk_score))
+                        succeeded += 1
+                    if len(chunk) >= RECOMMEND_BATCH_CHUNK_SIZE:
+                        yield from flush()
+            except ValueError as e:
+                body_error = str(e)
+            if retry_after is None:
+                charge_rate_limit(processed - charged)
+
+            yield from flush()
+
+            summary = {
+                'processed': processed,
+                'succeeded': succeeded,
+                'failed': processed - succeeded,
+                'saved': saved
+            }
+            if body_error:
+                summary['error'] = body_error
+            if retry_after is not None:
+                summary['retry_after'] = retry_after
+            yield app.json.dumps({'summary': summary}) + '\n'
+        finally:
+            batch.close()
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# Test job configuration
+TEST_JOB_CONCURRENCY = int(os.getenv('TEST_JOB_CONCURRENCY', 2))
+TEST_JOB_TIMEOUT = float(os.getenv('TEST_JOB_TIMEOUT', 30))
+TEST_JOB_RETENTION = float(os.getenv('TEST_JOB_RETENTION', 3600))
+# TEST_OUTPUT_MAX_CHARS: most output returned inline; /run-tests keeps the
+# end of the output (where pytest prints its summary) and job polling
+# pages through it, while /run-tests/jobs/<id>/log returns all of it
+TEST_OUTPUT_MAX_CHARS = int(os.getenv('TEST_OUTPUT_MAX_CHARS', 16384))
+TEST_JOB_DB_PATH = os.getenv(
+    'TEST_JOB_DB_PATH',
+    os.path.join(tempfile.gettempdir(), 'fin-secure-test-jobs.sqlite3')
+)
+TEST_TARGETS = {
+    'compliance': 'tests/security-tests.py::test_compliance_boundary_analysis',
+    'security': 'tests/security-tests.py::test_xml_injection_detection'
+}
+ACTIVE_JOB_STATUSES = ('queued', 'running')
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class TestJobStore:
+    """
+    Test job records in a local SQLite file
+    Shared by every worker on the host, so a job can be polled or
+    streamed from any worker. A job whose owning worker has exited is
+    marked as failed the next time it is read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                test_type TEXT,
+                status TEXT,
+                return_code INTEGER,
+                output TEXT DEFAULT '',
+                pid INTEGER,
+                created REAL,
+                started REAL,
+                finished REAL
+            )
+        """)
+
+    def _conn(self):
+        return open_sqlite(self.path, self._local)
+
+    def _row_to_job(self, row):
+        if row is None:
+            return None
+        job = dict(zip(
+            ('id', 'test_type', 'status', 'return_code', 'output',
+             'pid', 'created', 'started', 'finished'), row
+        ))
+        if job['status'] in ACTIVE_JOB_STATUSES and not _pid_alive(job['pid']):
+            self.finish(job['id'], 'error', None, "\nWorker exited before the job finished\n")
+            job['status'] = 'error'
+        return job
+
+    def submit(self, test_type):
+        """
+        Create a queued job, or return the identical job already in
+        flight. Returns (job, created).
+        """
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?",
+                (now - TEST_JOB_RETENTION,)
+            )
+            for row in conn.execute(
+                "SELECT * FROM jobs WHERE test_type = ? AND status IN (?, ?)",
+                (test_type, *ACTIVE_JOB_STATUSES)
+            ).fetchall():
+                if _pid_alive(row[5]):
+                    conn.execute("COMMIT")
+                    return self._row_to_job(row), False
+                conn.execute(
+                    "UPDATE jobs SET status = 'error', finished = ? WHERE id = ?",
+                    (now, row[0])
+                )
+
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (id, test_type, status, pid, created) VALUES (?, ?, 'queued', ?, ?)",
+                (job_id, test_type, os.getpid(), now)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return self.get(job_id), True
 
-    cursor = conn.cursor()
+    def get(self, job_id):
+        row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row)
 
-    # Create recommendations table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS recommendations (
-            id SERIAL PRIMARY KEY,
-            name VARCHAR(255),
-            risk_score INTEGER,
-            portfolio_type VARCHAR(50),
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    def mark_running(self, job_id):
+        self._conn().execute(
+            "UPDATE jobs SET status = 'running', started = ? WHERE id = ?",
+            (time.time(), job_id)
         )
-    """)
 
-    # Create test_results table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS test_results (
-            id SERIAL PRIMARY KEY,
-            test_name VARCHAR(255),
-            test_type VARCHAR(50),
-            status VARCHAR(50),
-            details TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    def append_output(self, job_id, text):
+        self._conn().execute(
+            "UPDATE jobs SET output = output || ? WHERE id = ?", (text, job_id)
         )
-    """)
 
-    conn.commit()
-    cursor.close()
-    conn.close()
-    print("Database initialized successfully")
+    def finish(self, job_id, status, return_code, text=''):
+        self._conn().execute("""
+            UPDATE jobs SET status = ?, return_code = ?, output = output || ?, finished = ?
+            WHERE id = ?
+        """, (status, return_code, text, time.time(), job_id))
 
-# Initialize database on startup
-init_database()
+_job_store = None
+_job_executor = None
+_job_executor_pid = None
+_job_lock = threading.Lock()
 
-def parse_xml_vulnerable(xml_string):
-    """
-    INTENTIONALLY VULNERABLE XML PARSER
-    This demonstrates XML injection vulnerability for testing purposes
-    In production, NEVER use this approach!
-    """
-    try:
-        # Parse XML without safety restrictions (VULNERABLE!)
-        root = ET.fromstring(xml_string)
+def get_test_job_store():
+    global _job_store
+    with _job_lock:
+        if _job_store is None:
+            _job_store = TestJobStore(TEST_JOB_DB_PATH)
+        return _job_store
 
-        risk_score = int(root.find('risk_score').text)
-        name = root.find('name').text
+def get_test_job_executor():
+    """Return this process's bounded pool of test job threads"""
+    global _job_executor, _job_executor_pid
+    with _job_lock:
+        # Threads do not survive fork(), so each worker needs its own pool
+        if _job_executor is None or _job_executor_pid != os.getpid():
+            _job_executor = ThreadPoolExecutor(
+                max_workers=TEST_JOB_CONCURRENCY, thread_name_prefix='test-job'
+            )
+            _job_executor_pid = os.getpid()
+        return _job_executor
 
-        return {'risk_score': risk_score, 'name': name}
+def run_test_job(job_id, test_type):
+    """Run one pytest suite, streaming its output into the job record"""
+    store = get_test_job_store()
+    store.mark_running(job_id)
+
+    try:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'pytest', TEST_TARGETS[test_type],
+             '-v', '--color=yes', '--tb=short'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            cwd=BASE_DIR
+        )
     except Exception as e:
-        raise ValueError(f"XML parsing error: {str(e)}")
+        store.finish(job_id, 'error', None, f"Error running tests: {str(e)}\n")
+        return
 
-def get_portfolio_recommendation(risk_score):
-    """Business logic for portfolio recommendation"""
-    if risk_score < 50:
-        return "Bonds"
-    else:
-        return "Stocks"
+    timed_out = threading.Event()
 
-def save_recommendation(name, risk_score, portfolio_type):
-    """Save recommendation to database"""
-    conn = get_db_connection()
-    if not conn:
-        return
+    def kill():
+        timed_out.set()
+        process.kill()
 
+    timer = threading.Timer(TEST_JOB_TIMEOUT, kill)
+    timer.start()
+    output = []
     try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO recommendations (name, risk_score, portfolio_type)
-            VALUES (%s, %s, %s)
-        """, (name, risk_score, portfolio_type))
-        conn.commit()
-        cursor.close()
+        for line in process.stdout:
+            output.append(line)
+            store.append_output(job_id, line)
+        return_code = process.wait()
     except Exception as e:
-        print(f"Error saving recommendation: {e}")
+        # Don't leave pytest running with nobody reading its output
+        process.kill()
+        process.wait()
+        print(f"Error running test job {job_id}: {e}")
+        store.finish(job_id, 'error', process.returncode, f"\nError running tests: {str(e)}\n")
+        return
     finally:
-        conn.close()
+        timer.cancel()
 
-def save_test_result(test_name, test_type, status, details=""):
-    """Save test result to database"""
-    conn = get_db_connection()
-    if not conn:
+    if timed_out.is_set():
+        store.finish(job_id, 'timeout', return_code, "\nTest execution timeout\n")
         return
 
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO test_results (test_name, test_type, status, details)
-            VALUES (%s, %s, %s, %s)
-        """, (test_name, test_type, status, details))
-        conn.commit()
-        cursor.close()
-    except Exception as e:
-        print(f"Error saving test result: {e}")
-    finally:
-        conn.close()
+    # Parse test results to save to database
+    output = ''.join(output)
+    if "PASSED" in output:
+        save_test_result(
+            test_name=f"{test_type}_test",
+            test_type=test_type,
+            status='passed',
+            details=output[:500]
+        )
+    elif "FAILED" in output:
+        save_test_result(
+            test_name=f"{test_type}_test",
+            test_type=test_type,
+            status='failed',
+            details=output[:500]
+        )
 
-@app.route('/recommend', methods=['POST'])
-def recommend():
+    store.finish(job_id, 'completed', return_code)
+
+def submit_test_job(test_type):
+    """Queue a test run unless an identical one is already in flight"""
+    job, created = get_test_job_store().submit(test_type)
+    if created:
+        future = get_test_job_executor().submit(run_test_job, job['id'], test_type)
+        future.add_done_callback(log_test_job_error)
+    return job
+
+def log_test_job_error(future):
+    """Report an exception that escaped run_test_job, which would otherwise go unseen"""
+    error = future.exception()
+    if error is not None:
+        print(f"Test job failed: {error!r}")
+
+def job_summary(job):
+    """Job fields returned to clients, without the (possibly long) output"""
+    return {key: value for key, value in job.items() if key not in ('output', 'pid')}
+
+def tests_disabled_response():
+    return jsonify({
+        "error": "Test execution disabled in production",
+        "message": "Use CI/CD or local environment to run tests"
+    }), 403
+
+@app.route('/run-tests/jobs', methods=['POST'])
+def create_test_job():
     """
-    Main recommendation endpoint
-    Accepts JSON or XML input
-    Returns portfolio recommendation based on risk score
+    Start a test run in the background
+    Query param: type=compliance or type=security
+    Returns the job immediately; an identical run already in flight is
+    returned instead of starting another one
     """
-    try:
-        content_type = request.headers.get('Content-Type', '')
+    if os.getenv("RENDER"):
+        return tests_disabled_response()
 
-        if 'application/xml' in content_type or 'text/xml' in content_type:
-            # Handle XML input (vulnerable to injection)
-            xml_data = request.data.decode('utf-8')
-            data = parse_xml_vulnerable(xml_data)
-        else:
-            # Handle JSON input
-            data = request.get_json()
+    test_type = request.args.get('type', 'compliance')
+    if test_type not in TEST_TARGETS:
+        return jsonify({'error': 'Invalid test type'}), 400
 
-        risk_score = data.get('risk_score')
-        name = data.get('name', 'Anonymous')
+    try:
+        job = submit_test_job(test_type)
+    except Exception as e:
+        return jsonify({'error': f'Error running tests: {str(e)}'}), 500
+    return jsonify(job_summary(job)), 202
 
-        if risk_score is None:
-            return jsonify({'error': 'risk_score is required'}), 400
+@app.route('/run-tests/jobs/<job_id>', methods=['GET'])
+def get_test_job(job_id):
+    """
+    Job status, with up to TEST_OUTPUT_MAX_CHARS of output from offset
+    (default 0); poll again with offset=next_offset for the rest
+    """
+    offset = request.args.get('offset', 0, type=int)
+    if offset < 0:
+        return jsonify({'error': 'offset must not be negative'}), 400
 
-        risk_score = int(risk_score)
+    job = get_test_job_store().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    output = job['output'] or ''
+    page = output[offset:offset + TEST_OUTPUT_MAX_CHARS]
+    return jsonify({
+        **job_summary(job),
+        'output': page,
+        'output_offset': offset,
+        'next_offset': offset + len(page),
+        'output_length': len(output)
+    })
 
-        # Validate risk score range
-        if not 0 <= risk_score <= 100:
-            return jsonify({'error': 'risk_score must be between 0 and 100'}), 400
+@app.route('/run-tests/jobs/<job_id>/log', methods=['GET'])
+def get_test_job_log(job_id):
+    """The complete output of a test job as plain text"""
+    job = get_test_job_store().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return Response(job['output'] or '', mimetype='text/plain')
 
-        # Get recommendation
-        portfolio_type = get_portfolio_recommendation(risk_score)
+@app.route('/run-tests/jobs/<job_id>/events', methods=['GET'])
+def stream_test_job(job_id):
+    """
+    Server-sent events for a test job
+    'output' events carry new output as it is produced, with the output
+    offset as the event id so reconnecting clients resume where they left
+    off; a final 'done' event carries the job status
+    """
+    store = get_test_job_store()
+    if store.get(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
 
-        # Save to database
-        save_recommendation(name, risk_score, portfolio_type)
+    try:
+        offset = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        offset = 0
 
-        return jsonify({
-            'name': name,
-            'risk_score': risk_score,
-            'portfolio_type': portfolio_type,
-            'timestamp': datetime.now().isoformat()
-        })
+    def generate():
+        nonlocal offset
+        while True:
+            job = store.get(job_id)
+            if job is None:
+                return
+            output = job['output'] or ''
+            if len(output) > offset:
+                chunk = output[offset:]
+                offset = len(output)
+                yield f"id: {offset}\nevent: output\ndata: {app.json.dumps({'text': chunk})}\n\n"
+            if job['status'] not in ACTIVE_JOB_STATUSES:
+                yield f"event: done\ndata: {app.json.dumps(job_summary(job))}\n\n"
+                return
+            time.sleep(0.25)
 
-    except ValueError as e:
-        return jsonify({'error': str(e)}), 400
-    except Exception as e:
-        return jsonify({'error': f'Server error: {str(e)}'}), 500
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/run-tests', methods=['GET'])
 def run_tests():
     if os.getenv("RENDER"):
-      return jsonify({
-          "error": "Test execution disabled in production",
-          "message": "Use CI/CD or local environment to run tests"
-      }), 403
+        return tests_disabled_response()
     #Execute pytest tests and return results
     #Query param: type=compliance or type=security
+    #Runs through the job queue and waits for the result; use
+    #POST /run-tests/jobs to avoid holding the request open
     test_type = request.args.get('type', 'compliance')
 
     try:
-        # Determine which test to run
-        if test_type == 'compliance':
-            test_file = 'tests/security-tests.py::test_compliance_boundary_analysis'
-        elif test_type == 'security':
-            test_file = 'tests/security-tests.py::test_xml_injection_detection'
-        else:
+        if test_type not in TEST_TARGETS:
             return jsonify({'error': 'Invalid test type'}), 400
 
-        # Run pytest with verbose output and color
-        result = subprocess.run(
-            [sys.executable, '-m', 'pytest', test_file, '-v', '--color=yes', '--tb=short'],
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
-
-        # Combine stdout and stderr
-        output = result.stdout + "\n" + result.stderr
+        job = submit_test_job(test_type)
+        store = get_test_job_store()
+        deadline = time.monotonic() + TEST_JOB_TIMEOUT + 10
+        while job['status'] in ACTIVE_JOB_STATUSES and time.monotonic() < deadline:
+            time.sleep(0.2)
+            job = store.get(job['id'])
 
-        # Parse test results to save to database
-        if "PASSED" in output:
-            save_test_result(
-                test_name=f"{test_type}_test",
-                test_type=test_type,
-                status='passed',
-                details=output[:500]
-            )
-        elif "FAILED" in output:
-            save_test_result(
-                test_name=f"{test_type}_test",
-                test_type=test_type,
-                status='failed',
-                details=output[:500]
-            )
+        if job['status'] in ACTIVE_JOB_STATUSES or job['status'] == 'timeout':
+            return jsonify({'error': 'Test execution timeout'}), 500
+        if job['status'] == 'error':
+            return jsonify({'error': job['output'].strip() or 'Error running tests'}), 500
 
+        output = job['output']
+        truncated = len(output) > TEST_OUTPUT_MAX_CHARS
         return jsonify({
-            'output': output,
-            'return_code': result.returncode,
-            'test_type': test_type
+            'output': output[-TEST_OUTPUT_MAX_CHARS:] if truncated else output,
+            'output_truncated': truncated,
+            'output_length': len(output),
+            'log_url': f"/run-tests/jobs/{job['id']}/log",
+            'return_code': job['return_code'],
+            'test_type': test_type,
+            'job_id': job['id']
         })
 
-    except subprocess.TimeoutExpired:
-        return jsonify({'error': 'Test execution timeout'}), 500
     except Exception as e:
         return jsonify({'error': f'Error running tests: {str(e)}'}), 500
 
+TOTAL_MODES = ('exact', 'estimate', 'none')
+# RECOMMENDATIONS_MAX_LIMIT: largest page /recommendations returns;
+# /recommendations/export streams any number of rows
+RECOMMENDATIONS_MAX_LIMIT = int(os.getenv('RECOMMENDATIONS_MAX_LIMIT', 1000))
+
+def fetch_records(cursor):
+    """
+    Fetch all rows of a plain tuple cursor as dicts keyed by column name
+    Builds each output dict once, instead of a RealDictRow plus a copy.
+    Responses carry one object per row, and writing each object's JSON
+    from the tuple in Python is slower than letting orjson encode a dict
+    """
+    columns = [column.name for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def encode_cursor(row):
+    """Build an opaque pagination cursor from the last row of a page"""
+    raw = json.dumps([row['timestamp'].isoformat(), row['id']])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(value):
+    """Return the (timestamp, id) position encoded in a cursor"""
+    try:
+        padded = value + '=' * (-len(value) % 4)
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def count_recommendations(cursor, portfolio_type, mode):
+    """
+    Count recommendations for the 'total' field
+    'exact' sums the counters in recommendation_stats, which are kept in
+    step with every insert (no table scan), 'estimate' reads the planner's
+    row estimate and 'none' skips counting altogether
+    """
+    if mode == 'none':
+        return None
+
+    where = " WHERE portfolio_type = %s" if portfolio_type else ""
+    params = [portfolio_type] if portfolio_type else []
+
+    if mode == 'estimate':
+        cursor.execute("EXPLAIN (FORMAT JSON) SELECT 1 FROM recommendations" + where, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    cursor.execute("SELECT COALESCE(SUM(count), 0) FROM recommendation_stats" + where, params)
+    return int(cursor.fetchone()[0])
+
 @app.route('/recommendations', methods=['GET'])
+@cached_response('recommendations')
 def get_recommendations():
     """
     Get all recommendations from database
     Supports pagination and filtering
+
+    Pass cursor (empty for the first page, then next_cursor from the
+    previous response) for keyset pagination on (timestamp, id);
+    otherwise limit/offset paging is used. total=exact|estimate|none
+    controls how the total is computed (default: exact with offset,
+    none with cursor). limit is clamped to 1..RECOMMENDATIONS_MAX_LIMIT
+    and the limit applied is returned.
     """
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'error': 'Database connection failed'}), 500
+    limit = request.args.get('limit', 100, type=int)
+    limit = min(max(limit, 1), RECOMMENDATIONS_MAX_LIMIT)
+    offset = request.args.get('offset', 0, type=int)
+    if offset < 0:
+        return jsonify({'error': 'offset must not be negative'}), 400
+    portfolio_type = request.args.get('portfolio_type', None)
+    cursor_param = request.args.get('cursor', None)
+    use_cursor = cursor_param is not None
+    total_mode = request.args.get('total', 'none' if use_cursor else 'exact')
+
+    if total_mode not in TOTAL_MODES:
+        return jsonify({'error': f"total must be one of {', '.join(TOTAL_MODES)}"}), 400
+
+    position = None
+    if cursor_param:
+        try:
+            position = decode_cursor(cursor_param)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+    try:
+        # Fetch one extra row to know whether another page exists
+        recommendations, total = get_storage().page_recommendations(
+            portfolio_type,
+            limit + 1 if use_cursor else limit,
+            offset=0 if use_cursor else offset,
+            position=position,
+            total_mode=total_mode
+        )
+
+        next_cursor = None
+        if use_cursor and len(recommendations) > limit:
+            recommendations = recommendations[:limit]
+            next_cursor = encode_cursor(recommendations[-1])
+
+        result = {
+            'recommendations': recommendations,
+            'total': total,
+            'limit': limit
+        }
+        if use_cursor:
+            result['next_cursor'] = next_cursor
+        else:
+            result['offset'] = offset
+        return jsonify(result)
+
+    except Exception as e:
+        print(f"Error fetching recommendations: {e}")
+        return jsonify({'error': str(e)}), 500
+
+# Export configuration
+EXPORT_FETCH_SIZE = int(os.getenv('EXPORT_FETCH_SIZE', 5000))
+EXPORT_ROW_GROUP_SIZE = int(os.getenv('EXPORT_ROW_GROUP_SIZE', 100000))
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet')
+}
+EXPORT_COLUMNS = ('id', 'name', 'risk_score', 'portfolio_type', 'timestamp')
+
+def parse_timestamp_arg(name):
+    """Parse an ISO 8601 query argument as a naive UTC datetime"""
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'{name} must be an ISO 8601 timestamp')
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
 
+def iter_export_batches(conn, query, params):
+    """Stream query results in batches through a server-side cursor"""
+    cursor = conn.cursor(name=f'export_{uuid.uuid4().hex}')
+    cursor.itersize = EXPORT_FETCH_SIZE
     try:
-        # Get query parameters
-        limit = request.args.get('limit', 100, type=int)
-        offset = request.args.get('offset', 0, type=int)
-        portfolio_type = request.args.get('portfolio_type', None)
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                return
+            yield rows
+    finally:
+        cursor.close()
 
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
+def export_csv(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in batches:
+        writer.writerows(
+            (row_id, name, risk_score, portfolio_type, json_default(timestamp) if timestamp else '')
+            for row_id, name, risk_score, portfolio_type, timestamp in rows
+        )
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
 
-        # Build query with optional filter
-        query = """
-            SELECT id, name, risk_score, portfolio_type, timestamp
-            FROM recommendations
-        """
-        params = []
+def export_ndjson(batches):
+    for rows in batches:
+        yield ''.join(
+            app.json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n' for row in rows
+        ).encode()
+
+class _ChunkSink:
+    """Write-only file object collecting output until it is taken"""
+
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def export_parquet(batches):
+    """
+    Zstandard-compressed Parquet, one row group per EXPORT_ROW_GROUP_SIZE
+    rows; each row group is sent as soon as it is written
+    """
+    schema = pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('name', pyarrow.string()),
+        ('risk_score', pyarrow.int32()),
+        ('portfolio_type', pyarrow.string()),
+        ('timestamp', pyarrow.timestamp('us', tz='UTC'))
+    ])
+    sink = _ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema, compression='zstd')
+    pending = []
 
+    def write_row_group():
+        columns = list(zip(*pending))
+        writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=field.type) for column, field in zip(columns, schema)],
+            schema=schema
+        ))
+        pending.clear()
+
+    for rows in batches:
+        pending.extend(rows)
+        if len(pending) >= EXPORT_ROW_GROUP_SIZE:
+            write_row_group()
+            yield sink.take()
+    if pending:
+        write_row_group()
+    writer.close()
+    yield sink.take()
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+EXPORT_WRITERS = {'csv': export_csv, 'ndjson': export_ndjson, 'parquet': export_parquet}
+
+@app.route('/recommendations/export', methods=['GET'])
+def export_recommendations():
+    """
+    Stream every matching recommendation in one response
+    format=csv|ndjson|parquet, optional portfolio_type, since and until
+    (ISO 8601, since inclusive, until exclusive), and compress=gzip for
+    csv/ndjson. Rows come oldest first from a server-side cursor, so
+    memory use does not depend on the number of rows.
+    """
+    export_format = request.args.get('format', 'csv')
+    compress = request.args.get('compress')
+    portfolio_type = request.args.get('portfolio_type')
+
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    if export_format == 'parquet' and pyarrow is None:
+        return jsonify({'error': 'Parquet export requires pyarrow'}), 400
+    if compress not in (None, 'gzip'):
+        return jsonify({'error': 'compress must be gzip'}), 400
+    if compress and export_format == 'parquet':
+        return jsonify({'error': 'Parquet exports are already compressed'}), 400
+    try:
+        since = parse_timestamp_arg('since')
+        until = parse_timestamp_arg('until')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    conn = None
+    if STORAGE_BACKEND == 'postgres':
+        conditions = []
+        params = []
         if portfolio_type:
-            query += " WHERE portfolio_type = %s"
+            conditions.append("portfolio_type = %s")
             params.append(portfolio_type)
+        if since:
+            conditions.append("timestamp >= %s")
+            params.append(since)
+        if until:
+            conditions.append("timestamp < %s")
+            params.append(until)
+        query = "SELECT id, name, risk_score, portfolio_type, timestamp FROM recommendations"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY timestamp, id"
 
-        query += " ORDER BY timestamp DESC LIMIT %s OFFSET %s"
-        params.extend([limit, offset])
+        conn = get_read_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'}), 500
+        batches = iter_export_batches(conn, query, params)
+    else:
+        batches = get_storage().export_batches(portfolio_type, since, until, EXPORT_FETCH_SIZE)
 
-        cursor.execute(query, params)
-        recommendations = cursor.fetchall()
+    def generate():
+        chunks = EXPORT_WRITERS[export_format](batches)
+        if compress:
+            chunks = gzip_chunks(chunks)
+        try:
+            yield from chunks
+        except Exception as e:
+            # Headers are already sent: cut the body short rather than
+            # let the client take a partial file for a complete one
+            print(f"Error exporting recommendations: {e}")
+            raise
 
-        # Get total count
-        count_query = "SELECT COUNT(*) as total FROM recommendations"
-        if portfolio_type:
-            count_query += " WHERE portfolio_type = %s"
-            cursor.execute(count_query, [portfolio_type])
-        else:
-            cursor.execute(count_query)
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    if compress:
+        mimetype, extension = 'application/gzip', extension + '.gz'
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="recommendations.{extension}"'
+    if conn is not None:
+        # Runs after the generator is closed, whether or not it was started
+        response.call_on_close(lambda: release_db_connection(conn))
+    return response
 
-        total = cursor.fetchone()['total']
+@app.route('/metrics', methods=['GET'])
+@cached_response('metrics')
+def get_metrics():
+    """
+    Get testing and recommendation metrics from database
+    Counts come from the incrementally maintained stats tables, so the
+    cost does not grow with the size of the base tables
+    """
+    ensure_metrics_reconciler()
 
-        cursor.close()
-        conn.close()
+    try:
+        test_counts, portfolio_stats, recent_tests = get_storage().metrics()
+        portfolio_dist = [
+            {
+                'portfolio_type': portfolio_type,
+                'count': count,
+                'avg_risk_score': risk_score_sum / count
+            }
+            for portfolio_type, count, risk_score_sum in portfolio_stats
+        ]
 
         return jsonify({
-            'recommendations': [dict(row) for row in recommendations],
-            'total': total,
-            'limit': limit,
-            'offset': offset
+            'total_tests': sum(test_counts.values()),
+            'passed_tests': test_counts.get('passed', 0),
+            'failed_tests': test_counts.get('failed', 0),
+            'total_recommendations': sum(row['count'] for row in portfolio_dist),
+            'recent_tests': recent_tests,
+            'portfolio_distribution': portfolio_dist
         })
 
     except Exception as e:
-        print(f"Error fetching recommendations: {e}")
+        print(f"Error fetching metrics: {e}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/metrics', methods=['GET'])
-def get_metrics():
+def format_live_event(event):
+    """SSE frames for one live event"""
+    kind = event.get('type')
+    if kind not in ('recommendations', 'test_results'):
+        return "event: reset\ndata: {}\n\n"
+    rows = {'count': event['count'], 'rows': event['rows']}
+    metrics = {'type': kind, 'delta': event['delta']}
+    if event.get('totals') is not None:
+        metrics['totals'] = event['totals']
+    return (f"event: {kind}\ndata: {app.json.dumps(rows)}\n\n"
+            f"event: metrics\ndata: {app.json.dumps(metrics)}\n\n")
+
+@app.route('/events', methods=['GET'])
+def stream_events():
     """
-    Get testing and recommendation metrics from database
+    Server-sent events of new recommendations and test results
+    The stream opens with 'ready', after which the client loads the
+    current state. Each write then sends a 'recommendations' or
+    'test_results' event with its newest rows, and a 'metrics' event
+    with the aggregate deltas and new totals. 'reset' means events were
+    missed and the state should be reloaded. Streams end after
+    LIVE_EVENTS_MAX_DURATION seconds; browsers reconnect on their own.
     """
-    conn = get_db_connection()
+    if not LIVE_EVENTS:
+        return jsonify({'error': 'Live events are disabled'}), 404
+    if STORAGE_BACKEND != 'postgres':
+        return jsonify({'error': 'Live events need the postgres storage backend'}), 501
+
+    broadcaster = get_event_broadcaster()
+    if broadcaster.subscriber_count() >= LIVE_EVENTS_MAX_SUBSCRIBERS:
+        response = jsonify({'error': 'Too many live event subscribers'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+
+    def generate():
+        # Subscribe only once the stream starts, so the finally clause
+        # below always runs for a subscription
+        subscriber = broadcaster.subscribe()
+        if subscriber is None:
+            return
+        try:
+            yield "retry: 3000\nevent: ready\ndata: {}\n\n"
+            deadline = time.monotonic() + LIVE_EVENTS_MAX_DURATION
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    event = subscriber.get(timeout=min(LIVE_EVENTS_HEARTBEAT, remaining))
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+                yield format_live_event(event)
+        finally:
+            broadcaster.unsubscribe(subscriber)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+METRICS_DAILY_MAX_DAYS = 366
+
+@app.route('/metrics/daily', methods=['GET'])
+@cached_response('metrics')
+def get_daily_metrics():
+    """
+    Per-day recommendation and test counts for the last `days` days
+    Complete days are read from the daily rollups; only days not rolled
+    up yet are aggregated from the base tables
+    """
+    days = request.args.get('days', 30, type=int)
+    if not 1 <= days <= METRICS_DAILY_MAX_DAYS:
+        return jsonify({'error': f'days must be between 1 and {METRICS_DAILY_MAX_DAYS}'}), 400
+    since = utc_now().date() - timedelta(days=days - 1)
+    if STORAGE_BACKEND != 'postgres':
+        return jsonify({'error': 'Daily metrics need the postgres storage backend'}), 501
+
+    conn = get_read_connection()
     if not conn:
         return jsonify({'error': 'Database connection failed'}), 500
 
     try:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-
-        # Get test statistics
-        cursor.execute("""
-            SELECT
-                COUNT(*) as total_tests,
-                SUM(CASE WHEN status = 'passed' THEN 1 ELSE 0 END) as passed_tests,
-                SUM(CASE WHEN status = 'failed' THEN 1 ELSE 0 END) as failed_tests
-            FROM test_results
-        """)
-        test_stats = cursor.fetchone()
-
-        # Get recommendation count
-        cursor.execute("SELECT COUNT(*) as total FROM recommendations")
-        rec_count = cursor.fetchone()
+        cursor = conn.cursor()
 
-        # Get recent test results
         cursor.execute("""
-            SELECT test_name, test_type, status, timestamp
-            FROM test_results
-            ORDER BY timestamp DESC
-            LIMIT 10
-        """)
-        recent_tests = cursor.fetchall()
+            WITH watermark AS (
+                SELECT COALESCE(MAX(rolled_up_until), '-infinity') AS until
+                FROM rollup_state WHERE source = 'recommendations'
+            )
+            SELECT day, portfolio_type, count, risk_score_sum
+            FROM recommendation_daily, watermark
+            WHERE day >= %(since)s AND day < watermark.until
+            UNION ALL
+            SELECT timestamp::date, portfolio_type, COUNT(*), COALESCE(SUM(risk_score), 0)
+            FROM recommendations, watermark
+            WHERE timestamp >= GREATEST(watermark.until, %(since)s)
+              AND portfolio_type IS NOT NULL
+            GROUP BY 1, 2
+            ORDER BY 1, 2
+        """, {'since': since})
+        recommendations = [
+            {
+                'day': day,
+                'portfolio_type': portfolio_type,
+                'count': count,
+                'avg_risk_score': risk_score_sum / count
+            }
+            for day, portfolio_type, count, risk_score_sum in cursor.fetchall()
+        ]
 
-        # Get portfolio distribution
         cursor.execute("""
-            SELECT
-                portfolio_type,
-                COUNT(*) as count,
-                AVG(risk_score) as avg_risk_score
-            FROM recommendations
-            GROUP BY portfolio_type
-        """)
-        portfolio_dist = cursor.fetchall()
+            WITH watermark AS (
+                SELECT COALESCE(MAX(rolled_up_until), '-infinity') AS until
+                FROM rollup_state WHERE source = 'test_results'
+            )
+            SELECT day, status, SUM(count)::bigint AS count
+            FROM test_result_daily, watermark
+            WHERE day >= %(since)s AND day < watermark.until
+            GROUP BY 1, 2
+            UNION ALL
+            SELECT timestamp::date, status, COUNT(*)
+            FROM test_results, watermark
+            WHERE timestamp >= GREATEST(watermark.until, %(since)s)
+              AND status IS NOT NULL
+            GROUP BY 1, 2
+            ORDER BY 1, 2
+        """, {'since': since})
+        tests = fetch_records(cursor)
 
         cursor.close()
-        conn.close()
 
         return jsonify({
-            'total_tests': test_stats['total_tests'] or 0,
-            'passed_tests': test_stats['passed_tests'] or 0,
-            'failed_tests': test_stats['failed_tests'] or 0,
-            'total_recommendations': rec_count['total'] or 0,
-            'recent_tests': [dict(row) for row in recent_tests],
-            'portfolio_distribution': [dict(row) for row in portfolio_dist]
+            'since': since,
+            'recommendations': recommendations,
+            'tests': tests
         })
 
     except Exception as e:
-        print(f"Error fetching metrics: {e}")
+        print(f"Error fetching daily metrics: {e}")
         return jsonify({'error': str(e)}), 500
+    finally:
+        release_db_connection(conn)
+
+# Pool, write-behind, admission, replica and readiness stats exported as gauges; the rest are counters
+GAUGE_STATS = ('min_size', 'max_size', 'in_use', 'idle', 'pending', 'max_in_flight', 'in_flight',
+               'healthy_replicas', 'ready', 'check_latency_ms', 'consecutive_failures')
+
+def _prometheus_labels(names, values):
+    escaped = (
+        str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        for value in values
+    )
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+def render_prometheus():
+    """Render this worker's metrics in the Prometheus text format"""
+    worker = (str(os.getpid()),)
+    lines = []
+
+    def histogram(name, help_text, histograms):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        names = ('worker',) + histograms.labelnames
+        bounds = [repr(bound) for bound in histograms.buckets] + ['+Inf']
+        for labels, (counts, count, total) in sorted(histograms.snapshot().items()):
+            label_text = _prometheus_labels(names, worker + labels)
+            for bound, bucket_count in zip(bounds, counts):
+                lines.append(f'{name}_bucket{{{label_text},le="{bound}"}} {bucket_count}')
+            lines.append(f'{name}_count{{{label_text}}} {count}')
+            lines.append(f'{name}_sum{{{label_text}}} {total:.6f}')
+
+    def stats(prefix, help_text, values):
+        if values is None:
+            return
+        label_text = _prometheus_labels(('worker',), worker)
+        for key, value in values.items():
+            if key in GAUGE_STATS:
+                name, kind = f'{prefix}_{key}', 'gauge'
+            else:
+                name, kind = f'{prefix}_{key}_total', 'counter'
+            lines.append(f'# HELP {name} {help_text} ({key})')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name}{{{label_text}}} {value}')
+
+    histogram('finsecure_http_request_duration_seconds',
+              'Request latency by route and status', request_latency)
+    histogram('finsecure_phase_duration_seconds',
+              'Time spent per phase (parse, db_connect, query, serialize) by route',
+              phase_latency)
+    stats('finsecure_db_pool', 'Database connection pool', get_pool_stats())
+    stats('finsecure_write_behind', 'Write-behind queue', get_write_behind_stats())
+    stats('finsecure_write_spool', 'Write spool', get_storage_stats())
+    stats('finsecure_read_routing', 'Read replica routing', get_replica_stats())
+    stats('finsecure_readiness', 'Readiness check', get_readiness_stats())
+    stats('finsecure_recommend_admission', 'Recommend admission control', recommend_gate.stats())
+    return '\n'.join(lines) + '\n'
+
+@app.route('/metrics/prometheus', methods=['GET'])
+def get_prometheus_metrics():
+    """
+    Request latency histograms and pool/queue gauges in the Prometheus
+    text format. Values are per worker process and labelled with its pid.
+    """
+    return Response(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/rate-limits', methods=['GET'])
+def get_rate_limits():
+    """
+    Per-client rate limit usage, busiest clients first, and this
+    worker's admission control counters
+    Query parameters: limit (default 50, max 1000)
+    """
+    limit = request.args.get('limit', 50, type=int)
+    if limit is None or not 1 <= limit <= 1000:
+        return jsonify({'error': 'limit must be between 1 and 1000'}), 400
+
+    result = {'admission': recommend_gate.stats(), 'rate_limit': None}
+    if rate_limiter is not None:
+        try:
+            clients = rate_limiter.usage(limit)
+        except Exception as e:
+            print(f"Error reading rate limits: {e}")
+            return jsonify({'error': str(e)}), 500
+        result['rate_limit'] = {
+            'store': RATE_LIMIT,
+            'rate': rate_limiter.rate,
+            'burst': rate_limiter.burst,
+            'clients': clients
+        }
+    return jsonify(result)
+
+# Readiness check configuration
+READINESS_CHECK_INTERVAL = float(os.getenv('READINESS_CHECK_INTERVAL', 5))
+# Failed checks in a row before a ready worker reports not ready, so one
+# slow reconnect (e.g. while the database wakes up) does not fail probes
+READINESS_FAILURE_THRESHOLD = int(os.getenv('READINESS_FAILURE_THRESHOLD', 3))
+# A result older than this means the checker itself is stuck
+READINESS_MAX_AGE = float(os.getenv('READINESS_MAX_AGE', 60))
+
+PROCESS_STARTED = time.monotonic()
+
+class ReadinessChecker:
+    """
+    Background check of whether this worker can serve requests
+    Every interval seconds it pings the storage backend and keeps the
+    outcome, so readiness probes only read memory. The worker becomes
+    ready on its first successful check and unready after
+    failure_threshold failed checks in a row.
+    """
+
+    def __init__(self, interval, failure_threshold):
+        self.interval = interval
+        self.failure_threshold = max(failure_threshold, 1)
+        self.pid = os.getpid()
+        self._result = {
+            'ready': False,
+            'status': 'starting',
+            'checked_at': None,
+            'latency_ms': None,
+            'error': None,
+            'consecutive_failures': 0
+        }
+        self._checked = None
+        threading.Thread(target=self._run, name='readiness-check', daemon=True).start()
+
+    def check(self):
+        started = time.perf_counter()
+        try:
+            get_storage().ping()
+            error = None
+        except Exception as e:
+            error = str(e)
+        latency_ms = round((time.perf_counter() - started) * 1000, 2)
+
+        previous = self._result
+        failures = 0 if error is None else previous['consecutive_failures'] + 1
+        ready = error is None or (previous['ready'] and failures < self.failure_threshold)
+        if error is None:
+            status = 'ok'
+        else:
+            status = 'degraded' if ready else 'unavailable'
+        # Replaced whole, so readers never see a half-updated result
+        self._result = {
+            'ready': ready,
+            'status': status,
+            'checked_at': utc_now(),
+            'latency_ms': latency_ms,
+            'error': error,
+            'consecutive_failures': failures
+        }
+        self._checked = time.monotonic()
+
+    def _run(self):
+        while True:
+            self.check()
+            time.sleep(self.interval)
+
+    def result(self):
+        result, checked = self._result, self._checked
+        if checked is not None and time.monotonic() - checked > READINESS_MAX_AGE:
+            return {**result, 'ready': False, 'status': 'stale'}
+        return result
+
+_readiness_checker = None
+_readiness_lock = threading.Lock()
+
+def get_readiness_checker():
+    """Return the readiness checker for the current process, starting it if needed"""
+    global _readiness_checker
+    checker = _readiness_checker
+    if checker is not None and checker.pid == os.getpid():
+        return checker
+
+    with _readiness_lock:
+        if _readiness_checker is None or _readiness_checker.pid != os.getpid():
+            _readiness_checker = ReadinessChecker(
+                READINESS_CHECK_INTERVAL, READINESS_FAILURE_THRESHOLD
+            )
+        return _readiness_checker
+
+def get_readiness_stats():
+    """Readiness gauges for the current worker, once it has been checked"""
+    checker = _readiness_checker
+    if checker is None or checker.pid != os.getpid():
+        return None
+    result = checker.result()
+    if result['latency_ms'] is None:
+        return None
+    return {
+        'ready': int(result['ready']),
+        'check_latency_ms': result['latency_ms'],
+        'consecutive_failures': result['consecutive_failures']
+    }
+
+@app.route('/health/live', methods=['GET'])
+def liveness():
+    """Liveness probe: the worker answers requests. Does no I/O."""
+    return jsonify({
+        'status': 'alive',
+        'pid': os.getpid(),
+        'uptime': round(time.monotonic() - PROCESS_STARTED, 3)
+    })
+
+@app.route('/health/ready', methods=['GET'])
+def readiness():
+    """
+    Readiness probe: 200 while this worker's storage backend answers,
+    503 otherwise. Serves the background checker's latest result.
+    """
+    result = get_readiness_checker().result()
+    return jsonify({**result, 'storage': STORAGE_BACKEND}), 200 if result['ready'] else 503
 
 @app.route('/health', methods=['GET'])
 def health():
-    """Health check endpoint"""
-    conn = get_db_connection()
-    db_status = "connected" if conn else "disconnected"
-    if conn:
-        conn.close()
+    """Health check endpoint, from the cached readiness result"""
+    readiness_result = get_readiness_checker().result()
+    db_status = STORAGE_BACKEND
+    if STORAGE_BACKEND == 'postgres':
+        db_status = "connected" if readiness_result['ready'] else "disconnected"
 
     return jsonify({
         'status': 'healthy',
         'database': db_status,
-        'timestamp': datetime.now().isoformat()
+        'readiness': readiness_result,
+        'storage': STORAGE_BACKEND,
+        'write_spool': get_storage_stats(),
+        'schema_version': _schema_version,
+        'pool': get_pool_stats(),
+        'replicas': get_replica_status(),
+        'write_behind': get_write_behind_stats(),
+        'timestamp': utc_isoformat(utc_now())
     })
 
 if __name__ == '__main__':
@@ -384,9 +4981,20 @@ if __name__ == '__main__':
     print("  POST /recommend - Get investment recommendation")
     print("  GET  /run-tests?type=compliance|security - Run tests")
     print("  GET  /metrics - Get testing metrics")
+    print("  GET  /events - Live recommendations and test results (SSE)")
+    print("  GET  /metrics/daily - Get per-day metrics")
+    print("  GET  /metrics/prometheus - Request latency and pool metrics")
     print("  GET  /recommendations - Get all user recommendations")
+    print("  GET  /recommendations/export - Export recommendations (CSV/NDJSON/Parquet)")
     print("  GET  /health - Health check")
+    print("  GET  /health/live, /health/ready - Liveness and readiness probes")
     print("=" * 60)
     port = int(os.environ.get('PORT', 5000))
     debug = not os.getenv('RENDER')  # Disable debug in production
+    if debug:
+        # Local development: bring the schema up to date on start
+        try:
+            migrate()
+        except Exception as e:
+            print(f"Warning: Could not migrate database: {e}")
     app.run(host='0.0.0.0', port=port, debug=debug)
@@ -1,10 +1,166 @@
+import csv
+import gzip
+import io
+import os
+import sys
+import threading
+import uuid
 import pytest
 import requests
 import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3.response import HTTPResponse
+from urllib.parse import urlsplit
 
 # Configuration
-BASE_URL = "https://fin-secure-server.onrender.com"
+# FINSECURE_BASE_URL=inprocess runs every case against server.app in this
+# process through Flask's test client: no server, network or TLS needed
+BASE_URL = os.getenv("FINSECURE_BASE_URL", "https://fin-secure-server.onrender.com").rstrip("/")
+IN_PROCESS = BASE_URL == "inprocess"
+if IN_PROCESS:
+    BASE_URL = "http://inprocess"
 RECOMMEND_ENDPOINT = f"{BASE_URL}/recommend"
+MAX_PARALLEL_CASES = int(os.getenv("FINSECURE_TEST_CONCURRENCY", 8))
+
+# One keep-alive session shared by every case, so connections (and TLS
+# handshakes) are reused instead of opened per request
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_PARALLEL_CASES)
+session.mount("http://", _adapter)
+session.mount("https://", _adapter)
+
+
+class FlaskAppAdapter(BaseAdapter):
+    """requests transport adapter that dispatches to a Flask app in-process"""
+
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+        # Flask test clients keep per-request state, so use one per thread
+        self.local = threading.local()
+
+    def _client(self):
+        if not hasattr(self.local, "client"):
+            self.local.client = self.app.test_client()
+        return self.local.client
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        url = urlsplit(request.url)
+        result = self._client().open(
+            url.path,
+            method=request.method,
+            query_string=url.query,
+            headers=dict(request.headers),
+            data=request.body,
+        )
+
+        response = requests.Response()
+        response.status_code = result.status_code
+        response.reason = result.status.partition(" ")[2]
+        response.headers = CaseInsensitiveDict(result.headers)
+        # Undo Content-Encoding as urllib3 does for a real connection
+        response._content = HTTPResponse(
+            body=io.BytesIO(result.get_data()), headers=dict(result.headers)
+        ).data
+        # A WSGI server closes the body once it is sent
+        result.close()
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def use_flask_app(app):
+    """Route every case to app through its test client"""
+    session.mount(BASE_URL, FlaskAppAdapter(app))
+
+
+# FINSECURE_TEST_DATABASE_URL: database the in-process cases may write to.
+# An exported DATABASE_URL is never used, since it may point at production;
+# without this, writes stay in the server's memory backend
+TEST_DATABASE_URL = os.getenv("FINSECURE_TEST_DATABASE_URL")
+
+if IN_PROCESS:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    # Every case comes from one client; don't let the limiter turn them away
+    os.environ.setdefault("RATE_LIMIT", "off")
+    if TEST_DATABASE_URL:
+        os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+        os.environ["STORAGE_BACKEND"] = "postgres"
+    else:
+        os.environ.pop("DATABASE_URL", None)
+        os.environ["STORAGE_BACKEND"] = "memory"
+    import server
+
+    use_flask_app(server.app)
+
+
+def prepare_test_database():
+    """Bring the opted-in test database's schema up to date"""
+    if IN_PROCESS and TEST_DATABASE_URL:
+        server.migrate()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def test_database():
+    prepare_test_database()
+
+
+class _PerThreadStdout(io.TextIOBase):
+    """Buffers print() output per worker thread so parallel cases don't interleave"""
+
+    def __init__(self, target):
+        self.target = target
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        return (buffer or self.target).write(text)
+
+    def flush(self):
+        self.target.flush()
+
+    def close(self):
+        # Never close (or flush at exit) the stream being wrapped
+        pass
+
+
+def run_cases_concurrently(cases):
+    """
+    Run (label, func, args) cases in parallel over the shared session
+    Each case's printed output is replayed in the original order.
+    Returns (label, error) pairs, where error is None for a passing case
+    or the exception it raised
+    """
+    stdout = _PerThreadStdout(sys.stdout)
+
+    def run(case):
+        label, func, args = case
+        stdout.local.buffer = io.StringIO()
+        try:
+            func(*args)
+            error = None
+        except Exception as e:
+            error = e
+        return label, error, stdout.local.buffer.getvalue()
+
+    sys.stdout = stdout
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(MAX_PARALLEL_CASES, len(cases)))) as executor:
+            results = list(executor.map(run, cases))
+    finally:
+        sys.stdout = stdout.target
+
+    for _, _, output in results:
+        sys.stdout.write(output)
+    return [(label, error) for label, error, _ in results]
 
 class TestComplianceBoundaryAnalysis:
     """
@@ -36,7 +192,7 @@ class TestComplianceBoundaryAnalysis:
             "name": f"Tester_{risk_score}"
         }
 
-        response = requests.post(
+        response = session.post(
             RECOMMEND_ENDPOINT,
             json=payload,
             headers={"Content-Type": "application/json"}
@@ -74,15 +230,19 @@ def test_compliance_boundary_analysis():
     passed = 0
     failed = 0
 
-    for risk_score, expected in test_cases:
-        try:
-            tester.test_risk_score_boundaries(risk_score, expected)
+    results = run_cases_concurrently([
+        (risk_score, tester.test_risk_score_boundaries, (risk_score, expected))
+        for risk_score, expected in test_cases
+    ])
+
+    for risk_score, error in results:
+        if error is None:
             passed += 1
-        except AssertionError as e:
-            print(f"✗ Risk Score {risk_score:3d} [FAIL]: {e}")
+        elif isinstance(error, AssertionError):
+            print(f"✗ Risk Score {risk_score:3d} [FAIL]: {error}")
             failed += 1
-        except Exception as e:
-            print(f"✗ Risk Score {risk_score:3d} [ERROR]: {e}")
+        else:
+            print(f"✗ Risk Score {risk_score:3d} [ERROR]: {error}")
             failed += 1
 
     print("="*60)
@@ -115,7 +275,7 @@ class TestXMLInjectionDetection:
   <name>&xxe;</name>
 </request>"""
 
-        response = requests.post(
+        response = session.post(
             RECOMMEND_ENDPOINT,
             data=malicious_xml,
             headers={"Content-Type": "application/xml"}
@@ -155,7 +315,7 @@ class TestXMLInjectionDetection:
 </request>"""
 
         try:
-            response = requests.post(
+            response = session.post(
                 RECOMMEND_ENDPOINT,
                 data=xml_bomb,
                 headers={"Content-Type": "application/xml"},
@@ -186,7 +346,7 @@ class TestXMLInjectionDetection:
   <name>&malicious;</name>
 </request>"""
 
-        response = requests.post(
+        response = session.post(
             RECOMMEND_ENDPOINT,
             data=malicious_xml,
             headers={"Content-Type": "application/xml"}
@@ -214,7 +374,7 @@ class TestXMLInjectionDetection:
   <name><![CDATA[<script>alert('XSS')</script>]]></name>
 </request>"""
 
-        response = requests.post(
+        response = session.post(
             RECOMMEND_ENDPOINT,
             data=cdata_xml,
             headers={"Content-Type": "application/xml"}
@@ -251,16 +411,19 @@ def test_xml_injection_detection():
     passed = 0
     failed = 0
 
-    for test_name, test_func in tests:
-        try:
-            print(f"\nRunning: {test_name}")
-            test_func()
+    print(f"\nRunning: {', '.join(test_name for test_name, _ in tests)}\n")
+    results = run_cases_concurrently([
+        (test_name, test_func, ()) for test_name, test_func in tests
+    ])
+
+    for test_name, error in results:
+        if error is None:
             passed += 1
-        except AssertionError as e:
-            print(f"✗ {test_name} [FAIL]: {e}")
+        elif isinstance(error, AssertionError):
+            print(f"✗ {test_name} [FAIL]: {error}")
             failed += 1
-        except Exception as e:
-            print(f"✗ {test_name} [ERROR]: {e}")
+        else:
+            print(f"✗ {test_name} [ERROR]: {error}")
             failed += 1
 
     print("\n" + "="*60)
@@ -282,27 +445,623 @@ class TestInputValidation:
     def test_invalid_risk_score_negative(self):
         """Test negative risk score"""
         payload = {"risk_score": -10, "name": "Test"}
-        response = requests.post(RECOMMEND_ENDPOINT, json=payload)
+        response = session.post(RECOMMEND_ENDPOINT, json=payload)
         assert response.status_code == 400, "Should reject negative risk score"
 
     def test_invalid_risk_score_too_high(self):
         """Test risk score above 100"""
         payload = {"risk_score": 150, "name": "Test"}
-        response = requests.post(RECOMMEND_ENDPOINT, json=payload)
+        response = session.post(RECOMMEND_ENDPOINT, json=payload)
         assert response.status_code == 400, "Should reject risk score > 100"
 
     def test_missing_risk_score(self):
         """Test missing risk score"""
         payload = {"name": "Test"}
-        response = requests.post(RECOMMEND_ENDPOINT, json=payload)
+        response = session.post(RECOMMEND_ENDPOINT, json=payload)
         assert response.status_code == 400, "Should reject missing risk score"
 
 
+# The cases below check server behaviour that needs the app in this process
+inprocess_only = pytest.mark.skipif(not IN_PROCESS, reason="needs FINSECURE_BASE_URL=inprocess")
+
+
+def recommendation_total():
+    response = session.get(f"{BASE_URL}/recommendations", params={"limit": 1, "total": "exact"})
+    assert response.status_code == 200
+    return response.json()["total"]
+
+
+@inprocess_only
+class TestIdempotency:
+    """Idempotency-Key on /recommend"""
+
+    def post(self, key, payload):
+        return session.post(RECOMMEND_ENDPOINT, json=payload, headers={"Idempotency-Key": key})
+
+    def test_repeat_is_replayed_without_saving(self):
+        key = uuid.uuid4().hex
+        before = recommendation_total()
+        first = self.post(key, {"risk_score": 30, "name": "Idempotent"})
+        second = self.post(key, {"risk_score": 30, "name": "Idempotent"})
+        assert first.status_code == second.status_code == 200
+        assert "Idempotent-Replayed" not in first.headers
+        assert second.headers["Idempotent-Replayed"] == "true"
+        assert second.json() == first.json()
+        assert recommendation_total() == before + 1
+
+    def test_key_reused_for_another_request_is_rejected(self):
+        key = uuid.uuid4().hex
+        assert self.post(key, {"risk_score": 30}).status_code == 200
+        assert self.post(key, {"risk_score": 31}).status_code == 422
+
+    def test_failed_write_leaves_key_free_for_retry(self, monkeypatch):
+        key = uuid.uuid4().hex
+        before = recommendation_total()
+
+        def fail(rows):
+            raise RuntimeError("write failed")
+
+        with monkeypatch.context() as patch:
+            patch.setattr(server, "recommendation_delta", fail)
+            assert self.post(key, {"risk_score": 30}).status_code == 500
+        assert recommendation_total() == before
+
+        retry = self.post(key, {"risk_score": 30})
+        assert retry.status_code == 200
+        assert "Idempotent-Replayed" not in retry.headers
+        assert recommendation_total() == before + 1
+
+    def test_unreachable_store_is_not_deduplicated_per_worker(self, monkeypatch):
+        def unavailable(*args, **kwargs):
+            raise server.StorageUnavailable("Database connection failed")
+
+        monkeypatch.setattr(server.get_storage(), "insert_recommendation_once", unavailable)
+        response = self.post(uuid.uuid4().hex, {"risk_score": 30})
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+
+
+
+@inprocess_only
+class TestAdmissionControl:
+    """Rate limiting and load shedding on /recommend and /recommend/batch"""
+
+    @pytest.fixture
+    def limiter(self, monkeypatch):
+        # Next to no refill, so the tests control every token
+        limiter = server.MemoryRateLimiter(rate=0.001, burst=5, retention=60)
+        monkeypatch.setattr(server, "rate_limiter", limiter)
+        return limiter
+
+    @pytest.fixture
+    def gate(self, monkeypatch):
+        gate = server.AdmissionGate(1)
+        monkeypatch.setattr(server, "recommend_gate", gate)
+        return gate
+
+    def test_empty_bucket_is_rejected_with_retry_after(self, limiter):
+        for remaining in range(4, -1, -1):
+            response = session.post(RECOMMEND_ENDPOINT, json={"risk_score": 30})
+            assert response.status_code == 200
+            assert response.headers["X-RateLimit-Limit"] == "5"
+            assert response.headers["X-RateLimit-Remaining"] == str(remaining)
+        response = session.post(RECOMMEND_ENDPOINT, json={"risk_score": 30})
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) >= 1
+
+    def test_batch_is_charged_per_item(self, limiter, monkeypatch):
+        monkeypatch.setattr(server, "RECOMMEND_BATCH_CHUNK_SIZE", 2)
+        response = session.post(f"{BASE_URL}/recommend/batch", json=[{"risk_score": 30}] * 20)
+        assert response.status_code == 200
+        summary = json.loads(response.text.splitlines()[-1])["summary"]
+        assert summary["error"] == "Rate limit exceeded"
+        assert summary["retry_after"] >= 1
+        assert summary["processed"] < 20
+        assert summary["saved"] == summary["succeeded"]
+        assert session.post(RECOMMEND_ENDPOINT, json={"risk_score": 30}).status_code == 429
+
+    def test_busy_worker_sheds_with_503(self, gate):
+        assert gate.enter()
+        try:
+            response = session.post(RECOMMEND_ENDPOINT, json={"risk_score": 30})
+        finally:
+            gate.leave()
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+        assert gate.stats()["shed"] == 1
+
+    def test_batch_holds_its_slot_until_the_stream_closes(self, gate):
+        stream = server.app.test_client().post("/recommend/batch", json=[{"risk_score": 30}])
+        try:
+            assert gate.stats()["in_flight"] == 1
+            response = session.post(f"{BASE_URL}/recommend/batch", json=[{"risk_score": 30}])
+            assert response.status_code == 503
+        finally:
+            stream.close()
+        assert gate.stats()["in_flight"] == 0
+
+
+@inprocess_only
+class TestSafeXMLParser:
+    """parse_xml_safe, the bounded parser behind XML_PARSER=safe"""
+
+    def parse(self, document):
+        return server.parse_xml_safe(io.BytesIO(document.encode()))
+
+    def test_fields_are_read(self):
+        assert self.parse("<r><risk_score>42</risk_score><name>Ann</name></r>") == {
+            "risk_score": 42, "name": "Ann"
+        }
+
+    def test_dtd_is_rejected(self):
+        with pytest.raises(ValueError, match="DTDs are not allowed"):
+            self.parse('<!DOCTYPE r [<!ENTITY x "y">]><r><risk_score>1</risk_score><name>&x;</name></r>')
+
+    def test_undeclared_entity_is_rejected(self):
+        with pytest.raises(ValueError, match="XML parsing error"):
+            self.parse("<r><risk_score>1</risk_score><name>&xxe;</name></r>")
+
+    def test_cdata_is_taken_as_text(self):
+        parsed = self.parse("<r><risk_score>1</risk_score><name><![CDATA[<b>&x;</b>]]></name></r>")
+        assert parsed["name"] == "<b>&x;</b>"
+
+    def test_nesting_limit(self, monkeypatch):
+        monkeypatch.setattr(server, "XML_MAX_DEPTH", 3)
+        with pytest.raises(ValueError, match="nesting exceeds 3 levels"):
+            self.parse("<r><a><b><c/></b></a><risk_score>1</risk_score><name>n</name></r>")
+
+    def test_body_size_limit(self, monkeypatch):
+        monkeypatch.setattr(server, "XML_MAX_BODY_BYTES", 100)
+        with pytest.raises(ValueError, match="body exceeds 100 bytes"):
+            self.parse("<r>" + "<pad/>" * 50 + "<risk_score>1</risk_score><name>n</name></r>")
+
+    def test_reading_stops_once_fields_are_complete(self):
+        # Never closed and followed by garbage: nothing after <name> is read
+        assert self.parse("<r><risk_score>7</risk_score><name>n</name>" + "<" * 10)["risk_score"] == 7
+
+    def test_endpoint_rejects_dtd_with_400(self, monkeypatch):
+        monkeypatch.setattr(server, "XML_PARSER", "safe")
+        response = session.post(
+            RECOMMEND_ENDPOINT,
+            data='<!DOCTYPE r SYSTEM "file:///etc/passwd"><r><risk_score>1</risk_score><name>n</name></r>',
+            headers={"Content-Type": "application/xml"},
+        )
+        assert response.status_code == 400
+        assert "DTDs are not allowed" in response.json()["error"]
+
+
+def create_recommendations(count, prefix):
+    """POST count recommendations named prefix-0, prefix-1, ...; returns their names"""
+    names = [f"{prefix}-{i}" for i in range(count)]
+    for name in names:
+        assert session.post(RECOMMEND_ENDPOINT, json={"risk_score": 30, "name": name}).status_code == 200
+    return names
+
+
+def ndjson_lines(text):
+    return [json.loads(line) for line in text.splitlines() if line]
+
+
+@inprocess_only
+class TestBatchRecommendations:
+    """/recommend/batch results, per-item errors and summary"""
+
+    def test_invalid_items_fail_alone(self):
+        before = recommendation_total()
+        response = session.post(f"{BASE_URL}/recommend/batch", json=[
+            {"risk_score": 10, "name": "Batch ok"},
+            {"risk_score": 150},
+            {"name": "No score"},
+            "not an object",
+            {"risk_score": 90, "name": "x" * 256},
+            {"risk_score": 90},
+        ])
+        assert response.status_code == 200
+        lines = ndjson_lines(response.text)
+        assert [line.get("index") for line in lines[:-1]] == [0, 1, 2, 3, 4, 5]
+        assert [("error" in line) for line in lines[:-1]] == [False, True, True, True, True, False]
+        assert lines[-1]["summary"] == {"processed": 6, "succeeded": 2, "failed": 4, "saved": 2}
+        assert recommendation_total() == before + 2
+
+    def test_malformed_ndjson_line_is_reported_with_its_index(self):
+        body = '{"risk_score": 10}\n{not json\n{"risk_score": 20}\n'
+        response = session.post(
+            f"{BASE_URL}/recommend/batch", data=body,
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        lines = ndjson_lines(response.text)
+        assert "error" in lines[1] and lines[1]["index"] == 1
+        assert lines[-1]["summary"]["succeeded"] == 2
+
+    def test_saved_count_stops_at_the_failed_chunk(self, monkeypatch):
+        storage = server.get_storage()
+        real_batch = storage.recommendation_batch
+        calls = []
+
+        class FlakyBatch:
+            available = True
+
+            def __init__(self):
+                self.batch = real_batch()
+
+            def add(self, rows):
+                calls.append(len(rows))
+                if len(calls) == 2:
+                    raise RuntimeError("chunk failed")
+                return self.batch.add(rows)
+
+            def close(self):
+                self.batch.close()
+
+        monkeypatch.setattr(server, "RECOMMEND_BATCH_CHUNK_SIZE", 2)
+        monkeypatch.setattr(storage, "recommendation_batch", FlakyBatch)
+        before = recommendation_total()
+        response = session.post(f"{BASE_URL}/recommend/batch", json=[{"risk_score": 30}] * 7)
+        summary = ndjson_lines(response.text)[-1]["summary"]
+        assert summary["succeeded"] == 7
+        assert summary["saved"] == 2
+        assert calls == [2, 2]
+        assert recommendation_total() == before + 2
+
+
+
+@inprocess_only
+class TestCursorPaging:
+    """Keyset pagination on /recommendations"""
+
+    def test_pages_follow_on_without_gaps(self):
+        names = create_recommendations(5, f"Page {uuid.uuid4().hex[:8]}")
+        first = session.get(f"{BASE_URL}/recommendations", params={"cursor": "", "limit": 3}).json()
+        assert first["limit"] == 3 and "offset" not in first
+        second = session.get(
+            f"{BASE_URL}/recommendations", params={"cursor": first["next_cursor"], "limit": 3}
+        ).json()
+        seen = [row["name"] for row in first["recommendations"] + second["recommendations"]]
+        assert seen[:5] == names[::-1]
+
+    def test_last_page_has_no_next_cursor(self):
+        page = session.get(f"{BASE_URL}/recommendations", params={"cursor": "", "limit": 1}).json()
+        while page["next_cursor"] is not None:
+            last = page["recommendations"][-1]
+            page = session.get(
+                f"{BASE_URL}/recommendations",
+                params={"cursor": page["next_cursor"], "limit": server.RECOMMENDATIONS_MAX_LIMIT},
+            ).json()
+            assert all(row["id"] != last["id"] for row in page["recommendations"])
+
+    def test_invalid_cursor_is_rejected(self):
+        response = session.get(f"{BASE_URL}/recommendations", params={"cursor": "not-a-cursor"})
+        assert response.status_code == 400
+
+    def test_exact_total_counts_the_filtered_type(self):
+        portfolio_type = session.post(RECOMMEND_ENDPOINT, json={"risk_score": 30}).json()["portfolio_type"]
+        params = {"limit": 1, "total": "exact", "portfolio_type": portfolio_type}
+        before = session.get(f"{BASE_URL}/recommendations", params=params).json()["total"]
+        create_recommendations(3, f"Total {uuid.uuid4().hex[:8]}")
+        assert session.get(f"{BASE_URL}/recommendations", params=params).json()["total"] == before + 3
+
+
+
+@inprocess_only
+class TestResponseCache:
+    """ETags, 304s and invalidation of cached GET responses"""
+
+    def test_matching_etag_gets_304(self):
+        first = session.get(f"{BASE_URL}/metrics")
+        assert first.status_code == 200
+        etag = first.headers["ETag"]
+        repeat = session.get(f"{BASE_URL}/metrics", headers={"If-None-Match": etag})
+        assert repeat.status_code == 304
+        assert repeat.content == b""
+
+    def test_write_invalidates_cached_responses(self):
+        etag = session.get(f"{BASE_URL}/recommendations", params={"limit": 1}).headers["ETag"]
+        create_recommendations(1, "Invalidate")
+        response = session.get(
+            f"{BASE_URL}/recommendations", params={"limit": 1}, headers={"If-None-Match": etag}
+        )
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert response.json()["recommendations"][0]["name"] == "Invalidate-0"
+
+
+
+@inprocess_only
+class TestPortfolioRuleReload:
+    """The rules file is re-read when it changes"""
+
+    def write_rules(self, path, bands, mtime):
+        path.write_text(json.dumps({"bands": bands}))
+        os.utime(path, (mtime, mtime))
+
+    def test_changed_file_is_reloaded_and_bad_files_are_ignored(self, tmp_path, monkeypatch):
+        path = tmp_path / "rules.json"
+        self.write_rules(path, [{"min": 0, "max": 100, "portfolio_type": "Cash"}], 1000)
+        rules = server.PortfolioRules(str(path), 0)
+        monkeypatch.setattr(server, "portfolio_rules", rules)
+        assert session.post(RECOMMEND_ENDPOINT, json={"risk_score": 80}).json()["portfolio_type"] == "Cash"
+
+        self.write_rules(path, [
+            {"min": 0, "max": 59, "portfolio_type": "Cash"},
+            {"min": 60, "max": 100, "portfolio_type": "Equity", "allocation": {"stocks": 100}},
+        ], 2000)
+        response = session.post(RECOMMEND_ENDPOINT, json={"risk_score": 80}).json()
+        assert response["portfolio_type"] == "Equity"
+        assert response["allocation"] == {"stocks": 100}
+
+        # Bands that leave scores uncovered keep the previous rules
+        self.write_rules(path, [{"min": 0, "max": 10, "portfolio_type": "Broken"}], 3000)
+        assert rules.reload() is False
+        assert rules.rule(80)["portfolio_type"] == "Equity"
+
+    def test_batch_applies_the_rules_once_per_chunk(self, tmp_path, monkeypatch):
+        path = tmp_path / "rules.json"
+        self.write_rules(path, [
+            {"min": 0, "max": 59, "portfolio_type": "Cash"},
+            {"min": 60, "max": 100, "portfolio_type": "Equity", "allocation": {"stocks": 100}},
+        ], 1000)
+        rules = server.PortfolioRules(str(path), 0)
+        calls = []
+        lookup = rules.rules
+        monkeypatch.setattr(rules, "rules", lambda scores: calls.append(1) or lookup(scores))
+        monkeypatch.setattr(server, "portfolio_rules", rules)
+        monkeypatch.setattr(server, "RECOMMEND_BATCH_CHUNK_SIZE", 3)
+        response = session.post(f"{BASE_URL}/recommend/batch", json=[
+            {"risk_score": 10}, {"risk_score": 80}, {"risk_score": 500}, {"risk_score": 70},
+        ])
+        lines = ndjson_lines(response.text)
+        assert [line.get("portfolio_type") for line in lines[:-1]] == ["Cash", "Equity", None, "Equity"]
+        assert lines[1]["allocation"] == {"stocks": 100}
+        assert len(calls) == 2
+
+
+@inprocess_only
+class TestTestJobs:
+    """Background pytest runs behind /run-tests/jobs"""
+
+    def test_failed_output_write_kills_the_run_and_finishes_the_job(self, tmp_path, monkeypatch):
+        store = server.TestJobStore(str(tmp_path / "jobs.db"))
+        monkeypatch.setattr(server, "get_test_job_store", lambda: store)
+        processes = []
+        popen = server.subprocess.Popen
+
+        def spawn(*args, **kwargs):
+            processes.append(popen(*args, **kwargs))
+            return processes[-1]
+
+        def append_output(job_id, text):
+            raise RuntimeError("job store is read-only")
+
+        monkeypatch.setattr(server.subprocess, "Popen", spawn)
+        monkeypatch.setattr(store, "append_output", append_output)
+        job, _ = store.submit("compliance")
+        server.run_test_job(job["id"], "compliance")
+
+        job = store.get(job["id"])
+        assert job["status"] == "error"
+        assert "job store is read-only" in job["output"]
+        assert processes[0].poll() is not None
+
+
+@inprocess_only
+def test_event_listener_exits_once_it_has_stopped(monkeypatch):
+    """A listener that has handed over to a new subscriber must not check in again"""
+    broadcaster = server.EventBroadcaster()
+    broadcaster._subscribers.add(object())
+    closed = []
+    checks = []
+
+    class Connection:
+        autocommit = False
+
+        def cursor(self):
+            return self
+
+        def execute(self, query):
+            pass
+
+        def close(self):
+            closed.append(True)
+
+    def connect(*args, **kwargs):
+        # The last subscriber leaves while the listener connects
+        broadcaster._subscribers.clear()
+        return Connection()
+
+    stopping = broadcaster._stopping
+    monkeypatch.setattr(server.psycopg2, "connect", connect)
+    monkeypatch.setattr(broadcaster, "_stopping", lambda: checks.append(stopping()) or checks[-1])
+    broadcaster._listen()
+    assert checks == [True]
+    assert closed == [True]
+
+
+
+@inprocess_only
+class TestExport:
+    """/recommendations/export formats"""
+
+    @pytest.fixture
+    def exported(self):
+        since = datetime.now(timezone.utc).isoformat()
+        names = create_recommendations(3, f"Export {uuid.uuid4().hex[:8]}")
+        return since, names
+
+    def export(self, since, **params):
+        response = session.get(f"{BASE_URL}/recommendations/export", params={"since": since, **params})
+        assert response.status_code == 200
+        return response
+
+    def test_csv(self, exported):
+        since, names = exported
+        response = self.export(since, format="csv")
+        assert response.headers["Content-Type"].startswith("text/csv")
+        rows = list(csv.reader(io.StringIO(response.text)))
+        assert rows[0] == ["id", "name", "risk_score", "portfolio_type", "timestamp"]
+        assert [row[1] for row in rows[1:]] == names
+
+    def test_ndjson(self, exported):
+        since, names = exported
+        rows = ndjson_lines(self.export(since, format="ndjson").text)
+        assert [row["name"] for row in rows] == names
+        assert all(row["risk_score"] == 30 for row in rows)
+
+    def test_gzip(self, exported):
+        since, names = exported
+        response = self.export(since, format="ndjson", compress="gzip")
+        assert response.headers["Content-Type"] == "application/gzip"
+        assert "recommendations.ndjson.gz" in response.headers["Content-Disposition"]
+        rows = ndjson_lines(gzip.decompress(response.content).decode())
+        assert [row["name"] for row in rows] == names
+
+    def test_parquet(self, exported):
+        parquet = pytest.importorskip("pyarrow.parquet")
+        since, names = exported
+        table = parquet.read_table(io.BytesIO(self.export(since, format="parquet").content))
+        assert table.column("name").to_pylist() == names
+
+    @pytest.mark.parametrize("params", [
+        {"format": "xml"}, {"compress": "zip"}, {"format": "parquet", "compress": "gzip"},
+        {"since": "yesterday"},
+    ])
+    def test_bad_arguments_are_rejected(self, params):
+        response = session.get(f"{BASE_URL}/recommendations/export", params=params)
+        assert response.status_code == 400
+
+
+
+@inprocess_only
+class TestStorageBackends:
+    """The sqlite and memory backends behave alike; the Postgres write spool"""
+
+    @pytest.fixture(params=["memory", "sqlite"])
+    def storage(self, request, tmp_path):
+        if request.param == "memory":
+            return server.MemoryStorage()
+        return server.SQLiteStorage(str(tmp_path / "storage.sqlite3"))
+
+    def test_rows_round_trip(self, storage):
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        rows = [("a", 10, "Bonds", now), ("b", 90, "Stocks", now + timedelta(seconds=1))]
+        assert storage.insert_recommendations(rows) == 2
+
+        page, total = storage.page_recommendations(None, 10, total_mode="exact")
+        assert total == 2
+        assert [row["name"] for row in page] == ["b", "a"]
+        page, _ = storage.page_recommendations("Bonds", 10)
+        assert [row["name"] for row in page] == ["a"]
+        page, _ = storage.page_recommendations(None, 10, position=(now + timedelta(seconds=1), 2))
+        assert [row["name"] for row in page] == ["a"]
+
+        _, portfolio_stats, _ = storage.metrics()
+        assert sorted(portfolio_stats) == [("Bonds", 1, 10), ("Stocks", 1, 90)]
+        exported = [row for batch in storage.export_batches(None, None, None, 1) for row in batch]
+        assert [row[1] for row in exported] == ["a", "b"]
+
+    def test_idempotency_key_is_claimed_once(self, storage):
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        row = ("a", 10, "Bonds", now)
+        expired_before = now - timedelta(days=1)
+        assert storage.insert_recommendation_once("k", "h", "{}", row, expired_before) is None
+        assert storage.insert_recommendation_once("k", "h", "{}", row, expired_before) == ("h", "{}")
+        assert storage.page_recommendations(None, 10, total_mode="exact")[1] == 1
+
+    @pytest.fixture
+    def spool(self, tmp_path):
+        return server.WriteSpool(str(tmp_path / "spool.sqlite3"), max_rows=3, batch_size=2)
+
+    def test_full_spool_drops_writes(self, spool):
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        assert spool.add("recommendations", [("a", 10, "Bonds", now)] * 2, ["1", "2"])
+        assert not spool.add("recommendations", [("b", 10, "Bonds", now)] * 2, ["3", "4"])
+        assert spool.stats() == {"pending": 2, "spooled": 2, "replayed": 0, "dropped": 2}
+
+    def test_unreachable_database_spools_and_busy_pool_does_not(self, spool, monkeypatch):
+        storage = server.PostgresStorage(spool)
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+
+        class Pool:
+            def __init__(self, error):
+                self.error = error
+
+            def getconn(self):
+                raise self.error
+
+        monkeypatch.setattr(server, "get_pool", lambda: Pool(server.PoolTimeout("busy")))
+        with pytest.raises(server.StorageUnavailable):
+            storage.insert_recommendations([("a", 10, "Bonds", now)])
+        assert spool.pending() == 0
+
+        monkeypatch.setattr(server, "get_pool", lambda: Pool(server.psycopg2.OperationalError("down")))
+        assert storage.insert_recommendations([("a", 10, "Bonds", now)]) == 1
+        assert spool.pending() == 1
+
+    @pytest.mark.skipif(not TEST_DATABASE_URL, reason="needs FINSECURE_TEST_DATABASE_URL")
+    def test_replay_saves_each_row_once(self, spool):
+        name = f"Spooled {uuid.uuid4().hex[:8]}"
+        row = (name, 10, "Bonds", datetime.now(timezone.utc).replace(tzinfo=None))
+        client_id = str(uuid.uuid4())
+        before = recommendation_total()
+        # The second copy stands for a batch replayed again after a crash
+        spool.add("recommendations", [row], [client_id])
+        assert spool.replay() == 1
+        spool.add("recommendations", [row], [client_id])
+        assert spool.replay() == 1
+        assert spool.pending() == 0
+        assert recommendation_total() == before + 1
+
+
+
+@inprocess_only
+class TestCompressionAndLimits:
+    """Response compression and /recommendations limit clamping"""
+
+    @pytest.fixture(autouse=True)
+    def enough_rows(self):
+        create_recommendations(30, "Compress")
+
+    def test_large_json_is_compressed(self):
+        response = session.get(
+            f"{BASE_URL}/recommendations", params={"limit": 30}, headers={"Accept-Encoding": "gzip"}
+        )
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert "Accept-Encoding" in response.headers["Vary"]
+        assert response.headers["ETag"].startswith("W/")
+        assert len(response.json()["recommendations"]) == 30
+
+    def test_small_and_unaccepted_bodies_are_not_compressed(self):
+        small = session.get(
+            f"{BASE_URL}/recommendations", params={"limit": 1}, headers={"Accept-Encoding": "gzip"}
+        )
+        assert "Content-Encoding" not in small.headers
+        identity = session.get(
+            f"{BASE_URL}/recommendations", params={"limit": 30}, headers={"Accept-Encoding": "identity"}
+        )
+        assert "Content-Encoding" not in identity.headers
+
+    def test_streamed_batch_is_compressed(self):
+        response = session.post(
+            f"{BASE_URL}/recommend/batch", json=[{"risk_score": 30}] * 100,
+            headers={"Accept-Encoding": "gzip"},
+        )
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert ndjson_lines(response.text)[-1]["summary"]["succeeded"] == 100
+
+    @pytest.mark.parametrize("requested, applied", [
+        (0, 1), (-5, 1), (7, 7), (10 ** 6, None),
+    ])
+    def test_limit_is_clamped(self, requested, applied):
+        response = session.get(f"{BASE_URL}/recommendations", params={"limit": requested})
+        assert response.status_code == 200
+        assert response.json()["limit"] == (applied or server.RECOMMENDATIONS_MAX_LIMIT)
+
+
 if __name__ == "__main__":
     """Run tests directly"""
     print("\n" + "="*60)
     print("ADVISOR AI COMPLIANCE SANDBOX - TEST SUITE")
     print("="*60)
+    prepare_test_database()
 
     # Run compliance tests
     try: